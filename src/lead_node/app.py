@@ -1,5 +1,10 @@
-from flask import Flask, request, jsonify
+import itertools
+
+from flask import Flask, Response, request, jsonify
 from file_handler import FileHandler
+from config import STREAMING_STORE, ASYNC_SERVER
+from compression import validate_codec
+from framing import iter_records
 
 app = Flask(__name__)
 file_handler = FileHandler()
@@ -11,20 +16,108 @@ def index():
     return "Welcome to the Distributed Storage System!"
 
 
+def requested_codec():
+    """The compression codec a store asks for with ?compression=, None for the default"""
+    return validate_codec(request.args.get("compression"))
+
+
 @app.route("/store", methods=["POST"])
 def store_endpoint():
-    file_bytes = request.get_data()
-    print("Received file length from get_data():", len(file_bytes))
-
-    file_id = file_handler.store_file(file_bytes)
+    try:
+        codec = requested_codec()
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    if STREAMING_STORE and request.content_length is not None:
+        print("Streaming file of length:", request.content_length)
+        file_id = file_handler.store_file_stream(request.stream, request.content_length, codec)
+    else:
+        file_bytes = request.get_data()
+        print("Received file length from get_data():", len(file_bytes))
+        file_id = file_handler.store_file(file_bytes, codec)
+
+    if file_id is None:
+        return jsonify({"message": "Failed to store file"}), 500
     return jsonify({"file_id": file_id})
 
 
+@app.route("/store_batch", methods=["POST"])
+def store_batch_endpoint():
+    try:
+        codec = requested_codec()
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    # The body holds one framed record per file, in the order the file_ids are returned
+    body = request.get_data()
+    files = [data for _, _, data in iter_records(body)]
+    print(f"Received batch of {len(files)} files, total length={len(body)}")
+    file_ids = file_handler.store_files(files, codec)
+    return jsonify({"file_ids": file_ids})
+
+
+@app.route("/plan_store", methods=["POST"])
+def plan_store_endpoint():
+    size = int(request.args.get("size"))
+    reply = file_handler.plan_store(size)
+    if "file_id" not in reply:
+        return jsonify(reply), 409
+    return jsonify(reply)
+
+
+@app.route("/commit_store", methods=["POST"])
+def commit_store_endpoint():
+    # The body is {"file_id": ..., "checksums": [...], "failed": [[replica_idx, frag_idx], ...]}
+    body = request.get_json()
+    reply = file_handler.commit_store(body["file_id"], body["checksums"], body.get("failed", []))
+    if "file_id" not in reply:
+        return jsonify(reply), 409
+    return jsonify(reply)
+
+
+@app.route("/plan_retrieve", methods=["GET"])
+def plan_retrieve_endpoint():
+    file_id = request.args.get("file_id")
+    reply = file_handler.plan_retrieve(file_id)
+    if "fragments" not in reply:
+        return jsonify(reply), 409
+    return jsonify(reply)
+
+
 @app.route("/retrieve", methods=["GET"])
 def retrieve_endpoint():
     file_id = request.args.get("file_id")
-    file_data = file_handler.retrieve_file(file_id)
-    return file_data
+    status, headers = 200, {"Accept-Ranges": "bytes"}
+    size = file_handler.file_size(file_id)
+    # Requests for a single byte range get only those bytes, other Range requests the whole file
+    if size is not None and request.range is not None and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            return "Range Not Satisfiable", 416, {"Content-Range": f"bytes */{size}"}
+        start, stop = byte_range
+        fragments = file_handler.retrieve_range_stream(file_id, start, stop)
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    else:
+        fragments = file_handler.retrieve_file_stream(file_id)
+    try:
+        # Fetch the first fragment before sending headers so missing files still get an empty reply
+        first = next(fragments)
+    except (StopIteration, IOError) as e:
+        print(f"Could not retrieve file_id={file_id}: {e}")
+        return b""
+    return Response(itertools.chain([first], fragments), status=status, headers=headers)
+
+
+@app.route("/stats", methods=["GET"])
+def stats_endpoint():
+    reply = file_handler.stats()
+    return jsonify(reply)
+
+
+@app.route("/delete", methods=["DELETE"])
+def delete_endpoint():
+    file_id = request.args.get("file_id")
+    reply = file_handler.delete_file(file_id)
+    return jsonify(reply)
 
 
 @app.route("/delete_pods", methods=["POST"])
@@ -39,12 +132,52 @@ def quantify_file_loss_endpoint():
     reply = file_handler.quantify_file_loss()
     return jsonify(reply)
 
+@app.route("/at_risk_files", methods=["GET"])
+def at_risk_files_endpoint():
+    reply = file_handler.at_risk_files()
+    return jsonify(reply)
+
+@app.route("/repair_status", methods=["GET"])
+def repair_status_endpoint():
+    reply = file_handler.repair_status()
+    return jsonify(reply)
+
 @app.route("/change_replication_strategy", methods=["POST"])
 def change_replication_strategy_endpoint():
     strategy = request.get_data().decode("utf-8")
     reply = file_handler.change_replication_strategy(strategy)
     return jsonify(reply)
 
+@app.route("/change_storage_mode", methods=["POST"])
+def change_storage_mode_endpoint():
+    mode = request.get_data().decode("utf-8")
+    reply = file_handler.change_storage_mode(mode)
+    return jsonify(reply)
+
+@app.route("/set_deduplication", methods=["POST"])
+def set_deduplication_endpoint():
+    enabled = request.get_data().decode("utf-8").strip().lower() in ("1", "true", "on")
+    reply = file_handler.set_deduplication(enabled)
+    return jsonify(reply)
+
+@app.route("/set_compression", methods=["POST"])
+def set_compression_endpoint():
+    codec = request.get_data().decode("utf-8").strip().lower()
+    reply = file_handler.set_compression(codec)
+    return jsonify(reply)
+
+@app.route("/set_write_quorum", methods=["POST"])
+def set_write_quorum_endpoint():
+    quorum = int(request.get_data())
+    reply = file_handler.set_write_quorum(quorum)
+    return jsonify(reply)
+
+@app.route("/set_erasure_coding", methods=["POST"])
+def set_erasure_coding_endpoint():
+    data_fragments, parity_fragments = map(int, request.get_data().decode("utf-8").split(","))
+    reply = file_handler.set_erasure_coding(data_fragments, parity_fragments)
+    return jsonify(reply)
+
 @app.route("/set_replicas", methods=["POST"])
 def set_replicas_endpoint():
     replicas = int(request.get_data())
@@ -57,10 +190,21 @@ def set_fragments_endpoint():
     reply = file_handler.set_fragments(fragments)
     return jsonify(reply)
 
+@app.route("/set_fragment_policy", methods=["POST"])
+def set_fragment_policy_endpoint():
+    # Body is "target_size,min_fragments,max_fragments", a target of 0 uses /set_fragments
+    target_size, min_fragments, max_fragments = map(int, request.get_data().decode("utf-8").split(","))
+    reply = file_handler.set_fragment_policy(target_size, min_fragments, max_fragments)
+    return jsonify(reply)
+
 @app.route("/reset_metadata", methods=["POST"])
 def reset_metadata_endpoint():
     reply = file_handler.reset_metadata()
     return jsonify(reply)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=4000)
+    if ASYNC_SERVER:
+        from async_app import run
+        run(file_handler, host="0.0.0.0", port=4000)
+    else:
+        app.run(host="0.0.0.0", port=4000)
@@ -0,0 +1,516 @@
+import asyncio
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from werkzeug.http import parse_range_header
+
+from config import STREAMING_STORE, ASYNC_BLOCKING_WORKERS, STREAM_CHUNK_SIZE
+from config import UPLOAD_RETRIES, PREFETCH_WINDOW
+from config import BATCH_TRANSFERS, BATCH_MAX_BYTES
+from async_storage_client import create_session, upload_fragment_to_node, upload_fragments_to_node
+from async_storage_client import upload_fragment_stream_to_node
+from async_storage_client import download_fragment_from_node, download_fragments_from_node
+from checksum import Checksum
+from compression import validate_codec
+from framing import iter_records
+
+
+class FragmentTransfers:
+    """Moves fragments between the lead node and the storage nodes on the event loop.
+
+    FileHandler places, compresses and records files on worker threads, and the
+    uploads and downloads in between are aiohttp requests, so a transfer waiting
+    on a storage node holds no thread. Stores that FileHandler has to coordinate
+    itself, i.e. deduplicated and write quorum ones, and erasure coded and range
+    reads, are left to FileHandler on a worker thread.
+
+    Transfers share FileHandler's node load scores, per-node upload limits,
+    hedged reads and fragment cache with the transfers FileHandler runs itself.
+    """
+
+    def __init__(self, file_handler, blocking):
+        self.__file_handler = file_handler
+        self.__blocking = blocking
+        self.__session = None
+
+    async def start(self, app):
+        self.__session = create_session()
+
+    async def close(self, app):
+        await self.__session.close()
+
+    async def store_files(self, files, codec):
+        """Store a list of files and return their file_ids, None for files that failed"""
+        if not self.__file_handler.records_after_upload():
+            return await self.__blocking(self.__file_handler.store_files, files, codec)
+        placed, file_ids = await self.__blocking(self.__file_handler.place_files, files, codec)
+        failed = await self.__upload(self.__file_handler.upload_batches(placed))
+        failed = await self.__blocking(self.__file_handler.record_uploaded, placed, failed)
+        if failed:
+            print(f"Failed to store {len(failed)} of {len(files)} files, not recording their metadata")
+        return [None if file_id in failed else file_id for file_id in file_ids]
+
+    async def __upload(self, batches):
+        """Upload a list of (node, records) batches, return the ids of the files that were not fully written"""
+        for attempt in range(1 + UPLOAD_RETRIES):
+            results = await asyncio.gather(
+                *(self.__upload_batch(node, records) for node, records in batches)
+            )
+            batches = [batch for batch, written in zip(batches, results) if not written]
+            if not batches:
+                return set()
+            print(f"Uploads to {sorted({node['name'] for node, _ in batches})} failed (attempt {attempt + 1})")
+        return {file_id for _, records in batches for file_id, _, _, _ in records}
+
+    async def __upload_batch(self, node, records):
+        if len(records) > 1:
+            print(f"Uploading {len(records)} fragments to node {node} in one batch")
+            return await self.__file_handler.upload_async(
+                node, upload_fragments_to_node, self.__session, node, node["ip"],
+                [(file_id, frag_idx, fragment) for file_id, frag_idx, fragment, _ in records],
+                [fragment_checksum for _, _, _, fragment_checksum in records],
+            )
+        file_id, frag_idx, fragment, fragment_checksum = records[0]
+        print(f"Uploading fragment {frag_idx} of {file_id} to node {node}, fragment length={len(fragment)}")
+        return await self.__file_handler.upload_async(
+            node, upload_fragment_to_node, self.__session, node, node["ip"],
+            file_id, frag_idx, fragment, fragment_checksum,
+        )
+
+    async def store_stream(self, content, content_length, codec):
+        """Store a file read from a request body and return its file_id, None if it failed.
+
+        Each fragment goes to its replicas as it is read, through bounded queues.
+        """
+        file_handler = self.__file_handler
+        if not (file_handler.streams(codec) and file_handler.records_after_upload()):
+            file_bytes = await content.read()
+            if len(file_bytes) != content_length:
+                print(f"Upload ended before {content_length} bytes")
+                return None
+            return (await self.store_files([file_bytes], codec))[0]
+        try:
+            file_id, record = await self.__blocking(file_handler.place_stream, content_length)
+        except ValueError as e:
+            print(f"Failed to place a streamed file: {e}")
+            return None
+
+        queue_size = file_handler.stream_queue_size(record)
+        uploads = []
+        try:
+            checksums, complete = await self.__stream_fragments(content, file_id, record, queue_size, uploads)
+        except BaseException:
+            # The client went away, so the uploads will never get the rest of their fragments.
+            # Those that got all of theirs may be stored already, so every started one is deleted.
+            for _, _, upload in uploads:
+                upload.cancel()
+            started = [(frag_idx, node, "unknown") for frag_idx, node, _ in uploads]
+            asyncio.ensure_future(self.__blocking(file_handler.abandon_stream, file_id, started))
+            raise
+
+        # Every replica reports the checksum of what it stored, which must match what was read
+        stored = await asyncio.gather(*(upload for _, _, upload in uploads))
+        results = [(frag_idx, node, result) for (frag_idx, node, _), result in zip(uploads, stored)]
+        if not complete:
+            print(f"Upload of file_id={file_id} ended before {content_length} bytes")
+        elif any(result != checksums[frag_idx] for frag_idx, _, result in results):
+            print(f"Failed to store file_id={file_id}, not recording metadata")
+        else:
+            record["checksums"] = checksums
+            return await self.__blocking(file_handler.record_streamed, file_id, record)
+        await self.__blocking(file_handler.abandon_stream, file_id, results)
+        return None
+
+    async def __stream_fragments(self, content, file_id, record, queue_size, uploads):
+        """Read the fragments of a file from content and pass them to replica uploads added to uploads.
+
+        Returns the checksums of the fragments read and whether the whole file was read.
+        """
+        checksums = []
+        complete = True
+        for frag_idx, fragment_size in enumerate(record["fragment_sizes"]):
+            pipes = []
+            for replica in record["assigned_nodes"]:
+                chunk_queue = asyncio.Queue(maxsize=queue_size)
+                upload = asyncio.ensure_future(
+                    upload_fragment_stream_to_node(
+                        self.__session, replica[frag_idx], replica[frag_idx]["ip"], file_id, frag_idx,
+                        self.__chunks(chunk_queue),
+                    )
+                )
+                pipes.append((chunk_queue, upload))
+                uploads.append((frag_idx, replica[frag_idx], upload))
+
+            running = Checksum()
+            remaining = fragment_size
+            while remaining > 0:
+                chunk = await content.read(min(STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    complete = False
+                    break
+                remaining -= len(chunk)
+                running.update(chunk)
+                await self.__feed_pipes(pipes, chunk)
+            await self.__feed_pipes(pipes, None)
+            checksums.append(running.hexdigest())
+            if not complete:
+                break
+        return checksums, complete
+
+    @staticmethod
+    async def __chunks(chunk_queue):
+        while True:
+            chunk = await chunk_queue.get()
+            if chunk is None:
+                return
+            yield chunk
+
+    @staticmethod
+    async def __feed_pipes(pipes, chunk):
+        """Hand chunk to every replica upload, skipping uploads that have stopped"""
+        for chunk_queue, upload in pipes:
+            if upload.done():
+                continue
+            put = asyncio.ensure_future(chunk_queue.put(chunk))
+            await asyncio.wait([put, upload], return_when=asyncio.FIRST_COMPLETED)
+            put.cancel()
+
+    async def retrieve(self, sources):
+        """Yield the fragments of a file listed by FileHandler.retrieve_sources in order.
+
+        Up to PREFETCH_WINDOW fragments are downloaded ahead, small files in one
+        batch per node. Raises IOError when a fragment is on none of its nodes.
+        """
+        file_id, fragments = sources["file_id"], sources["fragments"]
+        if BATCH_TRANSFERS and sources["size"] <= BATCH_MAX_BYTES and len(fragments) > 1:
+            for frag_idx, frag in enumerate(await self.__download_batched(sources)):
+                if frag is None:
+                    raise IOError(f"Fragment {frag_idx} not found for file_id={file_id}")
+                yield frag
+            return
+
+        pending = deque()
+        next_idx = 0
+        try:
+            while next_idx < len(fragments) or pending:
+                while next_idx < len(fragments) and len(pending) < max(1, PREFETCH_WINDOW):
+                    pending.append(
+                        (next_idx, asyncio.ensure_future(self.__download(sources, next_idx)))
+                    )
+                    next_idx += 1
+                frag_idx, download = pending.popleft()
+                frag = await download
+                if frag is None:
+                    raise IOError(f"Fragment {frag_idx} not found for file_id={file_id}")
+                yield frag
+        finally:
+            # Stop prefetching if the client went away or a fragment was missing
+            for _, download in pending:
+                download.cancel()
+
+    async def __download(self, sources, frag_idx):
+        """Download a fragment unless it is cached, None if none of its nodes has an intact copy.
+
+        Concurrent downloads of the same fragment are coalesced through the cache.
+        """
+        fragment = sources["fragments"][frag_idx]
+        if fragment["cached"] is not None:
+            return fragment["cached"]
+        return await self.__file_handler.load_fragment_async(
+            sources["file_id"], frag_idx, lambda: self.__fetch(sources, frag_idx)
+        )
+
+    async def __fetch(self, sources, frag_idx):
+        """Download a fragment, failing over through its live nodes"""
+        nodes = sources["fragments"][frag_idx]["nodes"]
+        if self.__file_handler.hedged_reads() and len(nodes) > 1:
+            return await self.__hedged_fetch(sources, frag_idx, nodes)
+        for node in nodes:
+            frag = await self.__fetch_from(sources, frag_idx, node)
+            if frag is not None:
+                return frag
+        return None
+
+    async def __hedged_fetch(self, sources, frag_idx, nodes):
+        """Download a fragment from whichever node answers first, as FileHandler hedges its reads.
+
+        A request to the next node is issued when the outstanding ones are slower than
+        the hedge delay or one of them fails. The losers are cancelled.
+        """
+        in_flight = {}
+        remaining = list(nodes)
+
+        def issue(node):
+            in_flight[asyncio.ensure_future(self.__fetch_from(sources, frag_idx, node))] = node
+
+        primary = remaining.pop(0)
+        issue(primary)
+        try:
+            while in_flight:
+                timeout = self.__file_handler.hedge_delay() if remaining else None
+                done, _ = await asyncio.wait(in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    node = remaining.pop(0)
+                    print(f"Hedging fragment {frag_idx} of {sources['file_id']} to {node}")
+                    self.__file_handler.count_hedge()
+                    issue(node)
+                    continue
+                for download in done:
+                    node = in_flight.pop(download)
+                    frag = download.result()
+                    if frag is not None:
+                        if node is not primary:
+                            self.__file_handler.count_hedge(won=True)
+                        return frag
+                    if remaining:  # Fail over right away
+                        issue(remaining.pop(0))
+            return None
+        finally:
+            for download in in_flight:
+                download.cancel()
+
+    async def __fetch_from(self, sources, frag_idx, node):
+        """Download a fragment from node, None if the node does not have an intact copy"""
+        fragment = sources["fragments"][frag_idx]
+        frag = await self.__file_handler.download_async(
+            node, download_fragment_from_node, self.__session, node, node["ip"],
+            fragment["file_id"], fragment["frag_idx"],
+        )
+        if frag is None:
+            return None
+        return await self.__blocking(self.__file_handler.accept_fragment, sources, frag_idx, frag, node)
+
+    async def __download_batched(self, sources):
+        """Download every fragment of a small file with one request per node, failing over fragment by fragment"""
+        fragments = sources["fragments"]
+        batches = {}
+        for frag_idx, fragment in enumerate(fragments):
+            if fragment["cached"] is None and fragment["nodes"]:
+                node = fragment["nodes"][0]
+                batches.setdefault(node["name"], (node, []))[1].append(frag_idx)
+        replies = await asyncio.gather(
+            *(
+                self.__file_handler.call_node_async(
+                    node, download_fragments_from_node, self.__session, node, node["ip"],
+                    [(fragments[frag_idx]["file_id"], fragments[frag_idx]["frag_idx"]) for frag_idx in indices],
+                )
+                for node, indices in batches.values()
+            )
+        )
+        found = {}
+        for (node, indices), reply in zip(batches.values(), replies):
+            for frag_idx in indices:
+                frag = (reply or {}).get((fragments[frag_idx]["file_id"], fragments[frag_idx]["frag_idx"]))
+                if frag is not None:
+                    found[frag_idx] = await self.__blocking(
+                        self.__file_handler.accept_fragment, sources, frag_idx, frag, node
+                    )
+        missing = [frag_idx for frag_idx in range(len(fragments)) if found.get(frag_idx) is None]
+        retries = await asyncio.gather(*(self.__download(sources, frag_idx) for frag_idx in missing))
+        found.update(zip(missing, retries))
+        return [found[frag_idx] for frag_idx in range(len(fragments))]
+
+
+def create_app(file_handler):
+    """The lead node's endpoints on an asyncio server.
+
+    Client connections are held by the event loop, so slow and idle clients cost no
+    thread. Fragments of stored and retrieved files move between the event loop and
+    the storage nodes over aiohttp, see FragmentTransfers. FileHandler calls that
+    block, e.g. placement, compression, metadata and the transfers FileHandler runs
+    itself, use a pool of ASYNC_BLOCKING_WORKERS threads.
+    """
+    executor = ThreadPoolExecutor(max_workers=ASYNC_BLOCKING_WORKERS)
+    routes = web.RouteTableDef()
+
+    async def blocking(fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, functools.partial(fn, *args)
+        )
+
+    transfers = FragmentTransfers(file_handler, blocking)
+
+    def json_endpoint(method, path, call, parse=None):
+        """Route path to call(*parse(body)) and reply with its result as JSON"""
+
+        async def handler(request):
+            args = parse((await request.read()).decode("utf-8")) if parse else ()
+            return web.json_response(await blocking(call, *args))
+
+        routes.route(method, path)(handler)
+
+    @routes.get("/")
+    async def index(request):
+        return web.Response(text="Welcome to the Distributed Storage System!")
+
+    @routes.post("/store")
+    async def store_endpoint(request):
+        try:
+            codec = validate_codec(request.query.get("compression"))
+        except ValueError as e:
+            return web.json_response({"message": str(e)}, status=400)
+        if STREAMING_STORE and request.content_length is not None:
+            print("Streaming file of length:", request.content_length)
+            file_id = await transfers.store_stream(request.content, request.content_length, codec)
+        else:
+            file_bytes = await request.read()
+            print("Received file length from get_data():", len(file_bytes))
+            file_id = (await transfers.store_files([file_bytes], codec))[0]
+
+        if file_id is None:
+            return web.json_response({"message": "Failed to store file"}, status=500)
+        return web.json_response({"file_id": file_id})
+
+    @routes.post("/store_batch")
+    async def store_batch_endpoint(request):
+        try:
+            codec = validate_codec(request.query.get("compression"))
+        except ValueError as e:
+            return web.json_response({"message": str(e)}, status=400)
+        # The body holds one framed record per file, in the order the file_ids are returned
+        body = await request.read()
+        files = [data for _, _, data in iter_records(body)]
+        print(f"Received batch of {len(files)} files, total length={len(body)}")
+        file_ids = await transfers.store_files(files, codec)
+        return web.json_response({"file_ids": file_ids})
+
+    @routes.post("/plan_store")
+    async def plan_store_endpoint(request):
+        reply = await blocking(file_handler.plan_store, int(request.query.get("size")))
+        return web.json_response(reply, status=200 if "file_id" in reply else 409)
+
+    @routes.post("/commit_store")
+    async def commit_store_endpoint(request):
+        body = await request.json()
+        reply = await blocking(
+            file_handler.commit_store, body["file_id"], body["checksums"], body.get("failed", [])
+        )
+        return web.json_response(reply, status=200 if "file_id" in reply else 409)
+
+    @routes.get("/plan_retrieve")
+    async def plan_retrieve_endpoint(request):
+        reply = await blocking(file_handler.plan_retrieve, request.query.get("file_id"))
+        return web.json_response(reply, status=200 if "fragments" in reply else 409)
+
+    @routes.get("/retrieve")
+    async def retrieve_endpoint(request):
+        file_id = request.query.get("file_id")
+        if request.headers.get("Range") is None:
+            sources = await blocking(file_handler.retrieve_sources, file_id)
+            if sources is not None:
+                return await send_fragments(request, file_id, transfers.retrieve(sources))
+        # Range requests and erasure coded files are read by FileHandler
+        status, headers = 200, {"Accept-Ranges": "bytes"}
+        size = await blocking(file_handler.file_size, file_id)
+        byte_ranges = parse_range_header(request.headers.get("Range"))
+        # Requests for a single byte range get only those bytes, other Range requests the whole file
+        if size is not None and byte_ranges is not None and len(byte_ranges.ranges) == 1:
+            byte_range = byte_ranges.range_for_length(size)
+            if byte_range is None:
+                return web.Response(
+                    text="Range Not Satisfiable", status=416,
+                    headers={"Content-Range": f"bytes */{size}"},
+                )
+            start, stop = byte_range
+            fragments = file_handler.retrieve_range_stream(file_id, start, stop)
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        else:
+            fragments = file_handler.retrieve_file_stream(file_id)
+        try:
+            try:
+                # Fetch the first fragment before sending headers so missing files still get an empty reply
+                fragment = await blocking(next, fragments, None)
+            except IOError as e:
+                fragment = None
+                print(f"Could not retrieve file_id={file_id}: {e}")
+            if fragment is None:
+                return web.Response(body=b"")
+            response = web.StreamResponse(status=status, headers=headers)
+            response.content_type = "application/octet-stream"
+            await response.prepare(request)
+            while fragment is not None:
+                await response.write(fragment)
+                fragment = await blocking(next, fragments, None)
+            await response.write_eof()
+            return response
+        finally:
+            # Stops prefetching if the client went away or a fragment was missing
+            await blocking(fragments.close)
+
+    async def send_fragments(request, file_id, fragments):
+        try:
+            try:
+                # Fetch the first fragment before sending headers so missing files still get an empty reply
+                fragment = await anext(fragments, None)
+            except IOError as e:
+                fragment = None
+                print(f"Could not retrieve file_id={file_id}: {e}")
+            if fragment is None:
+                return web.Response(body=b"")
+            response = web.StreamResponse(headers={"Accept-Ranges": "bytes"})
+            response.content_type = "application/octet-stream"
+            await response.prepare(request)
+            while fragment is not None:
+                await response.write(fragment)
+                fragment = await anext(fragments, None)
+            await response.write_eof()
+            return response
+        finally:
+            await fragments.aclose()
+
+    @routes.delete("/delete")
+    async def delete_endpoint(request):
+        reply = await blocking(file_handler.delete_file, request.query.get("file_id"))
+        return web.json_response(reply)
+
+    @routes.post("/delete_pods")
+    async def delete_pods_endpoint(request):
+        s = int(await request.read())
+        reply = await blocking(file_handler.kill_storage_nodes, s)
+        return web.json_response({"message": f"Killed {s} storage nodes", "killed_nodes": reply})
+
+    json_endpoint("GET", "/stats", file_handler.stats)
+    json_endpoint("GET", "/quantify_file_loss", file_handler.quantify_file_loss)
+    json_endpoint("GET", "/at_risk_files", file_handler.at_risk_files)
+    json_endpoint("GET", "/repair_status", file_handler.repair_status)
+    json_endpoint(
+        "POST", "/change_replication_strategy", file_handler.change_replication_strategy,
+        lambda body: (body,),
+    )
+    json_endpoint(
+        "POST", "/change_storage_mode", file_handler.change_storage_mode, lambda body: (body,)
+    )
+    json_endpoint(
+        "POST", "/set_deduplication", file_handler.set_deduplication,
+        lambda body: (body.strip().lower() in ("1", "true", "on"),),
+    )
+    json_endpoint(
+        "POST", "/set_compression", file_handler.set_compression,
+        lambda body: (body.strip().lower(),),
+    )
+    json_endpoint("POST", "/set_write_quorum", file_handler.set_write_quorum, lambda body: (int(body),))
+    json_endpoint(
+        "POST", "/set_erasure_coding", file_handler.set_erasure_coding,
+        lambda body: tuple(map(int, body.split(","))),
+    )
+    json_endpoint("POST", "/set_replicas", file_handler.set_replicas, lambda body: (int(body),))
+    json_endpoint("POST", "/set_fragments", file_handler.set_fragments, lambda body: (int(body),))
+    # Body is "target_size,min_fragments,max_fragments", a target of 0 uses /set_fragments
+    json_endpoint(
+        "POST", "/set_fragment_policy", file_handler.set_fragment_policy,
+        lambda body: tuple(map(int, body.split(","))),
+    )
+    json_endpoint("POST", "/reset_metadata", file_handler.reset_metadata)
+
+    app = web.Application(client_max_size=0)
+    app.add_routes(routes)
+    app.on_startup.append(transfers.start)
+    app.on_cleanup.append(transfers.close)
+    return app
+
+
+def run(file_handler, host, port):
+    web.run_app(create_app(file_handler), host=host, port=port, access_log=None)
@@ -0,0 +1,115 @@
+import aiohttp
+
+from config import NODE_POOL_SIZE, CONNECT_TIMEOUT, READ_TIMEOUT
+from framing import encode_records, iter_records
+
+# The asyncio counterpart of storage_node_client.py, used by async_app.py
+
+TIMEOUT = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+
+def create_session():
+    """Session for every storage node, keeping up to NODE_POOL_SIZE connections to each"""
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=NODE_POOL_SIZE)
+    return aiohttp.ClientSession(connector=connector, timeout=TIMEOUT)
+
+async def upload_fragment_to_node(session, node, node_ip, file_id, frag_idx, fragment, checksum=None):
+    """Upload a fragment to a storage node, return True on success.
+
+    The node rejects the fragment if it does not match checksum.
+    """
+    url = f"http://{node_ip}:5000/upload_fragment?file_id={file_id}&frag_idx={frag_idx}"
+    try:
+        headers = {"X-Checksum": checksum} if checksum else None
+        async with session.post(url, data=fragment, headers=headers) as r:
+            if r.status != 200:
+                print(
+                    f"Failed to upload fragment {frag_idx} of {file_id} to {node}, status code={r.status}"
+                )
+                return False
+        print(f"Successfully uploaded fragment {frag_idx} of {file_id} to {node}")
+        return True
+    except Exception as e:
+        print(f"Upload error for fragment {frag_idx} of {file_id} to {node}: {e}")
+        return False
+
+async def upload_fragment_stream_to_node(session, node, node_ip, file_id, frag_idx, chunks):
+    """Upload a fragment to a storage node from an async iterable of byte chunks.
+
+    Returns the checksum of the fragment as stored by the node, None on failure.
+    """
+    url = f"http://{node_ip}:5000/upload_fragment?file_id={file_id}&frag_idx={frag_idx}"
+    try:
+        # An async generator body is sent with chunked transfer encoding
+        async with session.post(url, data=chunks) as r:
+            if r.status != 200:
+                print(
+                    f"Failed to stream fragment {frag_idx} of {file_id} to {node}, status code={r.status}"
+                )
+                return None
+            print(f"Successfully streamed fragment {frag_idx} of {file_id} to {node}")
+            return r.headers.get("X-Checksum")
+    except Exception as e:
+        print(f"Streaming upload error for fragment {frag_idx} of {file_id} to {node}: {e}")
+        return None
+
+async def upload_fragments_to_node(session, node, node_ip, records, checksums=None):
+    """Upload a batch of (file_id, frag_idx, fragment) records in one request, return True on success.
+
+    checksums lists the checksum of every record, the node rejects the batch if one does not match.
+    """
+    url = f"http://{node_ip}:5000/upload_fragments"
+    try:
+        headers = {"X-Checksums": ",".join(checksums)} if checksums else None
+        async with session.post(url, data=encode_records(records), headers=headers) as r:
+            if r.status != 200:
+                print(
+                    f"Failed to upload batch of {len(records)} fragments to {node}, status code={r.status}"
+                )
+                return False
+        print(f"Successfully uploaded batch of {len(records)} fragments to {node}")
+        return True
+    except Exception as e:
+        print(f"Upload error for batch of {len(records)} fragments to {node}: {e}")
+        return False
+
+async def download_fragments_from_node(session, node, node_ip, keys):
+    """Download a batch of (file_id, frag_idx) fragments in one request.
+
+    Returns a dict from (file_id, frag_idx) to fragment holding the fragments the
+    node had, or None if the request failed.
+    """
+    url = f"http://{node_ip}:5000/get_fragments"
+    try:
+        body = encode_records((file_id, frag_idx, b"") for file_id, frag_idx in keys)
+        async with session.post(url, data=body) as r:
+            if r.status != 200:
+                print(
+                    f"Failed to download batch of {len(keys)} fragments from {node}, status code={r.status}"
+                )
+                return None
+            content = await r.read()
+        fragments = {
+            (file_id, frag_idx): bytes(data)
+            for file_id, frag_idx, data in iter_records(content)
+            if data is not None
+        }
+        print(f"Downloaded {len(fragments)} of {len(keys)} batched fragments from {node}")
+        return fragments
+    except Exception as e:
+        print(f"Download error for batch of {len(keys)} fragments from {node}: {e}")
+    return None
+
+async def download_fragment_from_node(session, node, node_ip, file_id, frag_idx):
+    """Download a fragment from a storage node, None if it could not be"""
+    url = f"http://{node_ip}:5000/get_fragment?file_id={file_id}&frag_idx={frag_idx}"
+    try:
+        async with session.get(url) as r:
+            if r.status != 200:
+                print(f"Fragment {frag_idx} of {file_id} not found on {node}, status code={r.status}")
+                return None
+            content = await r.read()
+        print(f"Downloaded fragment {frag_idx} of {file_id} from {node}, size={len(content)}")
+        return content
+    except Exception as e:
+        print(f"Download error for fragment {frag_idx} of {file_id} from {node}: {e}")
+    return None
@@ -0,0 +1,24 @@
+import zlib
+
+# Fragment checksums are CRC32s in hex, sent as X-Checksum headers and kept by
+# both the lead node and the storage nodes. A copy of this module lives in both.
+
+
+class Checksum:
+    """Running checksum of a fragment fed chunk by chunk, without copying the chunks"""
+
+    def __init__(self):
+        self.__crc = 0
+
+    def update(self, data):
+        self.__crc = zlib.crc32(data, self.__crc)
+
+    def hexdigest(self):
+        return f"{self.__crc:08x}"
+
+
+def checksum(data):
+    """Checksum of a whole fragment given as a bytes-like object"""
+    running = Checksum()
+    running.update(data)
+    return running.hexdigest()
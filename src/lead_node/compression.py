@@ -0,0 +1,97 @@
+import lzma
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, zlib and lzma are always there
+    zstandard = None
+
+ZLIB = "zlib"
+LZMA = "lzma"
+ZSTD = "zstd"
+
+
+def _zstd_compress(data):
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+# codec -> (compress, decompress), both taking and returning bytes
+CODECS = {
+    ZLIB: (lambda data: zlib.compress(data, 6), zlib.decompress),
+    LZMA: (lambda data: lzma.compress(data, preset=1), lzma.decompress),
+}
+if zstandard is not None:
+    CODECS[ZSTD] = (_zstd_compress, _zstd_decompress)
+
+
+def validate_codec(codec):
+    """Return a codec a client asked for, raising ValueError if it is unknown.
+
+    None asks for the default codec and "none" for no compression.
+    """
+    if codec is not None and codec != "none" and codec not in CODECS:
+        raise ValueError(f"Unknown compression codec {codec}, available: {sorted(CODECS)}")
+    return codec
+
+
+def compress(codec, data):
+    return CODECS[codec][0](data)
+
+
+def decompress(codec, data):
+    return CODECS[codec][1](data)
+
+
+class Compressor:
+    """Compresses the fragments of stored files on a pool of worker threads.
+
+    zlib, lzma and zstd release the GIL while they work, so threads compress in
+    parallel without holding up the request threads. Fragments are decompressed
+    by the download workers that fetch them.
+    """
+
+    def __init__(self, workers, min_size):
+        self.__executor = ThreadPoolExecutor(max_workers=workers)
+        self.__min_size = min_size
+        self.__lock = threading.Lock()
+        self.__bytes_in = 0
+        self.__bytes_stored = 0
+
+    def compress_fragments(self, codec, fragments):
+        """Compress fragments with codec and return (stored fragments, compressed flags).
+
+        Fragments smaller than min_size, or that do not shrink, are stored as they are.
+        """
+        if codec not in CODECS:
+            raise ValueError(f"Unknown compression codec {codec}, available: {sorted(CODECS)}")
+        futures = [
+            self.__executor.submit(compress, codec, fragment) if len(fragment) >= self.__min_size else None
+            for fragment in fragments
+        ]
+        stored, flags = [], []
+        for fragment, future in zip(fragments, futures):
+            compressed = future.result() if future is not None else None
+            if compressed is not None and len(compressed) < len(fragment):
+                stored.append(compressed)
+                flags.append(True)
+            else:
+                stored.append(fragment)
+                flags.append(False)
+        with self.__lock:
+            self.__bytes_in += sum(len(fragment) for fragment in fragments)
+            self.__bytes_stored += sum(len(fragment) for fragment in stored)
+        return stored, flags
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "codecs": sorted(CODECS),
+                "bytes_in": self.__bytes_in,
+                "bytes_stored": self.__bytes_stored,
+            }
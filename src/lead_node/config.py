@@ -1,6 +1,145 @@
+import os
+
 from node_selection import MIN_COPY_SETS_SELECTION, RANDOM_SELECTION, BUDDY_SELECTION
+from erasure_coding import REPLICATION, ERASURE_CODING
+from metadata_store import IN_MEMORY_METADATA, SQLITE_METADATA
+from membership import KUBERNETES_MEMBERSHIP, FAKE_MEMBERSHIP
 
 # NO_NODES = 4 # Hardcoded into yaml file.
 NO_REPLICAS = 3
 NO_FRAGMENTS = 4
 NODE_SELECTION_STRATEGY = RANDOM_SELECTION
+
+# Streaming store: read uploads in chunks and push fragments to the storage nodes
+# while the rest of the file is still arriving. Lead node memory per store is
+# bounded by STREAM_BUFFER_SIZE instead of the file size.
+STREAMING_STORE = True
+STREAM_CHUNK_SIZE = 64 * 1024  # 64 KiB
+STREAM_BUFFER_SIZE = 8 * 1024 * 1024  # 8 MiB
+
+# Streaming retrieve: fragments are sent to the client in order while up to
+# PREFETCH_WINDOW following fragments are downloaded in parallel.
+PREFETCH_WINDOW = 4
+DOWNLOAD_WORKERS = 32
+
+# Hedged reads: if a fragment download has not finished after the
+# HEDGE_PERCENTILE latency of recent downloads (but at least HEDGE_MIN_DELAY
+# seconds), the same fragment is requested from another replica and the first
+# response wins.
+HEDGED_READS = False
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_DELAY = 0.05
+HEDGE_LATENCY_WINDOW = 1000
+
+# Keep-alive connection pool per storage node and per-request timeouts (seconds)
+NODE_POOL_SIZE = 16
+CONNECT_TIMEOUT = 2
+READ_TIMEOUT = 30
+
+# Shared upload engine: bounded worker pool, per-node concurrency limit and a
+# cap on queued uploads that blocks new stores while the pool is saturated.
+UPLOAD_WORKERS = 32
+PER_NODE_UPLOAD_LIMIT = 8
+UPLOAD_QUEUE_LIMIT = 256
+STREAM_UPLOAD_WORKERS = 64
+UPLOAD_RETRIES = 2
+
+# Storage mode: full replication of every fragment, or Reed-Solomon erasure
+# coding with EC_DATA_FRAGMENTS data plus EC_PARITY_FRAGMENTS parity fragments.
+# Any EC_DATA_FRAGMENTS surviving fragments are enough to rebuild a file.
+STORAGE_MODE = REPLICATION
+EC_DATA_FRAGMENTS = 4
+EC_PARITY_FRAGMENTS = 2
+
+# File metadata backend. SQLite keeps metadata across lead node restarts and
+# commits concurrent writes together, waiting up to METADATA_COMMIT_INTERVAL
+# seconds to batch at most METADATA_COMMIT_BATCH writes per commit.
+METADATA_BACKEND = SQLITE_METADATA
+METADATA_PATH = os.environ.get("METADATA_PATH", "./metadata/metadata.db")
+METADATA_COMMIT_INTERVAL = 0.002
+METADATA_COMMIT_BATCH = 512
+
+# Fragments of files up to BATCH_MAX_BYTES that go to the same storage node are
+# sent and fetched in one batched request instead of one request per fragment
+BATCH_TRANSFERS = True
+BATCH_MAX_BYTES = 1024 * 1024  # 1 MiB
+
+# Content-addressed deduplication: fragments are stored under a BLAKE2 hash of
+# their bytes with reference counts in the metadata, and fragments that are
+# already stored on enough live nodes are not uploaded again.
+DEDUPLICATION = False
+
+# LRU cache of recently stored and retrieved fragments, bounded by
+# FRAGMENT_CACHE_BYTES (0 disables it). With CACHE_WRITE_THROUGH the fragments
+# of every stored file are cached as well.
+FRAGMENT_CACHE_BYTES = 256 * 1024 * 1024  # 256 MiB
+CACHE_WRITE_THROUGH = True
+
+# Storage nodes are tracked with a watch on the storage-node pods, and the full
+# pod list is fetched again every MEMBERSHIP_RESYNC_INTERVAL seconds in case
+# the watch missed an event. MEMBERSHIP=fake runs the lead node without
+# Kubernetes, on the fixed "host:port,host:port" list in STORAGE_NODES.
+MEMBERSHIP = os.environ.get("MEMBERSHIP", KUBERNETES_MEMBERSHIP)
+MEMBERSHIP_RESYNC_INTERVAL = 60
+FAKE_STORAGE_NODES = [
+    # Storage nodes are always reached on port 5000
+    {"name": entry.split(":")[0], "ip": entry.split(":")[0]}
+    for entry in os.environ.get("STORAGE_NODES", "").split(",")
+    if entry
+]
+
+# Fragments that lost copies when a storage node left are copied from a
+# surviving replica to a replacement node in the background, fewest surviving
+# copies first, by REPAIR_WORKERS workers sharing REPAIR_BYTES_PER_SECOND.
+AUTO_REPAIR = True
+REPAIR_WORKERS = 4
+REPAIR_BYTES_PER_SECOND = 32 * 1024 * 1024  # 32 MiB/s
+
+# Load-aware node selection scores nodes by an EWMA (weight LOAD_EWMA_ALPHA) of
+# their request latency, their requests in flight and the free disk space they
+# report every LOAD_STATS_INTERVAL seconds. Nodes with less than
+# LOAD_MIN_FREE_FRACTION of their disk free lose against any other choice.
+LOAD_EWMA_ALPHA = 0.2
+LOAD_STATS_INTERVAL = 10
+LOAD_MIN_FREE_FRACTION = 0.05
+
+# With replication, /store returns once WRITE_QUORUM replicas of every fragment
+# are written. The rest are recorded as pending and finish in the background,
+# reads skip them until they are confirmed. 0 waits for every replica.
+WRITE_QUORUM = 0
+
+# Fragments are compressed with the COMPRESSION codec ("zlib", "lzma" or, if the
+# zstandard package is installed, "zstd") unless a store asks for another one.
+# None stores them as they are. Fragments under COMPRESSION_MIN_SIZE bytes, or
+# that do not shrink, are never compressed.
+COMPRESSION = None
+COMPRESSION_MIN_SIZE = 4096
+COMPRESSION_WORKERS = 4
+
+# Replicated files get one fragment per FRAGMENT_TARGET_SIZE bytes, but at least
+# MIN_FRAGMENTS and at most MAX_FRAGMENTS, and keep that count in their record.
+# A target of 0, the default, splits every file into NO_FRAGMENTS fragments.
+# /set_fragment_policy turns the size policy on and /set_fragments turns it off.
+FRAGMENT_TARGET_SIZE = 0
+MIN_FRAGMENTS = 1
+MAX_FRAGMENTS = 16
+
+# Direct data path: /plan_store and /plan_retrieve give clients the nodes of a
+# file's fragments and tokens, signed with TOKEN_SECRET, that let them move the
+# fragments to and from the storage nodes themselves for DIRECT_TOKEN_TTL
+# seconds. Stores are recorded by /commit_store, uploads of stores that are not
+# committed within another DIRECT_TOKEN_TTL seconds are deleted. Direct uploads
+# never overwrite a stored fragment. Without a secret all data goes through the
+# lead node.
+TOKEN_SECRET = os.environ.get("TOKEN_SECRET")
+DIRECT_TOKEN_TTL = 300
+
+# Serve the lead node's endpoints from an asyncio server (async_app.py) instead
+# of Flask's threaded server. Client connections and fragment transfers then
+# cost no thread while they wait, and the FileHandler calls that block run on
+# ASYNC_BLOCKING_WORKERS threads. Its transfers keep to PER_NODE_UPLOAD_LIMIT,
+# hedge as HEDGED_READS says and count towards the load of their nodes, but
+# wait on the event loop, so UPLOAD_WORKERS, UPLOAD_QUEUE_LIMIT and
+# STREAM_UPLOAD_WORKERS only bound the transfers FileHandler runs itself.
+ASYNC_SERVER = os.environ.get("ASYNC_SERVER", "0") == "1"
+ASYNC_BLOCKING_WORKERS = 256
@@ -0,0 +1,199 @@
+import hashlib
+import threading
+
+CONTENT_PREFIX = "cas_"
+
+
+def content_address(fragment):
+    """Storage key of a fragment derived from its bytes"""
+    return CONTENT_PREFIX + hashlib.blake2b(memoryview(fragment), digest_size=32).hexdigest()
+
+
+class Deduplicator:
+    """Reference counted content-addressed fragments.
+
+    A chunk record {"nodes": [...], "refs": int, "size": int} is kept in the
+    metadata store for every content address. Stores and deletes hold the
+    addresses they work on between begin and end, so a repeat upload of the same
+    content waits for the first one and a chunk is never deleted while another
+    store is about to reference it.
+    """
+
+    def __init__(self, metadata):
+        self.__metadata = metadata
+        self.__lock = threading.Lock()
+        self.__busy = {}  # address -> Event set when its holder is done
+        self.__stats_lock = threading.Lock()
+        self.fragments_deduplicated = 0
+        self.bytes_saved = 0
+
+    def begin(self, addresses):
+        """Hold a set of addresses and return their chunk records, None for new content"""
+        held = []
+        try:
+            # Always taken in sorted order, so two stores cannot wait on each other
+            for address in sorted(addresses):
+                while True:
+                    with self.__lock:
+                        event = self.__busy.get(address)
+                        if event is None:
+                            self.__busy[address] = threading.Event()
+                            break
+                    event.wait()
+                held.append(address)
+        except BaseException:
+            self.end(held)
+            raise
+        return {address: self.__metadata.get_chunk(address) for address in held}
+
+    def end(self, addresses):
+        with self.__lock:
+            for address in addresses:
+                self.__busy.pop(address).set()
+
+    def add_references(self, updates):
+        """Add references to held addresses.
+
+        updates is a list of (address, chunk, nodes, references, size) where chunk is
+        the record returned by begin and nodes the nodes the fragment is stored on.
+        """
+        items = []
+        for address, chunk, nodes, references, size in updates:
+            if chunk is None:
+                chunk = {"nodes": [], "refs": 0, "size": size}
+            names = {node["name"] for node in chunk["nodes"]}
+            chunk["nodes"] = chunk["nodes"] + [node for node in nodes if node["name"] not in names]
+            chunk["refs"] += references
+            items.append((address, chunk))
+        self.__metadata.put_chunks(items)
+
+    def remove_references(self, chunks, references):
+        """Drop references (address -> count) to held addresses.
+
+        Returns address -> nodes for the content that is no longer referenced.
+        """
+        items, unused = [], {}
+        for address, count in references.items():
+            chunk = chunks.get(address)
+            if chunk is None:
+                continue
+            chunk["refs"] -= count
+            if chunk["refs"] > 0:
+                items.append((address, chunk))
+            else:
+                items.append((address, None))
+                unused[address] = chunk["nodes"]
+        self.__metadata.put_chunks(items)
+        return unused
+
+    def store(self, placed, live_nodes, upload_files, record_files):
+        """Store placed files, a dict of file_id -> (fragments, record), under the content addresses of their fragments.
+
+        Content that is already stored on enough of live_nodes (names) is referenced
+        instead of uploaded, and the file's record points at the nodes that hold it.
+        upload_files(files) uploads a dict of key -> (fragments, checksums, assigned_nodes)
+        and returns the keys that failed, record_files(records) records a list of
+        (file_id, record). Returns the ids of the files that failed.
+        """
+        occurrences = {}  # address -> [(file_id, frag_idx), ...]
+        for file_id, (fragments, record) in placed.items():
+            record["fragment_keys"] = [content_address(fragment) for fragment in fragments]
+            for frag_idx, address in enumerate(record["fragment_keys"]):
+                occurrences.setdefault(address, []).append((file_id, frag_idx))
+
+        chunks = self.begin(occurrences)
+        try:
+            uploads = {}
+            for address, refs in occurrences.items():
+                file_id, frag_idx = refs[0]
+                fragments, record = placed[file_id]
+                copies = len(record["assigned_nodes"])
+                chunk = chunks[address]
+                live = [node for node in chunk["nodes"] if node["name"] in live_nodes] if chunk else []
+                if len(live) >= copies:
+                    column = live[:copies]
+                else:
+                    column = [replica[frag_idx] for replica in record["assigned_nodes"]]
+                    uploads[address] = (
+                        [fragments[frag_idx]],
+                        [record["checksums"][frag_idx]],
+                        [[node] for node in column],
+                    )
+                for ref_file_id, ref_idx in refs:
+                    for replica, node in zip(placed[ref_file_id][1]["assigned_nodes"], column):
+                        replica[ref_idx] = node
+
+            # Content is stored as fragment 0 of its address
+            failed_uploads = upload_files(uploads)
+            failed = {
+                file_id for address in failed_uploads for file_id, _ in occurrences[address]
+            }
+
+            updates = []
+            for address, refs in occurrences.items():
+                stored = [ref for ref in refs if ref[0] not in failed]
+                if not stored:
+                    continue
+                file_id, frag_idx = stored[0]
+                fragments, record = placed[file_id]
+                size = len(fragments[frag_idx])
+                column = [replica[frag_idx] for replica in record["assigned_nodes"]]
+                updates.append((address, chunks[address], column, len(stored), size))
+                saved = len(stored) - (1 if address in uploads else 0)
+                self.count_saved(saved, saved * size)
+            self.add_references(updates)
+            record_files(
+                [(file_id, record) for file_id, (_, record) in placed.items() if file_id not in failed]
+            )
+        finally:
+            self.end(occurrences)
+        print(f"Uploaded {len(uploads)} of {len(occurrences)} distinct fragments")
+        return failed
+
+    def release(self, record, delete_fragments):
+        """Drop a deleted file's references to its content, deleting content nobody uses.
+
+        delete_fragments(fragments) deletes a dict of (node name, address, 0) -> node
+        and returns the number of copies deleted, which is returned.
+        """
+        references = {}
+        for address in record["fragment_keys"]:
+            references[address] = references.get(address, 0) + 1
+        chunks = self.begin(references)
+        try:
+            unused = self.remove_references(chunks, references)
+            # Still held, so a concurrent store of the same content waits for the delete
+            return delete_fragments(
+                {
+                    (node["name"], address, 0): node
+                    for address, nodes in unused.items()
+                    for node in nodes
+                }
+            )
+        finally:
+            self.end(references)
+
+    def holders(self, address):
+        """The nodes a content address is stored on"""
+        chunk = self.__metadata.get_chunk(address)
+        return chunk["nodes"] if chunk else []
+
+    def add_copies(self, address, nodes, size):
+        """Note new copies of stored content on nodes, e.g. made by a repair"""
+        chunks = self.begin([address])
+        try:
+            self.add_references([(address, chunks[address], nodes, 0, size)])
+        finally:
+            self.end([address])
+
+    def count_saved(self, fragments, size):
+        with self.__stats_lock:
+            self.fragments_deduplicated += fragments
+            self.bytes_saved += size
+
+    def stats(self):
+        with self.__stats_lock:
+            return {
+                "fragments_deduplicated": self.fragments_deduplicated,
+                "bytes_saved": self.bytes_saved,
+            }
@@ -0,0 +1,132 @@
+import threading
+import time
+from collections import Counter
+
+import tokens
+from file_records import fragment_copies
+
+
+class DirectTransfers:
+    """Plans and tokens of the direct data path, where clients move fragments to and from the storage nodes.
+
+    A planned store waits for its client to commit it. If that does not happen
+    within ttl seconds after its upload tokens expire, the plan is dropped and the
+    fragments its client uploaded are deleted. Tokens are signed with secret,
+    without one every plan is refused.
+    """
+
+    def __init__(self, secret, ttl, record_file, delete_fragments):
+        # record_file(file_id, record) records a committed file, raising IOError if it cannot,
+        # delete_fragments(fragments) deletes a dict of (node name, file_id, frag_idx) -> node
+        self.__secret = secret
+        self.__ttl = ttl
+        self.__record_file = record_file
+        self.__delete_fragments = delete_fragments
+        self.__plans = {}  # file_id -> (expiry time, record)
+        self.__lock = threading.Lock()
+        threading.Thread(target=self.__expire_loop, daemon=True, args=(ttl,)).start()
+
+    def enabled(self):
+        return bool(self.__secret)
+
+    def planned(self, file_id):
+        """Whether a store of file_id is planned and not committed yet"""
+        # Read without the lock, plan_store draws file_ids while it holds it
+        return file_id in self.__plans
+
+    def plan_store(self, new_file_id, place):
+        """Plan the direct store of a new file and return its plan with an upload token per fragment.
+
+        new_file_id() draws an unused file_id and place(file_id) returns the file's
+        record, raising ValueError if it cannot be placed.
+        """
+        expires = int(time.time() + self.__ttl)
+        with self.__lock:
+            file_id = new_file_id()
+            try:
+                record = place(file_id)
+            except ValueError as e:
+                return {"message": f"Failed to place file_id={file_id}: {e}"}
+            self.__plans[file_id] = (expires, record)
+        print(f"Planned direct store of file_id={file_id}, assigned nodes:", record["assigned_nodes"])
+        return {
+            "file_id": file_id,
+            "fragment_sizes": record["fragment_sizes"],
+            "assigned_nodes": record["assigned_nodes"],
+            "tokens": [
+                tokens.sign(self.__secret, tokens.UPLOAD, file_id, frag_idx, expires)
+                for frag_idx in range(record["no_fragments"])
+            ],
+            "expires": expires,
+        }
+
+    def commit_store(self, file_id, checksums, failed, required):
+        """Record a planned file once its client uploaded the fragments.
+
+        failed lists the [replica_idx, frag_idx] slots the client could not write. They are
+        recorded as pending, as long as every fragment has required written replicas.
+        """
+        with self.__lock:
+            expires, record = self.__plans.get(file_id, (None, None))
+            if record is None or expires + self.__ttl < time.time():
+                return {"message": f"No direct store planned for file_id={file_id}"}
+            if len(checksums) != record["no_fragments"]:
+                return {"message": f"Expected {record['no_fragments']} checksums for file_id={file_id}"}
+            pending = sorted({(int(replica_idx), int(frag_idx)) for replica_idx, frag_idx in failed})
+            required = required or len(record["assigned_nodes"])
+            written = Counter(frag_idx for _, frag_idx in pending)
+            if any(len(record["assigned_nodes"]) - written[frag_idx] < required for frag_idx in written):
+                return {"message": f"Too few replicas of file_id={file_id} were written"}
+            del self.__plans[file_id]
+        planned, record = record, dict(record, checksums=list(checksums))
+        if pending:
+            record["pending"] = [list(slot) for slot in pending]
+        try:
+            self.__record_file(file_id, record)
+        except IOError as e:
+            # The plan is kept, the client may commit again before it expires
+            with self.__lock:
+                self.__plans[file_id] = (expires, planned)
+            print(f"Failed to record direct store of file_id={file_id}: {e}")
+            return {"message": f"Failed to record file_id={file_id}: {e}"}
+        print(f"Committed direct store of file_id={file_id}")
+        return {"file_id": file_id}
+
+    def plan_retrieve(self, plan):
+        """Add a download token to every fragment of a plan listing where a file's fragments are"""
+        expires = int(time.time() + self.__ttl)
+        for fragment in plan["fragments"]:
+            fragment["token"] = tokens.sign(
+                self.__secret, tokens.DOWNLOAD, fragment["file_id"], fragment["frag_idx"], expires
+            )
+        plan["expires"] = expires
+        return plan
+
+    def expire(self):
+        """Forget direct stores that were never committed and delete what their clients uploaded"""
+        now = time.time()
+        with self.__lock:
+            expired = [
+                (file_id, record)
+                for file_id, (expires, record) in self.__plans.items()
+                if expires + self.__ttl < now
+            ]
+            for file_id, _ in expired:
+                del self.__plans[file_id]
+        if not expired:
+            return
+        print(f"{len(expired)} direct stores were not committed, deleting their fragments")
+        self.__delete_fragments(fragment_copies(expired))
+
+    def clear(self):
+        with self.__lock:
+            self.__plans = {}
+
+    def __expire_loop(self, period):
+        """Expire uncommitted direct stores every period seconds, whether or not new ones are planned"""
+        while True:
+            time.sleep(period)
+            try:
+                self.expire()
+            except Exception as e:
+                print(f"Failed to expire direct stores: {e}")
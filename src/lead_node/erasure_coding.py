@@ -0,0 +1,104 @@
+import math
+
+import numpy as np
+
+REPLICATION = "replication"
+ERASURE_CODING = "erasure_coding"
+
+# GF(2^8) arithmetic with the primitive polynomial x^8 + x^4 + x^3 + x^2 + 1
+GF_EXP = np.zeros(512, dtype=np.uint8)
+GF_LOG = np.zeros(256, dtype=np.int32)
+_x = 1
+for _i in range(255):
+    GF_EXP[_i] = _x
+    GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11D
+GF_EXP[255:510] = GF_EXP[:255]
+
+# Full multiplication table, GF_MUL[a][b] = a * b, so multiplying a whole shard by a
+# coefficient is a single vectorized table lookup
+_logs = GF_LOG[1:, None] + GF_LOG[None, 1:]
+GF_MUL = np.zeros((256, 256), dtype=np.uint8)
+GF_MUL[1:, 1:] = GF_EXP[_logs]
+
+
+def gf_inv(a):
+    return int(GF_EXP[255 - GF_LOG[a]])
+
+
+def parity_matrix(k, m):
+    """Cauchy matrix whose rows define the m parity shards.
+
+    Together with the identity rows of the data shards any k rows are linearly
+    independent, so any k shards are enough to rebuild the data.
+    """
+    if k + m > 256:
+        raise ValueError("k + m must be at most 256")
+    return [[gf_inv((k + i) ^ j) for j in range(k)] for i in range(m)]
+
+
+def _invert(matrix):
+    """Invert a square matrix over GF(2^8) with Gauss-Jordan elimination"""
+    n = len(matrix)
+    rows = [list(row) + [1 if i == j else 0 for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next(r for r in range(col, n) if rows[r][col])
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        inv = gf_inv(rows[col][col])
+        rows[col] = [int(GF_MUL[inv][v]) for v in rows[col]]
+        for r in range(n):
+            if r != col and rows[r][col]:
+                factor = rows[r][col]
+                rows[r] = [v ^ int(GF_MUL[factor][p]) for v, p in zip(rows[r], rows[col])]
+    return [row[n:] for row in rows]
+
+
+def _combine(coefficients, shards):
+    """XOR-sum of coefficient * shard over GF(2^8)"""
+    out = np.zeros(len(shards[0]), dtype=np.uint8)
+    for coefficient, shard in zip(coefficients, shards):
+        if coefficient:
+            out ^= GF_MUL[coefficient][shard]
+    return out
+
+
+def split_into_shards(file_bytes, k):
+    """Split a file into k equally sized data shards, zero padding the last one"""
+    shard_size = math.ceil(len(file_bytes) / k) if file_bytes else 0
+    padded = np.zeros(shard_size * k, dtype=np.uint8)
+    padded[: len(file_bytes)] = np.frombuffer(file_bytes, dtype=np.uint8)
+    return [padded[i * shard_size : (i + 1) * shard_size] for i in range(k)]
+
+
+def encode(file_bytes, k, m):
+    """Return the k data shards followed by the m parity shards of a file"""
+    data = split_into_shards(file_bytes, k)
+    if not data[0].size:
+        return [b"" for _ in range(k + m)]
+    parity = [_combine(row, data) for row in parity_matrix(k, m)]
+    return [shard.tobytes() for shard in data + parity]
+
+
+def decode(shards, k, m):
+    """Rebuild the k data shards from any k of the k + m shards.
+
+    shards maps shard index to shard bytes.
+    """
+    if len(shards) < k:
+        raise ValueError(f"Need {k} shards to decode, got {len(shards)}")
+    if all(i in shards for i in range(k)):
+        return [shards[i] for i in range(k)]
+
+    indices = sorted(shards)[:k]
+    parity = parity_matrix(k, m)
+    generator = [
+        [1 if i == j else 0 for j in range(k)] if i < k else parity[i - k]
+        for i in indices
+    ]
+    decoder = _invert(generator)
+    available = [np.frombuffer(shards[i], dtype=np.uint8) for i in indices]
+    if not available[0].size:
+        return [b"" for _ in range(k)]
+    return [_combine(row, available).tobytes() for row in decoder]
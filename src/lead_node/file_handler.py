@@ -2,102 +2,1195 @@ import random
 import threading
 import math
 import time
+import queue
+from collections import Counter, deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from config import NO_FRAGMENTS, NODE_SELECTION_STRATEGY, NO_REPLICAS
+from config import STREAM_CHUNK_SIZE, STREAM_BUFFER_SIZE
+from config import PREFETCH_WINDOW, DOWNLOAD_WORKERS
+from config import UPLOAD_WORKERS, PER_NODE_UPLOAD_LIMIT, UPLOAD_QUEUE_LIMIT
+from config import STREAM_UPLOAD_WORKERS, UPLOAD_RETRIES, WRITE_QUORUM
+from config import BATCH_TRANSFERS, BATCH_MAX_BYTES
+from config import DEDUPLICATION
+from config import FRAGMENT_CACHE_BYTES, CACHE_WRITE_THROUGH
+from config import HEDGED_READS, HEDGE_PERCENTILE, HEDGE_MIN_DELAY, HEDGE_LATENCY_WINDOW
+from config import STORAGE_MODE, EC_DATA_FRAGMENTS, EC_PARITY_FRAGMENTS
+from config import METADATA_BACKEND, METADATA_PATH
+from config import METADATA_COMMIT_INTERVAL, METADATA_COMMIT_BATCH
+from config import MEMBERSHIP, MEMBERSHIP_RESYNC_INTERVAL, FAKE_STORAGE_NODES
+from config import AUTO_REPAIR, REPAIR_WORKERS, REPAIR_BYTES_PER_SECOND
+from config import LOAD_EWMA_ALPHA, LOAD_STATS_INTERVAL, LOAD_MIN_FREE_FRACTION
+from config import COMPRESSION, COMPRESSION_MIN_SIZE, COMPRESSION_WORKERS
+from config import FRAGMENT_TARGET_SIZE, MIN_FRAGMENTS, MAX_FRAGMENTS
+from config import TOKEN_SECRET, DIRECT_TOKEN_TTL
+from erasure_coding import REPLICATION, ERASURE_CODING
+import erasure_coding
+from metadata_store import create_metadata_store
+from fragment_index import FragmentIndex
+from dedup import Deduplicator
+from checksum import Checksum, checksum
+from compression import Compressor
+import compression
+from fragment_cache import FragmentCache
+from latency_tracker import LatencyTracker
+from upload_engine import UploadEngine
+from write_quorum import WriteQuorum
+from membership import create_membership
+from repair import RepairEngine, FragmentRepair
+from node_load import NodeLoad
 from node_selection import RandomSelection, MinCopySetsSelection, BuddySelection
+from node_selection import LoadAwareSelection, LOAD_AWARE_SELECTIONS
+from node_selection import RendezvousSelection
 from node_selection import RANDOM_SELECTION, MIN_COPY_SETS_SELECTION, BUDDY_SELECTION
+from node_selection import RENDEZVOUS_SELECTION
+from placement import PlacementEpochs
+from file_records import storage_key, pending_slots, is_compressed, required_fragments
+from file_records import fragment_copies
+from direct import DirectTransfers
 
 from storage_node_client import upload_fragment_to_node, download_fragment_from_node
+from storage_node_client import upload_fragment_stream_to_node
+from storage_node_client import open_node_pool, close_node_pool
+from storage_node_client import delete_fragment_from_node, get_node_stats
+from storage_node_client import upload_fragments_to_node, download_fragments_from_node
 
-from kubernetes import client, config
 
+class FileHandler:
+    """Handles file storage and retrieval"""
+
+    def __init__(self, metadata_store=None, membership=None):
+        if metadata_store is None:
+            metadata_store = create_metadata_store(
+                METADATA_BACKEND, METADATA_PATH, METADATA_COMMIT_INTERVAL, METADATA_COMMIT_BATCH
+            )
+        self.metadata = metadata_store
+        self.__epochs = PlacementEpochs(self.metadata)
+        # Nodes are marked live as membership reports them, until then every indexed fragment counts as missing
+        self.__fragment_index = FragmentIndex()
+        self.__dedup = Deduplicator(self.metadata)
+        self.__cache = FragmentCache(FRAGMENT_CACHE_BYTES)
+        self.__compressor = Compressor(COMPRESSION_WORKERS, COMPRESSION_MIN_SIZE)
+        self.node_selector = None
+        self.storage_nodes = []
+        self.__node_load = NodeLoad(LOAD_EWMA_ALPHA, LOAD_MIN_FREE_FRACTION)
+        self.__upload_engine = UploadEngine(
+            UPLOAD_WORKERS, PER_NODE_UPLOAD_LIMIT, UPLOAD_QUEUE_LIMIT, STREAM_UPLOAD_WORKERS,
+            self.__node_load,
+        )
+        self.__download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+        # Hedged reads race replicas on their own pool so fragment downloads never wait on each other
+        self.__request_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+        self.__download_latency = LatencyTracker(HEDGE_LATENCY_WINDOW)
+        self.__hedge_lock = threading.Lock()
+        self.hedges_issued = 0
+        self.hedges_won = 0
+        self.__checksum_lock = threading.Lock()
+        self.checksum_mismatches = 0
+        # Repairs, deletes and write confirmations change a file's record after reading it, so they take turns
+        self.__repair_lock = threading.Lock()
+        # Files whose pending replicas are still being uploaded in the background
+        self.__writes_in_flight = set()
+        self.__direct = DirectTransfers(
+            TOKEN_SECRET, DIRECT_TOKEN_TTL, self.__record_direct, self.__delete_fragments
+        )
+        self.__fragment_repair = FragmentRepair(
+            self.__get_record, self.__put_record, self.__repair_lock, self.__writes_in_flight,
+            self.__fetch_fragment, self.__delete_fragments, self.__dedup, self.__upload_engine,
+            self.__download_executor,
+        )
+        self.__repair = RepairEngine(self.__repair_fragment, REPAIR_WORKERS, REPAIR_BYTES_PER_SECOND)
+        if membership is None:
+            membership = create_membership(
+                MEMBERSHIP, "default", "app=storage-node", MEMBERSHIP_RESYNC_INTERVAL, FAKE_STORAGE_NODES
+            )
+        self.membership = membership
+        self.membership.start(self.__nodes_changed)
+        # Stored files are indexed in the background, so startup does not wait for a pass over the metadata
+        threading.Thread(target=self.__load_fragment_index, daemon=True).start()
+        threading.Thread(
+            target=self.__poll_node_stats, daemon=True, args=(LOAD_STATS_INTERVAL,)
+        ).start()
 
-# Configure access to the Kubernetes cluster
-config.load_incluster_config()  # Use this if running inside the cluster
-# config.load_kube_config()  # Use this for local testing with kubeconfig
+    def store_file(self, file_bytes, codec=None):
+        """ "Store a file and return its file_id.
 
-# Create an API client for CoreV1
-v1 = client.CoreV1Api()
+        codec overrides the COMPRESSION codec for this file, "none" stores it uncompressed.
+        """
 
-# Global State (in-memory for demo) should be stored persistently in a real system
-file_metadata = {}
+        placed, (file_id,) = self.place_files([file_bytes], codec)
+        if file_id is None:
+            return None
 
+        # Upload fragments to nodes
+        if self.__store_placed(placed):
+            print(f"Failed to store file_id={file_id}, not recording metadata")
+            return None
+        return file_id
 
-class FileHandler:
-    """Handles file storage and retrieval"""
+    def store_files(self, files, codec=None):
+        """Store a list of files and return their file_ids, None for files that failed.
 
-    def __init__(self):
-        self.node_selector = None
-        self.storage_nodes = []
-        # self.__setup_node_strategy()
-        self.__node_monitor_thread = threading.Thread(
-            target=self.__monitor_storage_nodes, daemon=True, kwargs={"period": 5}
+        Fragments of all files that go to the same storage node are uploaded together.
+        """
+        placed, file_ids = self.place_files(files, codec)
+        failed = self.__store_placed(placed) if placed else set()
+        failed.update(file_id for file_id in file_ids if file_id is None)
+        if failed:
+            print(f"Failed to store {len(failed)} of {len(files)} files, not recording their metadata")
+        return [None if file_id in failed else file_id for file_id in file_ids]
+
+    def place_files(self, files, codec=None):
+        """Split, compress and place a list of files without uploading them.
+
+        Returns a dict of file_id -> (fragments, record) and the file_ids in the
+        order of files, None for files that could not be placed.
+        """
+        placed = {}
+        file_ids = []
+        for file_bytes in files:
+            file_id = self.__new_file_id(reserved=placed)
+            try:
+                placed[file_id] = self.__place_file(file_id, file_bytes, codec)
+            except ValueError as e:
+                print(f"Failed to place file_id={file_id}: {e}")
+                file_id = None
+            file_ids.append(file_id)
+        return placed, file_ids
+
+    def records_after_upload(self):
+        """Whether a store uploads every copy of its files and then records them.
+
+        Deduplicated and write quorum stores decide what to upload and record as
+        their uploads finish, so only FileHandler itself runs them.
+        """
+        return not DEDUPLICATION and self.__write_quorum(STORAGE_MODE) is None
+
+    def upload_batches(self, placed):
+        """The uploads of placed files as a list of (node, [(file_id, frag_idx, fragment, checksum), ...])"""
+        files = self.__upload_jobs(placed)
+        return [
+            (node, [(file_id, frag_idx, files[file_id][0][frag_idx], files[file_id][1][frag_idx])
+                    for file_id, frag_idx in batch])
+            for node, keys in self.__uploads_by_node(files).values()
+            for batch in self.__pack_batches(files, sorted(keys))
+        ]
+
+    def record_uploaded(self, placed, failed):
+        """Record the placed files that were uploaded by the caller, except the failed ones.
+
+        Returns the ids of the files that are not stored.
+        """
+        try:
+            self.__record_written(placed, failed)
+        except IOError as e:
+            print(f"Failed to record {len(placed)} files: {e}")
+            return set(placed)
+        self.__cache_stored(placed, failed)
+        return set(failed)
+
+    def __store_placed(self, placed):
+        """Upload placed files, a dict of file_id -> (fragments, record), and record the ones written.
+
+        Returns the ids of the files that failed.
+        """
+        quorum = self.__write_quorum(STORAGE_MODE)
+        try:
+            if DEDUPLICATION:
+                failed = self.__dedup.store(
+                    placed, {node["name"] for node in self.storage_nodes},
+                    self.__upload_files, self.__record_files,
+                )
+            elif quorum is not None:
+                failed = self.__store_with_quorum(placed, quorum)
+            else:
+                failed = self.__upload_files(self.__upload_jobs(placed))
+                self.__record_written(placed, failed)
+        except IOError as e:
+            # The metadata of the files could not be committed, so none of them is stored
+            print(f"Failed to record {len(placed)} files: {e}")
+            return set(placed)
+
+        self.__cache_stored(placed, failed)
+        return failed
+
+    def __cache_stored(self, placed, failed):
+        if CACHE_WRITE_THROUGH:
+            # Files are often read right after they are stored
+            for file_id, (fragments, record) in placed.items():
+                if file_id not in failed:
+                    for frag_idx, fragment in enumerate(fragments):
+                        # The cache holds fragments as they are read, compressed ones are left to the first read
+                        if not is_compressed(record, frag_idx):
+                            self.__cache.put((file_id, frag_idx), fragment)
+
+    @staticmethod
+    def __upload_jobs(placed):
+        """The files argument of __upload_files for placed files"""
+        return {
+            file_id: (fragments, record["checksums"], record["assigned_nodes"])
+            for file_id, (fragments, record) in placed.items()
+        }
+
+    def __record_written(self, placed, failed):
+        """Record the placed files that were fully written, all but the failed ones.
+
+        Raises IOError, after deleting their uploaded fragments, if the metadata cannot be committed.
+        """
+        written = [(file_id, record) for file_id, (_, record) in placed.items() if file_id not in failed]
+        try:
+            self.__record_files(written)
+        except IOError:
+            self.__delete_fragments(fragment_copies(written))
+            raise
+
+    @staticmethod
+    def __write_quorum(storage_mode):
+        """Replicas of each fragment a store waits for, None to wait for all of them.
+
+        Erasure coded stripes are always written in full.
+        """
+        if storage_mode != REPLICATION or not 0 < WRITE_QUORUM < NO_REPLICAS:
+            return None
+        return WRITE_QUORUM
+
+    def __store_with_quorum(self, placed, quorum):
+        """Upload placed files and record them once quorum replicas of every fragment are written.
+
+        The other replicas are recorded as pending and confirmed in the background.
+        Returns the ids of the files that did not reach quorum.
+        """
+        files = self.__upload_jobs(placed)
+        tracker = WriteQuorum(
+            {file_id: record["assigned_nodes"] for file_id, (_, record) in placed.items()}, quorum
+        )
+        recorded = self.__start_background_writes(
+            tracker, list(placed), lambda: self.__upload_files(files, tracker.ack)
         )
-        self.__ticker = threading.Event()
-        self.__node_monitor_thread.start()
+        try:
+            written = tracker.wait()
+            self.__record_files(self.__with_pending(placed, tracker))
+        finally:
+            recorded.set()
+        return set(placed) - written
+
+    @staticmethod
+    def __with_pending(placed, tracker):
+        """The (file_id, record) pairs of files that reached quorum, noting their pending replicas"""
+        records = []
+        for file_id, (_, record) in placed.items():
+            if file_id not in tracker.written():
+                continue
+            pending = tracker.pending(file_id)
+            if pending:
+                record["pending"] = pending
+            records.append((file_id, record))
+        return records
+
+    def __start_background_writes(self, tracker, file_ids, upload):
+        """Run upload() in the background and confirm the pending replicas once it is over.
+
+        Confirmation waits for the returned event, which is set once the files are recorded.
+        """
+        recorded = threading.Event()
+        with self.__repair_lock:
+            self.__writes_in_flight.update(file_ids)
+
+        def run():
+            try:
+                upload()
+            finally:
+                tracker.finish()
+                recorded.wait()
+                self.__confirm_writes(tracker, file_ids)
+
+        threading.Thread(target=run, daemon=True).start()
+        return recorded
 
-    def store_file(self, file_bytes):
-        """ "Store a file and return its file_id"""
+    def __confirm_writes(self, tracker, file_ids):
+        """Clear the pending replicas that were written after their files were recorded.
 
-        # Generate a unique file_id not in file_metadata
-        file_id = "file_" + str(random.randint(1000, 9999))
-        while file_id in file_metadata:
-            file_id = "file_" + str(random.randint(1000, 9999))
+        Replicas whose upload failed stay pending and are queued for repair. Files that
+        are not recorded, because they fell short of quorum or were deleted, have
+        their fragments deleted.
+        """
+        repairs, orphaned = [], {}
+        with self.__repair_lock:
+            for file_id in file_ids:
+                self.__writes_in_flight.discard(file_id)
+                record = self.__get_record(file_id) if file_id in tracker.written() else None
+                if record is None:
+                    # Short of quorum, or deleted while replicas were still being written
+                    for replica in tracker.assigned_nodes(file_id):
+                        for frag_idx, node in enumerate(replica):
+                            orphaned[(node["name"], file_id, frag_idx)] = node
+                    continue
+                if "pending" not in record:
+                    continue
+                unwritten = {tuple(slot) for slot in tracker.pending(file_id)}
+                pending = [slot for slot in record["pending"] if tuple(slot) in unwritten]
+                if pending == record["pending"]:
+                    continue
+                if pending:
+                    record["pending"] = pending
+                else:
+                    del record["pending"]
+                self.__put_record(file_id, record)
+            for file_id in file_ids:
+                record = self.__get_record(file_id) if file_id in tracker.written() else None
+                if record is not None:
+                    repairs.extend(self.__pending_repairs(file_id, record))
+        if orphaned:
+            self.__delete_fragments(orphaned)
+        self.__enqueue_pending_repairs(repairs)
+
+    @staticmethod
+    def __pending_repairs(file_id, record):
+        """The (surviving copies, file_id, frag_idx) repairs of the pending replicas of a record"""
+        missing = Counter(frag_idx for _, frag_idx in record.get("pending", ()))
+        return [
+            (len(record["assigned_nodes"]) - count, file_id, frag_idx)
+            for frag_idx, count in missing.items()
+        ]
+
+    def __enqueue_pending_repairs(self, repairs):
+        if repairs and AUTO_REPAIR:
+            print(f"{len(repairs)} replicas could not be written, queueing them for repair")
+            self.__repair.enqueue(repairs)
+
+    def __place_file(self, file_id, file_bytes, codec=None):
+        """Split a file into fragments and choose their nodes, return the fragments and the file's record.
+
+        The returned fragments are the bytes to store, compressed where that made them smaller.
+        """
+        codec = self.__codec(codec)
+        if STORAGE_MODE == ERASURE_CODING:
+            k, m = EC_DATA_FRAGMENTS, EC_PARITY_FRAGMENTS
+            fragments = erasure_coding.encode(file_bytes, k, m)
+            print(f"Storing file_id={file_id}, total size={len(file_bytes)} bytes as {k}+{m} erasure coded fragments")
+            stored, compressed = self.__compress(codec, fragments)
+
+            # The selector places one stripe of k + m fragments like the replicas of one fragment
+            assigned_nodes = [[replica[0] for replica in self.__choose_nodes(file_id, 1)]]
+            print(f"Assigned nodes for {file_id}:", assigned_nodes)
+            return stored, self.__note_placement({
+                "storage_mode": ERASURE_CODING,
+                "assigned_nodes": assigned_nodes,
+                "size": len(file_bytes),
+                "no_fragments": k + m,
+                "fragment_sizes": [len(fragment) for fragment in fragments],
+                "checksums": [checksum(fragment) for fragment in stored],
+                "ec": {"k": k, "m": m},
+                **compressed,
+            })
 
         # Split into fragments
-        base_fragment_size = math.floor(len(file_bytes) / NO_FRAGMENTS)
-        remainder = len(file_bytes) % NO_FRAGMENTS
         fragments = []
         start = 0
-        for i in range(NO_FRAGMENTS):
-            end = start + base_fragment_size + (1 if i < remainder else 0)
-            fragments.append(file_bytes[start:end])
-            start = end
+        for size in self.__fragment_sizes(len(file_bytes)):
+            fragments.append(file_bytes[start : start + size])
+            start += size
 
         print(f"Storing file_id={file_id}, total size={len(file_bytes)} bytes")
         print("Fragments sizes:", [len(f) for f in fragments])
+        stored, compressed = self.__compress(codec, fragments)
 
         # Choose nodes for each fragment
-        assigned_nodes = self.node_selector.choose_nodes()
+        assigned_nodes = self.__choose_nodes(file_id, len(fragments))
         print(f"Assigned nodes for {file_id}:", assigned_nodes)
+        return stored, self.__note_placement({
+            "storage_mode": REPLICATION,
+            "assigned_nodes": assigned_nodes,
+            "size": len(file_bytes),
+            "no_fragments": len(fragments),
+            "fragment_sizes": [len(fragment) for fragment in fragments],
+            "checksums": [checksum(fragment) for fragment in stored],
+            **compressed,
+        })
 
-        # Upload fragments to nodes
-        self.__upload_fragments(file_id, fragments, assigned_nodes)
+    @staticmethod
+    def __codec(codec):
+        """The codec a store compresses with, None to store fragments as they are"""
+        if codec is None:
+            codec = COMPRESSION
+        return None if codec in (None, "none") else codec
+
+    def __compress(self, codec, fragments):
+        """Compress fragments with codec, return the fragments to store and the record fields describing them"""
+        if codec is None:
+            return fragments, {}
+        stored, flags = self.__compressor.compress_fragments(codec, fragments)
+        if not any(flags):
+            return fragments, {}
+        print(f"Compressed {sum(flags)} of {len(fragments)} fragments with {codec}")
+        return stored, {"compression": {"codec": codec, "fragments": flags}}
+
+    def __decompressed(self, frag, record, frag_idx):
+        """Return a stored fragment as it was before compression"""
+        if frag is None or not is_compressed(record, frag_idx):
+            return frag
+        return compression.decompress(record["compression"]["codec"], frag)
+
+    def __choose_nodes(self, file_id, no_fragments):
+        """The [replica][fragment] nodes of a new file, raising ValueError if there are not enough nodes"""
+        node_selector = self.node_selector
+        if node_selector is None:
+            raise ValueError("No node selection strategy, the storage nodes could not be set up")
+        return node_selector.choose_nodes(file_id, no_fragments)
+
+    def __note_placement(self, record):
+        """Mark a record placed by rendezvous hashing, so its nodes are not stored with it"""
+        if isinstance(self.node_selector, RendezvousSelection):
+            record["epoch"] = self.__epochs.current
+            if record["storage_mode"] == REPLICATION:
+                record["replicas"] = len(record["assigned_nodes"])
+        return record
+
+    def __get_record(self, file_id):
+        """Return the record of file_id with its nodes, None if it is unknown"""
+        return self.__epochs.resolve(file_id, self.metadata.get(file_id))
+
+    def __stored_record(self, file_id, record):
+        """(file_id, record as it is stored) for metadata.put"""
+        return file_id, self.__epochs.compact(file_id, record)
+
+    def __put_record(self, file_id, record):
+        """Write the metadata of a file that is already stored and index its fragments again"""
+        self.metadata.put(*self.__stored_record(file_id, record))
+        self.__fragment_index.add_file(file_id, record, required_fragments(record))
+
+    def __record_files(self, records):
+        """Write the metadata of a list of (file_id, record) pairs and index their fragments"""
+        self.metadata.put_many(
+            [self.__stored_record(file_id, record) for file_id, record in records]
+        )
+        for file_id, record in records:
+            self.__fragment_index.add_file(file_id, record, required_fragments(record))
+
+    def delete_file(self, file_id):
+        """Delete a file's metadata and, best effort, its fragments on the storage nodes"""
+        with self.__repair_lock:
+            record = self.__get_record(file_id)
+            if not record:
+                return {"message": f"No metadata found for file_id={file_id}"}
+            self.metadata.delete(file_id)
+        self.__fragment_index.remove_file(file_id)
+        self.__cache.invalidate(file_id, record["no_fragments"])
 
-        file_metadata[file_id] = assigned_nodes
+        if "fragment_keys" in record:
+            deleted = self.__dedup.release(record, self.__delete_fragments)
+        else:
+            deleted = self.__delete_fragments(fragment_copies([(file_id, record)]))
+        print(f"Deleted file_id={file_id}, removed {deleted} fragment copies")
+        return {"message": f"Deleted file_id={file_id}", "fragments_deleted": deleted}
+
+    def __delete_fragments(self, fragments):
+        """Delete fragments, a dict of (node name, file_id, frag_idx) -> node, from live nodes.
+
+        Returns the number of deleted copies.
+        """
+        live_nodes = {node["name"] for node in self.storage_nodes}
+        futures = [
+            self.__request_executor.submit(
+                delete_fragment_from_node, node, node["ip"], file_id, frag_idx
+            )
+            for (name, file_id, frag_idx), node in fragments.items()
+            if name in live_nodes
+        ]
+        return sum(1 for future in futures if future.result())
+
+    def store_file_stream(self, stream, content_length, codec=None):
+        """Store a file read in chunks from stream and return its file_id.
+
+        Replica uploads of a fragment start as soon as its first chunk is read.
+        Their queues are bounded so at most STREAM_BUFFER_SIZE bytes are buffered.
+        Returns None if the stream ends early or a replica upload fails.
+        """
+        if not self.streams(codec):
+            file_bytes = stream.read(content_length)
+            if len(file_bytes) != content_length:
+                print(f"Upload ended before {content_length} bytes")
+                return None
+            return self.store_file(file_bytes, codec)
+
+        try:
+            file_id, record = self.place_stream(content_length)
+        except ValueError as e:
+            print(f"Failed to place a streamed file: {e}")
+            return None
+        assigned_nodes = record["assigned_nodes"]
+        fragment_sizes = record["fragment_sizes"]
+
+        queue_size = self.stream_queue_size(record)
+        futures = []
+        checksums = []
+        complete = True
+        for frag_idx, fragment_size in enumerate(fragment_sizes):
+            queues = [queue.Queue(maxsize=queue_size) for _ in range(NO_REPLICAS)]
+            uploads = [
+                (
+                    self.__stream_upload,
+                    (assigned_nodes[replica_idx][frag_idx], file_id, frag_idx, queues[replica_idx]),
+                )
+                for replica_idx in range(NO_REPLICAS)
+            ]
+            fragment_futures = self.__upload_engine.submit_streams(uploads)
+            futures.extend(
+                (frag_idx, assigned_nodes[replica_idx][frag_idx], future)
+                for replica_idx, future in enumerate(fragment_futures)
+            )
+            pipes = list(zip(queues, fragment_futures))
+
+            running = Checksum()
+            remaining = fragment_size
+            while remaining > 0:
+                chunk = stream.read(min(STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    complete = False
+                    break
+                remaining -= len(chunk)
+                running.update(chunk)
+                self.__feed_pipes(pipes, chunk)
+            self.__feed_pipes(pipes, None)
+            checksums.append(running.hexdigest())
+            if not complete:
+                break
+
+        record["checksums"] = checksums
+        quorum = self.__write_quorum(REPLICATION)
+        if complete and quorum is not None:
+            return self.__finish_stream_with_quorum(file_id, record, futures, quorum)
+
+        # Every replica reports the checksum of what it stored, which must match what was read
+        results = [(frag_idx, node, future.result()) for frag_idx, node, future in futures]
+
+        if not complete:
+            print(f"Upload of file_id={file_id} ended before {content_length} bytes")
+        elif any(result != checksums[frag_idx] for frag_idx, _, result in results):
+            print(f"Failed to store file_id={file_id}, not recording metadata")
+        else:
+            return self.record_streamed(file_id, record)
+        self.abandon_stream(file_id, results)
+        return None
+
+    def streams(self, codec=None):
+        """Whether a store with codec streams its fragments to the nodes as the file is read.
+
+        Parity, content addresses and compression that must shrink need whole fragments,
+        so those files are buffered and stored with store_file.
+        """
+        return STORAGE_MODE != ERASURE_CODING and not DEDUPLICATION and self.__codec(codec) is None
+
+    def place_stream(self, content_length):
+        """Place a streamed file of content_length bytes, return its file_id and record.
+
+        The record has no checksums until the file is read. Raises ValueError if
+        there are not enough nodes.
+        """
+        file_id = self.__new_file_id()
+        fragment_sizes = self.__fragment_sizes(content_length)
+        print(f"Streaming file_id={file_id}, total size={content_length} bytes")
+        print("Fragments sizes:", fragment_sizes)
+        assigned_nodes = self.__choose_nodes(file_id, len(fragment_sizes))
+        print(f"Assigned nodes for {file_id}:", assigned_nodes)
+        return file_id, self.__note_placement({
+            "storage_mode": REPLICATION,
+            "assigned_nodes": assigned_nodes,
+            "size": content_length,
+            "no_fragments": len(fragment_sizes),
+            "fragment_sizes": fragment_sizes,
+        })
+
+    @staticmethod
+    def stream_queue_size(record):
+        """Chunks buffered per replica upload, so a streamed file holds at most STREAM_BUFFER_SIZE bytes"""
+        return max(
+            1,
+            STREAM_BUFFER_SIZE
+            // (STREAM_CHUNK_SIZE * len(record["assigned_nodes"]) * len(record["fragment_sizes"])),
+        )
+
+    def record_streamed(self, file_id, record):
+        """Record a streamed file whose replicas all hold its checksummed fragments.
+
+        Returns file_id, or None after deleting the fragments if the record cannot be committed.
+        """
+        try:
+            self.__record_files([(file_id, record)])
+        except IOError as e:
+            print(f"Failed to record file_id={file_id}, deleting its fragments: {e}")
+            self.__delete_fragments(fragment_copies([(file_id, record)]))
+            return None
         return file_id
 
+    def abandon_stream(self, file_id, results):
+        """Delete the fragments of a streamed file that is not recorded.
+
+        results is a list of (frag_idx, node, checksum) for every replica upload that
+        was started, with a None checksum for uploads that stored nothing.
+        """
+        written = {
+            (node["name"], file_id, frag_idx): node
+            for frag_idx, node, result in results
+            if result is not None
+        }
+        if written:
+            print(f"Deleting {len(written)} fragment copies of file_id={file_id}")
+            self.__delete_fragments(written)
+
+    def __finish_stream_with_quorum(self, file_id, record, futures, quorum):
+        """Record a streamed file once quorum replicas of every fragment hold the right bytes.
+
+        futures is a list of (frag_idx, node, future) for every replica upload.
+        """
+        tracker = WriteQuorum({file_id: record["assigned_nodes"]}, quorum)
+        for frag_idx, node, future in futures:
+            future.add_done_callback(
+                partial(self.__acknowledge_stream, tracker, node["name"], file_id, frag_idx,
+                        record["checksums"][frag_idx])
+            )
+        recorded = self.__start_background_writes(
+            tracker, [file_id], lambda: wait([future for _, _, future in futures])
+        )
+        try:
+            if file_id not in tracker.wait():
+                print(f"Failed to store file_id={file_id}, not recording metadata")
+                return None
+            # Unless it is recorded, the fragments are deleted once the background writes are over
+            self.__record_files(self.__with_pending({file_id: (None, record)}, tracker))
+            return file_id
+        except IOError as e:
+            print(f"Failed to record file_id={file_id}: {e}")
+            return None
+        finally:
+            recorded.set()
+
+    @staticmethod
+    def __acknowledge_stream(tracker, name, file_id, frag_idx, expected, future):
+        # A streamed replica is written once the node reports the checksum that was read
+        if future.result() == expected:
+            tracker.ack(name, [(file_id, frag_idx)])
+
+    def plan_store(self, size):
+        """Place a file of size bytes whose client uploads the fragments to the storage nodes itself.
+
+        Returns the file_id, fragment sizes, assigned nodes and an upload token per fragment.
+        The file is recorded once commit_store confirms its fragments are written.
+        """
+        if not self.__direct.enabled():
+            return {"message": "Direct transfers are disabled, no TOKEN_SECRET is set"}
+        if STORAGE_MODE == ERASURE_CODING or DEDUPLICATION or COMPRESSION is not None:
+            # Parity, content addresses and compression are made by the lead node
+            return {"message": "Direct stores need replication without deduplication or compression, use /store"}
+        fragment_sizes = self.__fragment_sizes(size)
+        return self.__direct.plan_store(
+            self.__new_file_id,
+            lambda file_id: self.__note_placement({
+                "storage_mode": REPLICATION,
+                "assigned_nodes": self.__choose_nodes(file_id, len(fragment_sizes)),
+                "size": size,
+                "no_fragments": len(fragment_sizes),
+                "fragment_sizes": fragment_sizes,
+            }),
+        )
+
+    def commit_store(self, file_id, checksums, failed=()):
+        """Record a file planned by plan_store once its client uploaded the fragments.
+
+        failed lists the [replica_idx, frag_idx] slots the client could not write. They are
+        recorded as pending and repaired, as long as every fragment has the replicas a
+        store waits for.
+        """
+        return self.__direct.commit_store(file_id, checksums, failed, self.__write_quorum(REPLICATION))
+
+    def __record_direct(self, file_id, record):
+        self.__record_files([(file_id, record)])
+        self.__enqueue_pending_repairs(self.__pending_repairs(file_id, record))
+
+    def plan_retrieve(self, file_id):
+        """Return the nodes and a download token of every fragment of a file for its client to fetch.
+
+        Fragments are listed in order with their storage key, checksum, whether they are
+        compressed, and the live nodes holding confirmed copies.
+        """
+        if not self.__direct.enabled():
+            return {"message": "Direct transfers are disabled, no TOKEN_SECRET is set"}
+        record = self.__get_record(file_id)
+        if not record:
+            return {"message": f"No metadata found for file_id={file_id}"}
+        if record["storage_mode"] == ERASURE_CODING:
+            return {"message": "Erasure coded files are decoded by the lead node, use /retrieve"}
+        return self.__direct.plan_retrieve(self.__fragment_sources(file_id, record))
+
+    def retrieve_sources(self, file_id):
+        """Return where to download each fragment of a replicated file, for servers that fetch them themselves.
+
+        Lists the fragments as plan_retrieve does, with the decompressed fragment
+        under "cached" if the cache has it. None if the file is unknown or erasure coded.
+        """
+        record = self.__get_record(file_id)
+        if not record or record["storage_mode"] == ERASURE_CODING:
+            return None
+        sources = self.__fragment_sources(file_id, record)
+        for frag_idx, fragment in enumerate(sources["fragments"]):
+            fragment["cached"] = self.__cache.get((file_id, frag_idx))
+        return sources
+
+    def accept_fragment(self, sources, frag_idx, frag, node=None):
+        """Return a fragment downloaded from sources as it was stored, None if it does not match its checksum.
+
+        Accepted fragments are decompressed and cached.
+        """
+        fragment = sources["fragments"][frag_idx]
+        if fragment["checksum"] is not None and checksum(frag) != fragment["checksum"]:
+            print(f"Checksum mismatch for fragment {frag_idx} of {fragment['file_id']} from {node}")
+            with self.__checksum_lock:
+                self.checksum_mismatches += 1
+            return None
+        if fragment["compressed"]:
+            frag = compression.decompress(sources["codec"], frag)
+        self.__cache.put((sources["file_id"], frag_idx), frag)
+        return frag
+
+    def __fragment_sources(self, file_id, record):
+        """The storage key, checksum, compression and live nodes of every fragment of a replicated file"""
+        fragments = []
+        for frag_idx, size in enumerate(self.__data_fragment_sizes(record)):
+            key = storage_key(file_id, frag_idx, record)
+            fragments.append({
+                "file_id": key[0],
+                "frag_idx": key[1],
+                "size": size,
+                "checksum": record["checksums"][frag_idx] if "checksums" in record else None,
+                "compressed": bool(is_compressed(record, frag_idx)),
+                "nodes": self.__live_replicas(frag_idx, record),
+            })
+        return {
+            "file_id": file_id,
+            "size": record["size"],
+            "codec": record["compression"]["codec"] if "compression" in record else None,
+            "fragments": fragments,
+        }
+
     def retrieve_file(self, file_id):
         """Retrieve a file given its file_id"""
-        assigned_nodes = file_metadata.get(file_id)
-        if not assigned_nodes:
+        try:
+            # Fetch every fragment concurrently, the latency is that of the slowest fragment
+            reassembled = b"".join(self.retrieve_file_stream(file_id, window=None))
+        except IOError as e:
+            print(e)
+            return b""  # Return empty bytes if any fragment is missing
+
+        # Check final file size after reassembly
+        print(f"Reassembled file_id={file_id} with total length={len(reassembled)}")
+        return reassembled
+
+    def retrieve_file_stream(self, file_id, window=PREFETCH_WINDOW):
+        """Yield the fragments of a file in order, downloading up to window fragments ahead.
+
+        A window of None downloads all fragments at once.
+        Raises IOError when a fragment cannot be found on any replica.
+        """
+        record = self.__get_record(file_id)
+        if not record:
             print(f"No metadata found for file_id={file_id}")
-            return b""
+            return
 
+        assigned_nodes = record["assigned_nodes"]
         print(f"Retrieving file_id={file_id}, assigned_nodes:", assigned_nodes)
-        fragments = [None for _ in range(NO_FRAGMENTS)]
-        for frag_idx in range(NO_FRAGMENTS):
-            fragment_found = False
-            for nodes_list in assigned_nodes:  # Check each replica for the fragment
-                node = nodes_list[frag_idx]
-                # TODO: Check that node is in storage_nodes
-                frag = download_fragment_from_node(node, node["ip"], file_id, frag_idx)
-                if frag:
-                    print(
-                        f"Retrieved fragment {frag_idx} from {node}, length={len(frag)}"
+        if record["storage_mode"] == ERASURE_CODING:
+            yield from self.__retrieve_erasure_coded(file_id, record)
+            return
+
+        no_fragments = record["no_fragments"]
+        if window is None:
+            window = no_fragments
+        if BATCH_TRANSFERS and window >= no_fragments and record["size"] <= BATCH_MAX_BYTES:
+            fragments = self.__download_fragments_batched(file_id, record)
+            for frag_idx, frag in enumerate(fragments):
+                if frag is None:
+                    raise IOError(f"Fragment {frag_idx} not found for file_id={file_id}")
+                yield frag
+            return
+
+        downloads = [
+            (frag_idx, partial(self.__download_fragment, file_id, frag_idx, record))
+            for frag_idx in range(no_fragments)
+        ]
+        yield from self.__ordered_downloads(file_id, downloads, window)
+
+    def file_size(self, file_id):
+        """Size in bytes of a stored file, None if it is unknown"""
+        record = self.__get_record(file_id)
+        return record["size"] if record else None
+
+    def retrieve_range_stream(self, file_id, start, stop, window=PREFETCH_WINDOW):
+        """Yield bytes start up to stop of a file in order.
+
+        Only the fragments holding the range are downloaded, and of those at the
+        edges of the range only the bytes that are needed.
+        Raises IOError when part of the range cannot be found on any replica.
+        """
+        record = self.__get_record(file_id)
+        if not record:
+            print(f"No metadata found for file_id={file_id}")
+            return
+        print(f"Retrieving bytes {start}-{stop - 1} of file_id={file_id}")
+
+        downloads = []
+        offset = 0
+        for frag_idx, size in enumerate(self.__data_fragment_sizes(record)):
+            lo, hi = max(start, offset), min(stop, offset + size)
+            if lo < hi:
+                downloads.append(
+                    (
+                        frag_idx,
+                        partial(
+                            self.__download_fragment_range,
+                            file_id, frag_idx, record, lo - offset, hi - offset, size,
+                        ),
                     )
-                    fragments[frag_idx] = frag
-                    fragment_found = True
+                )
+            offset += size
+
+        sent = 0
+        try:
+            for piece in self.__ordered_downloads(file_id, downloads, window):
+                yield piece
+                sent += len(piece)
+        except IOError:
+            if record["storage_mode"] != ERASURE_CODING:
+                raise
+            # A data fragment is missing, rebuild the file from parity and send the rest
+            print(f"Range of {file_id} is incomplete, decoding from parity")
+            data = b"".join(self.__retrieve_erasure_coded(file_id, record))
+            yield data[start + sent : stop]
+
+    def __ordered_downloads(self, file_id, downloads, window):
+        """Run a list of (frag_idx, download) calls up to window at a time and yield their results in order"""
+        pending = deque()
+        next_idx = 0
+        try:
+            while next_idx < len(downloads) or pending:
+                while next_idx < len(downloads) and len(pending) < max(1, window):
+                    pending.append(
+                        (downloads[next_idx][0], self.__download_executor.submit(downloads[next_idx][1]))
+                    )
+                    next_idx += 1
+                frag_idx, future = pending.popleft()
+                frag = future.result()
+                if frag is None:
+                    raise IOError(f"Fragment {frag_idx} not found for file_id={file_id}")
+                yield frag
+        finally:
+            # Stop prefetching if the client went away or a fragment was missing
+            for _, future in pending:
+                future.cancel()
+
+    @staticmethod
+    def __data_fragment_sizes(record):
+        """Sizes of the consecutive pieces of the file held by its data fragments"""
+        if record["storage_mode"] == ERASURE_CODING:
+            k = record["ec"]["k"]
+            shard_size = math.ceil(record["size"] / k) if record["size"] else 0
+            return [min(shard_size, max(0, record["size"] - i * shard_size)) for i in range(k)]
+        if "fragment_sizes" in record:
+            return record["fragment_sizes"]
+        # Files stored before sizes were recorded were split evenly
+        no_fragments = record["no_fragments"]
+        return [
+            record["size"] // no_fragments + (1 if i < record["size"] % no_fragments else 0)
+            for i in range(no_fragments)
+        ]
+
+    def __download_fragment_range(self, file_id, frag_idx, record, lo, hi, size):
+        """Return bytes lo up to hi of a fragment of size bytes, None if no replica has them.
+
+        Partial reads cannot be checked against the fragment checksum, which covers the whole fragment.
+        """
+        if (lo == 0 and hi == size) or is_compressed(record, frag_idx):
+            # A compressed fragment has to be read whole to get at any of its bytes
+            frag = self.__download_fragment(file_id, frag_idx, record)
+            return frag[lo:hi] if frag is not None else None
+        cached = self.__cache.get((file_id, frag_idx))
+        if cached is not None:
+            return cached[lo:hi]
+        key = storage_key(file_id, frag_idx, record)
+        for node in self.__live_replicas(frag_idx, record):
+            frag = download_fragment_from_node(
+                node, node["ip"], key[0], key[1], byte_range=(lo, hi - 1)
+            )
+            if frag is not None and len(frag) == hi - lo:
+                return frag
+        return None
+
+    def __download_fragments_batched(self, file_id, record):
+        """Return all fragments of a small file, downloading the uncached ones in batches"""
+        return self.__cache.get_or_load_many(
+            [(file_id, frag_idx) for frag_idx in range(record["no_fragments"])],
+            lambda missing: {
+                key: self.__decompressed(frag, record, key[1])
+                for key, frag in self.__fetch_fragments_batched(
+                    file_id, record, [frag_idx for _, frag_idx in missing]
+                ).items()
+            },
+        )
+
+    def __fetch_fragments_batched(self, file_id, record, frag_indices):
+        """Download fragments of a file with one request per storage node.
+
+        Fragments a batch did not return are fetched again with per-fragment failover.
+        Returns a dict of (file_id, frag_idx) -> fragment, None for missing ones.
+        """
+        live_nodes = {node["name"] for node in self.storage_nodes}
+        pending = pending_slots(record)
+        keys = {frag_idx: storage_key(file_id, frag_idx, record) for frag_idx in frag_indices}
+        batches = {}
+        for frag_idx, key in keys.items():
+            for replica_idx, nodes_list in enumerate(record["assigned_nodes"]):
+                node = nodes_list[frag_idx]
+                if node["name"] in live_nodes and (replica_idx, frag_idx) not in pending:
+                    batches.setdefault(node["name"], (node, []))[1].append(key)
                     break
 
-            if not fragment_found:
-                print(f"Fragment {frag_idx} not found for file_id={file_id}")
-                return b""  # Return empty bytes if any fragment is missing
+        futures = [
+            self.__request_executor.submit(
+                self.__node_load.call, node, download_fragments_from_node, node, node["ip"], node_keys
+            )
+            for node, node_keys in batches.values()
+        ]
+        found = {}
+        for future in futures:
+            found.update(future.result() or {})
+        fragments = {
+            frag_idx: self.__verified(found.get(key), record, frag_idx, key)
+            for frag_idx, key in keys.items()
+        }
+
+        retries = {
+            frag_idx: self.__download_executor.submit(
+                self.__fetch_fragment, file_id, frag_idx, record
+            )
+            for frag_idx, frag in fragments.items()
+            if frag is None
+        }
+        for frag_idx, future in retries.items():
+            fragments[frag_idx] = future.result()
+        return {(file_id, frag_idx): frag for frag_idx, frag in fragments.items()}
+
+    def __retrieve_erasure_coded(self, file_id, record):
+        """Yield the data fragments of an erasure coded file in order.
 
-        # Check final file size after reassembly
-        reassembled = b"".join(fragments)
-        print(f"Reassembled file_id={file_id} with total length={len(reassembled)}")
-        return reassembled
+        Parity fragments are only downloaded once a data fragment turns out to be missing.
+        """
+        k, m = record["ec"]["k"], record["ec"]["m"]
+        futures = {
+            shard_idx: self.__download_executor.submit(
+                self.__download_fragment, file_id, shard_idx, record
+            )
+            for shard_idx in range(k)
+        }
+        remaining = record["size"]
+        shard_idx = 0
+        try:
+            while shard_idx < k:
+                shard = futures[shard_idx].result()
+                if shard is None:
+                    break
+                yield shard[:remaining]
+                remaining -= min(remaining, len(shard))
+                shard_idx += 1
+            if shard_idx == k:
+                return
+
+            print(f"Data fragment {shard_idx} of {file_id} is missing, decoding from parity")
+            for parity_idx in range(k, k + m):
+                futures[parity_idx] = self.__download_executor.submit(
+                    self.__download_fragment, file_id, parity_idx, record
+                )
+            shards = {}
+            for idx, future in futures.items():
+                shard = future.result()
+                if shard is not None:
+                    shards[idx] = shard
+            if len(shards) < k:
+                raise IOError(
+                    f"Only {len(shards)} of {k} required fragments found for file_id={file_id}"
+                )
+            data_shards = erasure_coding.decode(shards, k, m)
+            for shard in data_shards[shard_idx:]:
+                yield shard[:remaining]
+                remaining -= min(remaining, len(shard))
+        finally:
+            for future in futures.values():
+                future.cancel()
+
+    def __verified(self, frag, record, frag_idx, key, node=None):
+        """Return frag if it matches its recorded checksum, None if it is missing or corrupt"""
+        if frag is None or "checksums" not in record:
+            return frag
+        if checksum(frag) != record["checksums"][frag_idx]:
+            print(f"Checksum mismatch for fragment {frag_idx} of {key[0]} from {node}")
+            with self.__checksum_lock:
+                self.checksum_mismatches += 1
+            return None
+        return frag
+
+    def __download_fragment(self, file_id, frag_idx, record):
+        """Return a decompressed fragment from the cache, downloading it on a miss"""
+        return self.__cache.get_or_load(
+            (file_id, frag_idx),
+            lambda: self.__decompressed(
+                self.__fetch_fragment(file_id, frag_idx, record), record, frag_idx
+            ),
+        )
+
+    def __fetch_fragment(self, file_id, frag_idx, record):
+        """Download a fragment, failing over through its replicas on live nodes.
+
+        A replica whose data does not match the recorded checksum counts as missing.
+        """
+        key = storage_key(file_id, frag_idx, record)
+        replicas = self.__live_replicas(frag_idx, record)
+        if HEDGED_READS and len(replicas) > 1:
+            return self.__hedged_download(key, frag_idx, record, replicas)
+
+        for node in replicas:
+            frag = self.__verified(self.__timed_download(node, key), record, frag_idx, key, node)
+            if frag is not None:
+                print(f"Retrieved fragment {frag_idx} from {node}, length={len(frag)}")
+                return frag
+        return None
+
+    def __live_replicas(self, frag_idx, record):
+        """Nodes holding a confirmed copy of a fragment that are still in the cluster"""
+        live_nodes = {node["name"] for node in self.storage_nodes}
+        pending = pending_slots(record)
+        replicas = []
+        for replica_idx, nodes_list in enumerate(record["assigned_nodes"]):  # Check each replica for the fragment
+            node = nodes_list[frag_idx]
+            if node["name"] not in live_nodes:
+                print(f"Skipping fragment {frag_idx} on {node}, node is gone")
+                continue
+            if (replica_idx, frag_idx) in pending:
+                continue
+            replicas.append(node)
+        return replicas
+
+    def __hedged_download(self, key, frag_idx, record, replicas):
+        """Download a fragment from whichever replica answers first.
+
+        A request to the next replica is issued when the outstanding ones are slower
+        than the hedge delay or one of them fails. The losers are cancelled.
+        """
+        cancel_event = threading.Event()
+        in_flight = {}
+        remaining = list(replicas)
+
+        def issue(node):
+            future = self.__request_executor.submit(
+                self.__timed_download, node, key, cancel_event
+            )
+            in_flight[future] = node
+
+        primary = remaining.pop(0)
+        issue(primary)
+        try:
+            while in_flight:
+                timeout = self.hedge_delay() if remaining else None
+                done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    node = remaining.pop(0)
+                    print(f"Hedging fragment {frag_idx} of {key[0]} to {node}")
+                    self.count_hedge()
+                    issue(node)
+                    continue
+                for future in done:
+                    node = in_flight.pop(future)
+                    frag = self.__verified(future.result(), record, frag_idx, key, node)
+                    if frag is not None:
+                        if node is not primary:
+                            self.count_hedge(won=True)
+                        print(f"Retrieved fragment {frag_idx} from {node}, length={len(frag)}")
+                        return frag
+                    if remaining:  # Fail over right away
+                        issue(remaining.pop(0))
+            return None
+        finally:
+            cancel_event.set()
+            for future in in_flight:
+                future.cancel()
+
+    def __timed_download(self, node, key, cancel_event=None):
+        start = time.time()
+        frag = self.__node_load.call(
+            node, download_fragment_from_node, node, node["ip"], key[0], key[1], cancel_event
+        )
+        if frag is not None:
+            self.__download_latency.record(time.time() - start)
+        return frag
+
+    def hedged_reads(self):
+        """Whether fragment downloads are hedged to another replica when they are slow"""
+        return HEDGED_READS
+
+    def hedge_delay(self):
+        """Seconds to wait on a replica before hedging the request to another one"""
+        latency = self.__download_latency.percentile(HEDGE_PERCENTILE)
+        if latency is None:
+            return HEDGE_MIN_DELAY
+        return max(HEDGE_MIN_DELAY, latency)
+
+    def count_hedge(self, won=False):
+        """Count a hedged request, or one that answered before the replica it hedged"""
+        with self.__hedge_lock:
+            if won:
+                self.hedges_won += 1
+            else:
+                self.hedges_issued += 1
+
+    # The fragment transfers of async_app.py, which run on an event loop, go
+    # through the same node load, upload limits, download latencies and cache
+    # as those of FileHandler.
+
+    async def upload_async(self, node, fn, *args):
+        """Await fn(*args), an upload to node, within the node's concurrent upload limit"""
+        return await self.__upload_engine.run_async(node, fn, *args)
+
+    async def call_node_async(self, node, fn, *args):
+        """Await fn(*args), a request to node, as part of the node's load"""
+        return await self.__node_load.call_async(node, fn, *args)
+
+    async def download_async(self, node, fn, *args):
+        """Await fn(*args), a fragment download from node, noting its latency for the hedge delay"""
+        start = time.time()
+        frag = await self.__node_load.call_async(node, fn, *args)
+        if frag is not None:
+            self.__download_latency.record(time.time() - start)
+        return frag
+
+    async def load_fragment_async(self, file_id, frag_idx, loader):
+        """Return a fragment from the cache, awaiting loader() on a miss that no one else is loading"""
+        return await self.__cache.get_or_load_async((file_id, frag_idx), loader)
+
+    def stats(self):
+        with self.__hedge_lock:
+            hedged_reads = {
+                "enabled": HEDGED_READS,
+                "hedges_issued": self.hedges_issued,
+                "hedges_won": self.hedges_won,
+                "hedge_delay": self.hedge_delay(),
+            }
+        deduplication = {"enabled": DEDUPLICATION, **self.__dedup.stats()}
+        return {
+            "hedged_reads": hedged_reads,
+            "deduplication": deduplication,
+            "checksum_mismatches": self.checksum_mismatches,
+            "fragment_cache": self.__cache.stats(),
+            "node_load": self.__node_load.stats(),
+            "compression": {"codec": COMPRESSION, **self.__compressor.stats()},
+        }
 
     def change_replication_strategy(self, strategy):
         global NODE_SELECTION_STRATEGY
@@ -109,73 +1202,306 @@ class FileHandler:
         except Exception as e:
             print(f"Failed to change replication strategy to {strategy}: {e}")
             return {
-                "message": f"Failed to change replication strategy to {strategy}: {e}, use valid strategy: random, min_copy_sets, buddy"
+                "message": f"Failed to change replication strategy to {strategy}: {e}, use valid strategy: random, min_copy_sets, buddy, rendezvous, load_aware, load_aware_min_copy_sets, load_aware_buddy"
             }
 
-    def __upload_fragments(self, file_id, fragments, assigned_nodes):
-        threads = (
-            []
-        )  # Threads makes sense since we dont have to wait for one fragment to be uploaded to start the next one
-        for replica_idx in range(NO_REPLICAS):
-            for frag_idx, fragment in enumerate(fragments):
-                node = assigned_nodes[replica_idx][frag_idx]
-                print(
-                    f"Uploading replica {replica_idx} of fragment {frag_idx} to node {node}, fragment length={len(fragment)}"
-                )
-                t = threading.Thread(
-                    target=upload_fragment_to_node,
-                    args=(node, node["ip"], file_id, frag_idx, fragment),
-                )
-                t.start()
-                threads.append(t)
-        for t in threads:
-            t.join()
+    def change_storage_mode(self, mode):
+        global STORAGE_MODE
+        if mode not in (REPLICATION, ERASURE_CODING):
+            return {
+                "message": f"Invalid storage mode {mode}, use valid mode: {REPLICATION}, {ERASURE_CODING}"
+            }
+        STORAGE_MODE = mode
+        try:
+            self.__setup_node_strategy()
+            print(f"Changed storage mode to {mode}")
+            return {"message": f"Changed storage mode to {mode}"}
+        except Exception as e:
+            print(f"Failed to change storage mode to {mode}: {e}")
+            return {"message": f"Failed to change storage mode to {mode}: {e}"}
+
+    def set_deduplication(self, enabled):
+        global DEDUPLICATION
+        DEDUPLICATION = enabled
+        print(f"Set deduplication to {enabled}")
+        return {"message": f"Set deduplication to {enabled}"}
+
+    def set_compression(self, codec):
+        global COMPRESSION
+        codec = self.__codec(codec)
+        if codec is not None and codec not in compression.CODECS:
+            print(f"Unknown compression codec {codec}")
+            return {"message": f"Unknown compression codec {codec}, available: {sorted(compression.CODECS)}"}
+        COMPRESSION = codec
+        print(f"Set compression to {codec}")
+        return {"message": f"Set compression to {codec}"}
+
+    def set_write_quorum(self, quorum):
+        global WRITE_QUORUM
+        WRITE_QUORUM = quorum
+        print(f"Set write quorum to {quorum}")
+        return {"message": f"Set write quorum to {quorum}"}
+
+    def set_erasure_coding(self, data_fragments, parity_fragments):
+        global EC_DATA_FRAGMENTS, EC_PARITY_FRAGMENTS
+        EC_DATA_FRAGMENTS = data_fragments
+        EC_PARITY_FRAGMENTS = parity_fragments
+        message = f"erasure coding to {data_fragments} data + {parity_fragments} parity fragments"
+        try:
+            self.__setup_node_strategy()
+            print(f"Changed {message}")
+            return {"message": f"Changed {message}"}
+        except Exception as e:
+            print(f"Failed to change {message}: {e}")
+            return {"message": f"Failed to change {message}: {e}"}
+
+    def __upload_files(self, files, on_ack=None):
+        """Upload every replica of every fragment of files.
+
+        files is a dict of file_id -> (fragments, checksums, assigned_nodes).
+        on_ack(name, keys) is called as soon as the (file_id, frag_idx) keys are written to a node.
+
+        Fragments that go to the same node are packed into batches of up to BATCH_MAX_BYTES.
+        Returns the ids of the files that could not be fully written.
+        """
+        uploads = self.__uploads_by_node(files)
+        for attempt in range(1 + UPLOAD_RETRIES):
+            futures = {}
+            for name, (node, keys) in uploads.items():
+                for batch in self.__pack_batches(files, sorted(keys)):
+                    if len(batch) > 1:
+                        print(f"Uploading {len(batch)} fragments to node {node} in one batch")
+                        records = [
+                            (file_id, frag_idx, files[file_id][0][frag_idx])
+                            for file_id, frag_idx in batch
+                        ]
+                        checksums = [files[file_id][1][frag_idx] for file_id, frag_idx in batch]
+                        futures[(name, tuple(batch))] = self.__upload_engine.submit(
+                            node, upload_fragments_to_node, node, node["ip"], records, checksums
+                        )
+                        continue
+                    file_id, frag_idx = batch[0]
+                    fragment = files[file_id][0][frag_idx]
+                    fragment_checksum = files[file_id][1][frag_idx]
+                    print(
+                        f"Uploading fragment {frag_idx} of {file_id} to node {node}, fragment length={len(fragment)}"
+                    )
+                    futures[(name, tuple(batch))] = self.__upload_engine.submit(
+                        node, upload_fragment_to_node,
+                        node, node["ip"], file_id, frag_idx, fragment, fragment_checksum,
+                    )
+            if on_ack is not None:
+                for (name, keys), future in futures.items():
+                    future.add_done_callback(
+                        partial(self.__acknowledge, on_ack, name, keys)
+                    )
+
+            failed = {}
+            for (name, keys), future in futures.items():
+                if not future.result():
+                    failed.setdefault(name, (uploads[name][0], set()))[1].update(keys)
+            uploads = failed
+            if not uploads:
+                return set()
+            print(f"Uploads to {list(uploads)} failed (attempt {attempt + 1})")
+        return {file_id for _, keys in uploads.values() for file_id, _ in keys}
+
+    @staticmethod
+    def __uploads_by_node(files):
+        """The (file_id, frag_idx) keys of files to write to each node, by node name"""
+        # Each fragment is written once per node, even if a node holds two of its replicas
+        uploads = {}
+        for file_id, (_, _, assigned_nodes) in files.items():
+            for replica in assigned_nodes:
+                for frag_idx, node in enumerate(replica):
+                    uploads.setdefault(node["name"], (node, set()))[1].add((file_id, frag_idx))
+        return uploads
+
+    @staticmethod
+    def __acknowledge(on_ack, name, keys, future):
+        if future.result():
+            on_ack(name, keys)
+
+    @staticmethod
+    def __pack_batches(files, keys):
+        """Group the (file_id, frag_idx) keys headed to one node into batches of at most BATCH_MAX_BYTES"""
+        if not BATCH_TRANSFERS:
+            return [[key] for key in keys]
+        batches, batch, batch_bytes = [], [], 0
+        for key in keys:
+            file_id, frag_idx = key
+            size = len(files[file_id][0][frag_idx])
+            if batch and batch_bytes + size > BATCH_MAX_BYTES:
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(key)
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __stream_upload(self, node, file_id, frag_idx, chunk_queue):
+        def chunks():
+            while True:
+                chunk = chunk_queue.get()
+                if chunk is None:
+                    return
+                yield chunk
+
+        print(f"Streaming fragment {frag_idx} of {file_id} to node {node}")
+        return upload_fragment_stream_to_node(
+            node, node["ip"], file_id, frag_idx, chunks()
+        )
+
+    @staticmethod
+    def __feed_pipes(pipes, chunk):
+        """Hand chunk to every replica upload, skipping uploads that have stopped"""
+        for chunk_queue, future in pipes:
+            while not future.done():
+                try:
+                    chunk_queue.put(chunk, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+
+    def __new_file_id(self, reserved=()):
+        """Generate a unique file_id not in the metadata or in reserved"""
+        # Metadata outlives the lead node now, so draw from a range that does not run out
+        file_id = "file_" + str(random.randint(10**7, 10**8 - 1))
+        while file_id in reserved or self.__direct.planned(file_id) or file_id in self.metadata:
+            file_id = "file_" + str(random.randint(10**7, 10**8 - 1))
+        return file_id
+
+    @staticmethod
+    def __fragment_count(file_size):
+        """Number of fragments a file of file_size bytes is split into"""
+        if not FRAGMENT_TARGET_SIZE:
+            return NO_FRAGMENTS
+        count = math.ceil(file_size / FRAGMENT_TARGET_SIZE)
+        return max(MIN_FRAGMENTS, min(MAX_FRAGMENTS, count))
+
+    @staticmethod
+    def __fragment_sizes(file_size):
+        """Sizes of the fragments a file of file_size bytes is split into"""
+        no_fragments = FileHandler.__fragment_count(file_size)
+        base_fragment_size = math.floor(file_size / no_fragments)
+        remainder = file_size % no_fragments
+        return [
+            base_fragment_size + (1 if i < remainder else 0) for i in range(no_fragments)
+        ]
 
     def __setup_node_strategy(self):
-        if NODE_SELECTION_STRATEGY == RANDOM_SELECTION:
-            self.node_selector = RandomSelection(
-                self.storage_nodes, NO_FRAGMENTS, NO_REPLICAS
+        if STORAGE_MODE == ERASURE_CODING:
+            # A stripe of k + m fragments is placed like k + m replicas of one fragment
+            no_fragments, no_replicas = 1, EC_DATA_FRAGMENTS + EC_PARITY_FRAGMENTS
+        else:
+            no_fragments, no_replicas = NO_FRAGMENTS, NO_REPLICAS
+
+        # Load-aware strategies choose between placements of the strategy they are based on
+        strategy = LOAD_AWARE_SELECTIONS.get(NODE_SELECTION_STRATEGY, NODE_SELECTION_STRATEGY)
+        if strategy == RANDOM_SELECTION:
+            node_selector = RandomSelection(
+                self.storage_nodes, no_fragments, no_replicas
             )
-        elif NODE_SELECTION_STRATEGY == MIN_COPY_SETS_SELECTION:
-            self.node_selector = MinCopySetsSelection(
-                self.storage_nodes, NO_FRAGMENTS, NO_REPLICAS
+        elif strategy == MIN_COPY_SETS_SELECTION:
+            node_selector = MinCopySetsSelection(
+                self.storage_nodes, no_fragments, no_replicas
             )
-        elif NODE_SELECTION_STRATEGY == BUDDY_SELECTION:
-            self.node_selector = BuddySelection(
-                self.storage_nodes, NO_FRAGMENTS, NO_REPLICAS
+        elif strategy == BUDDY_SELECTION:
+            node_selector = BuddySelection(
+                self.storage_nodes, no_fragments, no_replicas
+            )
+        elif strategy == RENDEZVOUS_SELECTION:
+            node_selector = RendezvousSelection(
+                self.storage_nodes, no_fragments, no_replicas
             )
         else:
             raise NotImplementedError(
                 f"Invalid node selection strategy: {NODE_SELECTION_STRATEGY}"
             )
+        if NODE_SELECTION_STRATEGY in LOAD_AWARE_SELECTIONS:
+            node_selector = LoadAwareSelection(node_selector, self.__node_load)
+        self.node_selector = node_selector
 
-    def __get_storage_node_pods(
-        self, namespace="default", timeout=5, poll_interval=0.5
-    ):
-        """Get the names and IPs of storage-node pods."""
-        pod_list = v1.list_namespaced_pod(namespace, label_selector="app=storage-node")
-        pods = []
-        start_time = time.time()
-        for pod in pod_list.items:
-            while pod.status.phase != "Running":
-                elapsed_time = time.time() - start_time
-                if elapsed_time > timeout:
-                    print(f"Timeout waiting for pod {pod.metadata.name} to be Running")
-                    break
-                print(f"Waiting for pod {pod.metadata.name} to be Running")
-                try:
-                    pod = v1.read_namespaced_pod(pod.metadata.name, namespace)
-                except Exception as e:
-                    print(f"Error getting pod {pod.metadata.name}: {e}")
-                    break
-            if pod.status.phase == "Running" and not pod.metadata.deletion_timestamp:
-                pods.append({"name": pod.metadata.name, "ip": pod.status.pod_ip})
-        if pods != self.storage_nodes:
-            print("Storage nodes updated:", pods)
-            self.storage_nodes = pods
-            self.__setup_node_strategy()
+    def __nodes_changed(self, joined, left):
+        """Membership listener, called with the storage nodes that joined and left"""
+        print("Storage nodes joined:", joined, "left:", left)
+        for node in left:
+            close_node_pool(node)
+            self.__upload_engine.forget_node(node)
+            self.__node_load.forget(node)
+            self.__fragment_index.node_down(node["name"])
+        for node in joined:
+            open_node_pool(node)
+            self.__fragment_index.node_up(node["name"])
+        # Readers iterate over storage_nodes without a lock, so it is replaced rather than changed
+        self.storage_nodes = [
+            node for node in self.storage_nodes if node not in left
+        ] + joined
+        self.__epochs.advance(self.storage_nodes)
+
+        initial = self.node_selector is None
+        try:
+            if initial:
+                self.__setup_node_strategy()
+            else:
+                # Only the groups of the nodes that changed are touched, so placement stays stable
+                for node in left:
+                    self.node_selector.remove_node(node)
+                for node in joined:
+                    self.node_selector.add_node(node)
+        except Exception as e:
+            print(f"Failed to set up node selection for {len(self.storage_nodes)} nodes: {e}")
+            self.node_selector = None
+            return
+
+        if AUTO_REPAIR:
+            if initial and self.__fragment_index.loaded():
+                # Files may have lost copies while the lead node was down,
+                # if the index is still loading this is done once it is loaded
+                self.__repair.enqueue(self.__fragment_index.fragments_to_repair())
+            for node in left:
+                self.__repair.enqueue(self.__fragment_index.fragments_to_repair(node["name"]))
+            if joined or left:
+                # Repairs that found no replacement node, or picked one that was down, may succeed now
+                self.__repair.retry_failed()
+
+    def __load_fragment_index(self):
+        start = time.time()
+        self.__fragment_index.load(
+            (file_id, record, required_fragments(record))
+            for file_id, record in (
+                (file_id, self.__epochs.resolve(file_id, record))
+                for file_id, record in self.metadata.items()
+            )
+        )
+        print(f"Indexed {self.__fragment_index.total_files()} files in {time.time() - start:.2f}s")
+        if AUTO_REPAIR and self.node_selector is not None:
+            # Files may have lost copies while the lead node was down
+            self.__repair.enqueue(self.__fragment_index.fragments_to_repair())
+
+    def __poll_node_stats(self, period):
+        """Keep the disk usage of every storage node up to date for load-aware selection"""
+        while True:
+            nodes = self.storage_nodes
+            try:
+                replies = self.__request_executor.map(
+                    lambda node: get_node_stats(node, node["ip"]), nodes
+                )
+                for node, reply in zip(nodes, replies):
+                    if reply is not None:
+                        self.__node_load.set_disk_usage(node, reply["free_bytes"], reply["total_bytes"])
+            except Exception as e:
+                print(f"Polling storage node stats failed: {e}")
+            time.sleep(period)
 
-    def kill_storage_nodes(self, s, namespace="default"):
+    def __repair_fragment(self, file_id, frag_idx):
+        return self.__fragment_repair.repair(file_id, frag_idx, self.storage_nodes, self.node_selector)
+
+    def repair_status(self):
+        return {"enabled": AUTO_REPAIR, **self.__repair.status()}
+
+    def kill_storage_nodes(self, s):
         """kill s random storage node pods"""
         if s >= len(self.storage_nodes):
             error_str = "Cannot kill all or more than number of storage nodes"
@@ -184,7 +1510,7 @@ class FileHandler:
         pods_to_delete = random.sample(self.storage_nodes, k=s)
         killed_nodes = []
         for pod in pods_to_delete:
-            v1.delete_namespaced_pod(pod["name"], namespace)
+            self.membership.kill(pod)
             print(f"Killed storage node pod {pod['name']}")
             killed_nodes.append(pod)
         return killed_nodes
@@ -202,13 +1528,30 @@ class FileHandler:
                 "message": f"Failed to change number of replicas to {replicas}: {e}"
             }
 
+    def set_fragment_policy(self, target_size, min_fragments, max_fragments):
+        global FRAGMENT_TARGET_SIZE, MIN_FRAGMENTS, MAX_FRAGMENTS
+        if target_size < 0 or not 1 <= min_fragments <= max_fragments:
+            print(f"Invalid fragment policy {target_size}, {min_fragments}, {max_fragments}")
+            return {"message": f"Invalid fragment policy {target_size}, {min_fragments}, {max_fragments}"}
+        FRAGMENT_TARGET_SIZE = target_size
+        MIN_FRAGMENTS = min_fragments
+        MAX_FRAGMENTS = max_fragments
+        message = f"fragment policy to {target_size} bytes per fragment, {min_fragments} to {max_fragments} fragments"
+        print(f"Set {message}")
+        return {"message": f"Set {message}"}
+
     def set_fragments(self, fragments):
-        global NO_FRAGMENTS
+        global NO_FRAGMENTS, FRAGMENT_TARGET_SIZE
         NO_FRAGMENTS = fragments
         try:
             self.__setup_node_strategy()
-            print(f"Changed number of fragments to {fragments}")
-            return {"message": f"Changed number of fragments to {fragments}"}
+            message = f"Changed number of fragments to {fragments}"
+            if FRAGMENT_TARGET_SIZE:
+                # A fixed count is asked for, so files are no longer split by size
+                FRAGMENT_TARGET_SIZE = 0
+                message += ", fragment size policy turned off"
+            print(message)
+            return {"message": message}
         except Exception as e:
             print(f"Failed to change number of fragments to {fragments}: {e}")
             return {
@@ -216,47 +1559,26 @@ class FileHandler:
             }
 
     def quantify_file_loss(self):
-        self.__get_storage_node_pods()
-        files_lost = 0
-
-        # Iterate over all files and their replica metadata
-        for file_id, replicas in file_metadata.items():
-            print(f"Checking file_id={file_id} with replicas: {replicas}")
-
-            # Track the fragments successfully found across all replicas
-            fragments_found = set()
-
-            for replica in replicas:
-                for frag_idx, fragment_node in enumerate(replica):
-                    # Check if the fragment node exists in the current storage nodes
-                    if any(
-                        node["name"] == fragment_node["name"]
-                        for node in self.storage_nodes
-                    ):
-                        fragments_found.add(frag_idx)
-
-            # If the number of found fragments is less than expected, the file is lost
-            if len(fragments_found) < NO_FRAGMENTS:
-                print(
-                    f"File {file_id} is lost (found {len(fragments_found)} of {NO_FRAGMENTS} fragments)"
-                )
-                files_lost += 1
-            else:
-                print(f"File {file_id} is intact (found all {NO_FRAGMENTS} fragments)")
-
-        total_files = len(file_metadata)
+        # The fragment index is updated whenever nodes come and go, so this is a counter read
+        files_lost = self.__fragment_index.files_lost()
+        total_files = self.__fragment_index.total_files()
         print(f"Files lost: {files_lost}/{total_files}")
         return {
             "files_lost": files_lost,
             "total_files": total_files,
             "node_count": len(self.storage_nodes),
+            # The counts only cover every stored file once the index is loaded after a restart
+            "index_loaded": self.__fragment_index.loaded(),
         }
 
+    def at_risk_files(self):
+        """Files that are lost or have fragments with missing copies"""
+        return self.__fragment_index.at_risk_files()
+
     def reset_metadata(self):
-        global file_metadata
-        file_metadata = {}
+        self.metadata.clear()
+        self.__fragment_index.clear()
+        self.__cache.clear()
+        self.__repair.clear()
+        self.__direct.clear()
         return {"message": "Metadata reset successfully"}
-
-    def __monitor_storage_nodes(self, period):
-        while not self.__ticker.wait(period):
-            self.__get_storage_node_pods()
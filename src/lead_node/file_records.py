@@ -0,0 +1,35 @@
+from erasure_coding import ERASURE_CODING
+
+
+def storage_key(file_id, frag_idx, record):
+    """The (file_id, frag_idx) a fragment is stored under on the storage nodes"""
+    if "fragment_keys" in record:
+        return record["fragment_keys"][frag_idx], 0
+    return file_id, frag_idx
+
+
+def pending_slots(record):
+    """The (replica_idx, frag_idx) slots of record whose write is not confirmed yet"""
+    return {tuple(slot) for slot in record.get("pending", ())}
+
+
+def is_compressed(record, frag_idx):
+    return "compression" in record and record["compression"]["fragments"][frag_idx]
+
+
+def required_fragments(record):
+    """Number of distinct fragments that must survive for the file to be readable"""
+    # Erasure coded files survive as long as any k of their fragments do
+    if record["storage_mode"] == ERASURE_CODING:
+        return record["ec"]["k"]
+    return record["no_fragments"]
+
+
+def fragment_copies(records):
+    """Every stored copy of the files in a list of (file_id, record), as a dict of (node name, file_id, frag_idx) -> node"""
+    return {
+        (node["name"], file_id, frag_idx): node
+        for file_id, record in records
+        for replica in record["assigned_nodes"]
+        for frag_idx, node in enumerate(replica)
+    }
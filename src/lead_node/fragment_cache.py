@@ -0,0 +1,172 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future
+
+
+class FragmentCache:
+    """LRU cache of fragments keyed by (file_id, frag_idx), bounded by total bytes.
+
+    Concurrent misses for the same key are coalesced, so only one of them loads
+    the fragment and the others wait for its result.
+    """
+
+    def __init__(self, max_bytes):
+        self.__max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()  # key -> fragment, least recently used first
+        self.__size = 0
+        self.__loading = {}  # key -> Future of the load in progress
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached fragment, None on a miss"""
+        with self.__lock:
+            fragment = self.__entries.get(key)
+            if fragment is None:
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return fragment
+
+    def get_or_load(self, key, loader):
+        """Return the cached fragment, calling loader() on a miss and caching its result.
+
+        A loader result of None is returned but not cached.
+        """
+        return self.get_or_load_many([key], lambda _: {key: loader()})[0]
+
+    def get_or_load_many(self, keys, loader):
+        """Return the fragments of keys, loading the missing ones with one loader call.
+
+        loader gets the keys that are neither cached nor being loaded by another
+        caller and returns a dict of key -> fragment. Keys that another caller is
+        loading are waited for.
+        """
+        found, waiting, owned = {}, {}, {}
+        with self.__lock:
+            for key in keys:
+                fragment = self.__entries.get(key)
+                if fragment is not None:
+                    self.__entries.move_to_end(key)
+                    self.hits += 1
+                    found[key] = fragment
+                elif key in self.__loading:
+                    self.coalesced += 1
+                    waiting[key] = self.__loading[key]
+                elif key not in owned:
+                    owned[key] = self.__loading[key] = Future()
+                    self.misses += 1
+
+        if owned:
+            try:
+                loaded = loader(list(owned))
+                for key, future in owned.items():
+                    fragment = loaded.get(key)
+                    if fragment is not None:
+                        self.put(key, fragment)
+                    future.set_result(fragment)
+                    found[key] = fragment
+            except BaseException as e:
+                for future in owned.values():
+                    if not future.done():
+                        future.set_exception(e)
+                raise
+            finally:
+                with self.__lock:
+                    for key in owned:
+                        self.__loading.pop(key, None)
+        for key, future in waiting.items():
+            try:
+                found[key] = future.result()
+            except CancelledError:
+                # The caller loading it on the event loop went away, so load it here
+                found[key] = self.get_or_load(key, lambda: loader([key]).get(key))
+        return [found[key] for key in keys]
+
+    async def get_or_load_async(self, key, loader):
+        """get_or_load on the event loop, awaiting loader(), a coroutine function, on a miss.
+
+        Misses are coalesced with those of get_or_load and get_or_load_many.
+        """
+        while True:
+            with self.__lock:
+                fragment = self.__entries.get(key)
+                if fragment is not None:
+                    self.__entries.move_to_end(key)
+                    self.hits += 1
+                    return fragment
+                future = self.__loading.get(key)
+                if future is None:
+                    future = self.__loading[key] = Future()
+                    self.misses += 1
+                    break
+                self.coalesced += 1
+            try:
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # The caller loading it went away before it finished, so try again
+
+        try:
+            fragment = await loader()
+            if fragment is not None:
+                self.put(key, fragment)
+        except BaseException as e:
+            with self.__lock:
+                self.__loading.pop(key, None)
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+            raise
+        # Dropped from loading before the waiters wake, so none of them finds a finished load
+        with self.__lock:
+            self.__loading.pop(key, None)
+        future.set_result(fragment)
+        return fragment
+
+    def put(self, key, fragment):
+        fragment = bytes(fragment)
+        if len(fragment) > self.__max_bytes:
+            return
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.__size -= len(old)
+            self.__entries[key] = fragment
+            self.__size += len(fragment)
+            while self.__size > self.__max_bytes:
+                _, evicted = self.__entries.popitem(last=False)
+                self.__size -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, file_id, no_fragments):
+        """Drop every cached fragment of a file"""
+        with self.__lock:
+            for frag_idx in range(no_fragments):
+                fragment = self.__entries.pop((file_id, frag_idx), None)
+                if fragment is not None:
+                    self.__size -= len(fragment)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries = OrderedDict()
+            self.__size = 0
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "max_bytes": self.__max_bytes,
+                "bytes": self.__size,
+                "fragments": len(self.__entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+            }
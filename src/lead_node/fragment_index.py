@@ -0,0 +1,187 @@
+import threading
+from collections import Counter
+
+
+class FragmentIndex:
+    """Inverted index from storage node to the fragments it holds.
+
+    Tracks how many live copies every fragment has, so a node joining or leaving
+    only touches the fragments on that node, and the number of lost and
+    under-replicated files is always known without scanning the metadata.
+
+    The files already in the metadata are indexed by load, which may run in the
+    background while files are added and removed.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__live_nodes = set()
+        self.__node_fragments = {}  # node name -> Counter of (file_id, frag_idx)
+        self.__files = {}  # file_id -> {"live": [...], "copies": [...], "required": int, "nodes": set}
+        self.__lost = set()
+        self.__at_risk = set()
+        self.__loaded = threading.Event()
+        # Files added or removed while load runs, whose loaded records are out of date
+        self.__changed = set()
+        self.__generation = 0  # bumped by clear, so a load of cleared files stops
+
+    def load(self, files):
+        """Index an iterable of (file_id, record, required) read from the metadata.
+
+        Files that were added or removed since the load started are skipped, the
+        index already has them as they are now.
+        """
+        with self.__lock:
+            generation = self.__generation
+        for file_id, record, required in files:
+            with self.__lock:
+                if generation != self.__generation:
+                    break
+                if file_id not in self.__changed:
+                    self.__add(file_id, record, required)
+        with self.__lock:
+            self.__changed = set()
+        self.__loaded.set()
+
+    def loaded(self):
+        """Whether the files in the metadata are all indexed"""
+        return self.__loaded.is_set()
+
+    def add_file(self, file_id, record, required):
+        """Index a file. It is lost once fewer than required fragments have a live copy.
+
+        Pending copies, whose write is not confirmed, count as missing.
+        """
+        with self.__lock:
+            if not self.__loaded.is_set():
+                self.__changed.add(file_id)
+            self.__add(file_id, record, required)
+
+    def __add(self, file_id, record, required):
+        self.__remove(file_id)
+        assigned_nodes = record["assigned_nodes"]
+        pending = {tuple(slot) for slot in record.get("pending", ())}
+        no_fragments = len(assigned_nodes[0])
+        entry = {
+            "live": [0] * no_fragments,
+            "copies": [len(assigned_nodes)] * no_fragments,
+            "required": required,
+            "nodes": set(),
+        }
+        for replica_idx, replica in enumerate(assigned_nodes):
+            for frag_idx, node in enumerate(replica):
+                if (replica_idx, frag_idx) in pending:
+                    continue
+                entry["nodes"].add(node["name"])
+                self.__node_fragments.setdefault(node["name"], Counter())[
+                    (file_id, frag_idx)
+                ] += 1
+                if node["name"] in self.__live_nodes:
+                    entry["live"][frag_idx] += 1
+        self.__files[file_id] = entry
+        self.__classify(file_id)
+
+    def remove_file(self, file_id):
+        with self.__lock:
+            if not self.__loaded.is_set():
+                self.__changed.add(file_id)
+            self.__remove(file_id)
+
+    def node_down(self, name):
+        """Mark every fragment on a node that left the cluster as one copy short"""
+        with self.__lock:
+            if name not in self.__live_nodes:
+                return
+            self.__live_nodes.discard(name)
+            self.__update_node(name, -1)
+
+    def node_up(self, name):
+        with self.__lock:
+            if name in self.__live_nodes:
+                return
+            self.__live_nodes.add(name)
+            self.__update_node(name, 1)
+
+    def fragments_on_node(self, name):
+        """Return the (file_id, frag_idx) pairs stored on a node"""
+        with self.__lock:
+            return list(self.__node_fragments.get(name, ()))
+
+    def fragments_to_repair(self, name=None):
+        """Return (surviving copies, file_id, frag_idx) for fragments of readable files with missing copies.
+
+        Only fragments on the named node are looked at if a name is given. Erasure
+        coded fragments count the spare fragments their file has left plus one as
+        copies, so a stripe one loss away from being unreadable ranks with a
+        fragment that has a single copy.
+        """
+        with self.__lock:
+            if name is None:
+                keys = [
+                    (file_id, frag_idx)
+                    for file_id in self.__at_risk
+                    for frag_idx in range(len(self.__files[file_id]["live"]))
+                ]
+            else:
+                keys = list(self.__node_fragments.get(name, ()))
+            fragments = []
+            for file_id, frag_idx in keys:
+                # Lost files cannot be read back, so there is nothing to copy from
+                if file_id in self.__lost:
+                    continue
+                entry = self.__files[file_id]
+                live = entry["live"][frag_idx]
+                if live >= entry["copies"][frag_idx]:
+                    continue
+                if entry["required"] < len(entry["live"]):
+                    live = sum(1 for copies in entry["live"] if copies > 0) - entry["required"] + 1
+                fragments.append((live, file_id, frag_idx))
+            return fragments
+
+    def files_lost(self):
+        return len(self.__lost)
+
+    def total_files(self):
+        return len(self.__files)
+
+    def at_risk_files(self):
+        """Return the ids of lost files and of files with fewer live copies than stored"""
+        with self.__lock:
+            return {"lost": sorted(self.__lost), "under_replicated": sorted(self.__at_risk)}
+
+    def clear(self):
+        with self.__lock:
+            self.__generation += 1
+            self.__node_fragments = {}
+            self.__files = {}
+            self.__lost = set()
+            self.__at_risk = set()
+
+    def __update_node(self, name, delta):
+        touched = set()
+        for (file_id, frag_idx), copies in self.__node_fragments.get(name, {}).items():
+            self.__files[file_id]["live"][frag_idx] += delta * copies
+            touched.add(file_id)
+        for file_id in touched:
+            self.__classify(file_id)
+
+    def __remove(self, file_id):
+        entry = self.__files.pop(file_id, None)
+        if entry is None:
+            return
+        for name in entry["nodes"]:
+            fragments = self.__node_fragments[name]
+            for frag_idx in range(len(entry["live"])):
+                fragments.pop((file_id, frag_idx), None)
+        self.__lost.discard(file_id)
+        self.__at_risk.discard(file_id)
+
+    def __classify(self, file_id):
+        entry = self.__files[file_id]
+        available = sum(1 for live in entry["live"] if live > 0)
+        self.__lost.discard(file_id)
+        self.__at_risk.discard(file_id)
+        if available < entry["required"]:
+            self.__lost.add(file_id)
+        elif any(live < copies for live, copies in zip(entry["live"], entry["copies"])):
+            self.__at_risk.add(file_id)
@@ -0,0 +1,23 @@
+import threading
+from collections import deque
+
+
+class LatencyTracker:
+    """Keeps the most recent request latencies and reports percentiles over them"""
+
+    def __init__(self, window):
+        self.__samples = deque(maxlen=window)
+        self.__lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.__lock:
+            self.__samples.append(seconds)
+
+    def percentile(self, p):
+        """Return the p-th percentile of the recorded latencies, None if there are none"""
+        with self.__lock:
+            samples = sorted(self.__samples)
+        if not samples:
+            return None
+        idx = min(len(samples) - 1, int(len(samples) * p / 100))
+        return samples[idx]
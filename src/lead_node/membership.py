@@ -0,0 +1,153 @@
+import threading
+import time
+
+KUBERNETES_MEMBERSHIP = "kubernetes"
+FAKE_MEMBERSHIP = "fake"
+
+
+class Membership:
+    """Parent class for storage node membership sources.
+
+    A source calls listener(joined, left) with lists of {"name", "ip"} nodes
+    whenever nodes join or leave, starting with every current node as joined.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__nodes = {}  # name -> node
+        self.__listener = None
+
+    def start(self, listener):
+        raise NotImplementedError("This method must be implemented by the subclass")
+
+    def nodes(self):
+        with self.__lock:
+            return list(self.__nodes.values())
+
+    def kill(self, node):
+        """Make a storage node fail, for loss experiments"""
+        raise NotImplementedError("This method must be implemented by the subclass")
+
+    def _set_listener(self, listener):
+        self.__listener = listener
+
+    def _update(self, name, node):
+        """Record that the node called name is now node, or gone if node is None"""
+        with self.__lock:
+            old = self.__nodes.get(name)
+            if old == node:
+                return
+            if node is None:
+                del self.__nodes[name]
+            else:
+                self.__nodes[name] = node
+            # A pod whose IP changed is replaced like one that restarted
+            left = [old] if old is not None else []
+            joined = [node] if node is not None else []
+            self.__listener(joined, left)
+
+    def _sync(self, nodes):
+        """Replace the membership with a full list of nodes"""
+        with self.__lock:
+            current = {node["name"]: node for node in nodes}
+            left = [node for name, node in self.__nodes.items() if current.get(name) != node]
+            joined = [node for name, node in current.items() if self.__nodes.get(name) != node]
+            self.__nodes = current
+            if joined or left:
+                self.__listener(joined, left)
+
+
+class KubernetesMembership(Membership):
+    """Storage node membership from a watch on the storage-node pods.
+
+    Pod changes arrive as soon as Kubernetes sees them, so a pod that is deleted
+    or stops being ready leaves within a fraction of a second. The pod list is
+    fetched again every resync_interval seconds and after watch errors.
+    """
+
+    def __init__(self, namespace, label_selector, resync_interval):
+        super().__init__()
+        # Imported here so the lead node runs with FakeMembership where the package is not installed
+        from kubernetes import client, config, watch
+
+        # Configure access to the Kubernetes cluster
+        config.load_incluster_config()  # Use this if running inside the cluster
+        # config.load_kube_config()  # Use this for local testing with kubeconfig
+        self.__api = client.CoreV1Api()
+        self.__watch = watch
+        self.__namespace = namespace
+        self.__label_selector = label_selector
+        self.__resync_interval = resync_interval
+
+    def start(self, listener):
+        self._set_listener(listener)
+        threading.Thread(target=self.__watch_loop, daemon=True).start()
+
+    def kill(self, node):
+        # The watch reports the pod leaving
+        self.__api.delete_namespaced_pod(node["name"], self.__namespace)
+
+    @staticmethod
+    def _node(pod):
+        """The node of a pod that can serve requests, None otherwise"""
+        if pod.status.phase != "Running" or pod.metadata.deletion_timestamp or not pod.status.pod_ip:
+            return None
+        for condition in pod.status.conditions or ():
+            if condition.type == "Ready" and condition.status != "True":
+                return None
+        return {"name": pod.metadata.name, "ip": pod.status.pod_ip}
+
+    def __watch_loop(self):
+        while True:
+            try:
+                pod_list = self.__api.list_namespaced_pod(
+                    self.__namespace, label_selector=self.__label_selector
+                )
+                self._sync([node for node in map(self._node, pod_list.items) if node])
+                stream = self.__watch.Watch().stream(
+                    self.__api.list_namespaced_pod,
+                    self.__namespace,
+                    label_selector=self.__label_selector,
+                    resource_version=pod_list.metadata.resource_version,
+                    timeout_seconds=self.__resync_interval,
+                )
+                for event in stream:
+                    pod = event["object"]
+                    node = None if event["type"] == "DELETED" else self._node(pod)
+                    self._update(pod.metadata.name, node)
+            except Exception as e:
+                print(f"Storage node watch failed, listing pods again: {e}")
+                time.sleep(1)
+
+
+class FakeMembership(Membership):
+    """Membership changed by hand, for tests and for running the lead node without Kubernetes.
+
+    Starts with a fixed list of nodes, e.g. the storage nodes of docker-compose.yml.
+    """
+
+    def __init__(self, nodes=()):
+        super().__init__()
+        self.__initial = list(nodes)
+
+    def start(self, listener):
+        self._set_listener(listener)
+        self._sync(self.__initial)
+
+    def add_node(self, node):
+        self._update(node["name"], node)
+
+    def remove_node(self, node):
+        self._update(node["name"], None)
+
+    def kill(self, node):
+        # The node keeps running, the lead node just stops using it
+        self.remove_node(node)
+
+
+def create_membership(source, namespace, label_selector, resync_interval, fake_nodes):
+    if source == KUBERNETES_MEMBERSHIP:
+        return KubernetesMembership(namespace, label_selector, resync_interval)
+    if source == FAKE_MEMBERSHIP:
+        return FakeMembership(fake_nodes)
+    raise NotImplementedError(f"Invalid membership source: {source}")
@@ -0,0 +1,327 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+
+IN_MEMORY_METADATA = "memory"
+SQLITE_METADATA = "sqlite"
+
+
+class MetadataStore:
+    """Parent class for file metadata backends"""
+
+    def get(self, file_id):
+        """Return the record of file_id, None if it is unknown"""
+        raise NotImplementedError("This method must be implemented by the subclass")
+
+    def put(self, file_id, record):
+        """Insert or replace the record of file_id"""
+        raise NotImplementedError("This method must be implemented by the subclass")
+
+    def put_many(self, items):
+        """Insert or replace the records of a list of (file_id, record) pairs"""
+        for file_id, record in items:
+            self.put(file_id, record)
+
+    def delete(self, file_id):
+        raise NotImplementedError("This method must be implemented by the subclass")
+
+    def items(self):
+        """Iterate over all (file_id, record) pairs"""
+        raise NotImplementedError("This method must be implemented by the subclass")
+
+    def get_chunk(self, address):
+        """Return the record of a content-addressed fragment, None if it is unknown"""
+        raise NotImplementedError("This method must be implemented by the subclass")
+
+    def put_chunks(self, items):
+        """Insert or replace the records of a list of (address, chunk) pairs, a chunk of None deletes it"""
+        raise NotImplementedError("This method must be implemented by the subclass")
+
+    def get_epoch(self, epoch):
+        """Return the nodes of a membership epoch, None if it is unknown"""
+        raise NotImplementedError("This method must be implemented by the subclass")
+
+    def put_epoch(self, epoch, nodes):
+        raise NotImplementedError("This method must be implemented by the subclass")
+
+    def latest_epoch(self):
+        """Return (epoch, nodes) of the newest membership epoch, None if there is none"""
+        raise NotImplementedError("This method must be implemented by the subclass")
+
+    def clear(self):
+        raise NotImplementedError("This method must be implemented by the subclass")
+
+    def __len__(self):
+        raise NotImplementedError("This method must be implemented by the subclass")
+
+    def __contains__(self, file_id):
+        return self.get(file_id) is not None
+
+    def close(self):
+        pass
+
+
+class InMemoryMetadataStore(MetadataStore):
+    """Keeps metadata in a dict, lost when the lead node restarts"""
+
+    def __init__(self):
+        self.__files = {}
+        self.__chunks = {}
+        self.__epochs = {}
+        self.__lock = threading.Lock()
+
+    def get(self, file_id):
+        return self.__files.get(file_id)
+
+    def put(self, file_id, record):
+        with self.__lock:
+            self.__files[file_id] = record
+
+    def delete(self, file_id):
+        with self.__lock:
+            self.__files.pop(file_id, None)
+
+    def items(self):
+        return list(self.__files.items())
+
+    def get_chunk(self, address):
+        return self.__chunks.get(address)
+
+    def put_chunks(self, items):
+        with self.__lock:
+            for address, chunk in items:
+                if chunk is None:
+                    self.__chunks.pop(address, None)
+                else:
+                    self.__chunks[address] = chunk
+
+    def get_epoch(self, epoch):
+        return self.__epochs.get(epoch)
+
+    def put_epoch(self, epoch, nodes):
+        with self.__lock:
+            self.__epochs[epoch] = nodes
+
+    def latest_epoch(self):
+        with self.__lock:
+            if not self.__epochs:
+                return None
+            epoch = max(self.__epochs)
+            return epoch, self.__epochs[epoch]
+
+    def clear(self):
+        # Epochs are kept, the current one is still in use
+        with self.__lock:
+            self.__files = {}
+            self.__chunks = {}
+
+    def __len__(self):
+        return len(self.__files)
+
+
+class SQLiteMetadataStore(MetadataStore):
+    """Durable metadata in an embedded SQLite database.
+
+    Writes are queued to a single writer thread that commits them in batches, so
+    concurrent stores share one fsync. put and delete return once their batch is
+    committed, and raise IOError if it could not be. Reads use a per-thread
+    connection and never wait for the writer.
+    """
+
+    def __init__(self, path, commit_interval, max_batch):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.__path = path
+        self.__commit_interval = commit_interval
+        self.__max_batch = max_batch
+        self.__local = threading.local()
+
+        conn = self.__connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS files (file_id TEXT PRIMARY KEY, record TEXT NOT NULL)"
+        )
+        # Which files are on which node is kept by the lead node's FragmentIndex, an older
+        # database may still have a by-node table that nothing reads
+        conn.execute("DROP TABLE IF EXISTS file_nodes")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (address TEXT PRIMARY KEY, chunk TEXT NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS epochs (epoch INTEGER PRIMARY KEY, nodes TEXT NOT NULL)"
+        )
+        conn.commit()
+        self.__count = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        print(f"Loaded metadata for {self.__count} files from {path}")
+
+        self.__writes = queue.Queue()
+        self.__writer = threading.Thread(target=self.__write_loop, daemon=True)
+        self.__writer.start()
+
+    def __connection(self):
+        conn = getattr(self.__local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.__path)
+            conn.execute("PRAGMA synchronous=FULL")
+            self.__local.conn = conn
+        return conn
+
+    def get(self, file_id):
+        row = (
+            self.__connection()
+            .execute("SELECT record FROM files WHERE file_id = ?", (file_id,))
+            .fetchone()
+        )
+        return json.loads(row[0]) if row else None
+
+    def put(self, file_id, record):
+        self.__write([("put", file_id, record)])
+
+    def put_many(self, items):
+        # Queued together, so the records share as few commits as the batch size allows
+        self.__write([("put", file_id, record) for file_id, record in items])
+
+    def delete(self, file_id):
+        self.__write([("delete", file_id, None)])
+
+    def clear(self):
+        self.__write([("clear", None, None)])
+
+    def get_chunk(self, address):
+        row = (
+            self.__connection()
+            .execute("SELECT chunk FROM chunks WHERE address = ?", (address,))
+            .fetchone()
+        )
+        return json.loads(row[0]) if row else None
+
+    def put_chunks(self, items):
+        self.__write([("put_chunk", address, chunk) for address, chunk in items])
+
+    def get_epoch(self, epoch):
+        row = (
+            self.__connection()
+            .execute("SELECT nodes FROM epochs WHERE epoch = ?", (epoch,))
+            .fetchone()
+        )
+        return json.loads(row[0]) if row else None
+
+    def put_epoch(self, epoch, nodes):
+        self.__write([("put_epoch", epoch, nodes)])
+
+    def latest_epoch(self):
+        row = (
+            self.__connection()
+            .execute("SELECT epoch, nodes FROM epochs ORDER BY epoch DESC LIMIT 1")
+            .fetchone()
+        )
+        return (row[0], json.loads(row[1])) if row else None
+
+    def items(self):
+        cursor = self.__connection().execute("SELECT file_id, record FROM files")
+        for file_id, record in cursor:
+            yield file_id, json.loads(record)
+
+    def __len__(self):
+        return self.__count
+
+    def close(self):
+        self.__writes.put(None)
+        self.__writer.join()
+
+    def __write(self, ops):
+        """Queue ops for the writer and wait until they are committed, raising IOError if they were not"""
+        writes = []
+        for op in ops:
+            write = {"done": threading.Event(), "error": None}
+            self.__writes.put((op, write))
+            writes.append(write)
+        for write in writes:
+            write["done"].wait()
+        for write in writes:
+            if write["error"] is not None:
+                raise IOError(f"Failed to commit metadata: {write['error']}") from write["error"]
+
+    def __write_loop(self):
+        conn = self.__connection()
+        while True:
+            first = self.__writes.get()
+            if first is None:
+                return
+            batch = [first]
+            # Group commit: gather whatever else arrives shortly after the first write
+            while len(batch) < self.__max_batch:
+                try:
+                    item = self.__writes.get(timeout=self.__commit_interval)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.__writes.put(None)
+                    break
+                batch.append(item)
+
+            try:
+                with conn:
+                    for op, _ in batch:
+                        self.__apply(conn, *op)
+            except Exception as e:
+                print(f"Failed to commit {len(batch)} metadata writes: {e}")
+                # The whole batch was rolled back, so every write in it failed
+                for _, write in batch:
+                    write["error"] = e
+                try:
+                    self.__count = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+                except sqlite3.Error:
+                    pass
+            for _, write in batch:
+                write["done"].set()
+
+    def __apply(self, conn, kind, file_id, record):
+        if kind == "clear":
+            conn.execute("DELETE FROM files")
+            conn.execute("DELETE FROM chunks")
+            self.__count = 0
+            return
+        # Chunk writes carry the content address in place of the file_id
+        if kind == "put_chunk":
+            if record is None:
+                conn.execute("DELETE FROM chunks WHERE address = ?", (file_id,))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO chunks (address, chunk) VALUES (?, ?)",
+                    (file_id, json.dumps(record)),
+                )
+            return
+        # Epoch writes carry the epoch in place of the file_id and its nodes as the record
+        if kind == "put_epoch":
+            conn.execute(
+                "INSERT OR REPLACE INTO epochs (epoch, nodes) VALUES (?, ?)",
+                (file_id, json.dumps(record)),
+            )
+            return
+
+        existed = conn.execute(
+            "SELECT 1 FROM files WHERE file_id = ?", (file_id,)
+        ).fetchone()
+        if kind == "put":
+            conn.execute(
+                "INSERT OR REPLACE INTO files (file_id, record) VALUES (?, ?)",
+                (file_id, json.dumps(record)),
+            )
+            if not existed:
+                self.__count += 1
+        elif kind == "delete":
+            conn.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+            if existed:
+                self.__count -= 1
+
+
+def create_metadata_store(backend, path, commit_interval, max_batch):
+    if backend == IN_MEMORY_METADATA:
+        return InMemoryMetadataStore()
+    if backend == SQLITE_METADATA:
+        return SQLiteMetadataStore(path, commit_interval, max_batch)
+    raise NotImplementedError(f"Invalid metadata backend: {backend}")
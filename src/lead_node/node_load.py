@@ -0,0 +1,102 @@
+import math
+import threading
+import time
+
+
+class NodeLoad:
+    """Load of every storage node as seen by the lead node.
+
+    Keeps an EWMA of request latencies and the number of requests in flight per
+    node, plus the disk usage the nodes report, and combines them into a score
+    used to steer new fragments away from slow, busy or full nodes.
+    """
+
+    def __init__(self, alpha, min_free_fraction):
+        self.__alpha = alpha
+        self.__min_free_fraction = min_free_fraction
+        self.__lock = threading.Lock()
+        self.__latency = {}  # node name -> EWMA of request latency in seconds
+        # node name -> [requests in progress], a request counts down the list it counted up
+        self.__in_flight = {}
+        self.__disk = {}  # node name -> (free bytes, total bytes)
+
+    def call(self, node, fn, *args):
+        """Run fn(*args) as a request to node and return its result"""
+        in_flight = self.__start(node)
+        start = time.time()
+        try:
+            return fn(*args)
+        finally:
+            self.__finish(node, in_flight, time.time() - start)
+
+    async def call_async(self, node, fn, *args):
+        """Await fn(*args), a coroutine function making a request to node, and return its result"""
+        in_flight = self.__start(node)
+        start = time.time()
+        try:
+            return await fn(*args)
+        finally:
+            self.__finish(node, in_flight, time.time() - start)
+
+    def __start(self, node):
+        with self.__lock:
+            in_flight = self.__in_flight.setdefault(node["name"], [0])
+            in_flight[0] += 1
+        return in_flight
+
+    def __finish(self, node, in_flight, elapsed):
+        name = node["name"]
+        with self.__lock:
+            in_flight[0] -= 1
+            # Nothing is noted for a node that was forgotten while the request ran
+            if self.__in_flight.get(name) is in_flight:
+                old = self.__latency.get(name)
+                self.__latency[name] = (
+                    elapsed if old is None else self.__alpha * elapsed + (1 - self.__alpha) * old
+                )
+
+    def set_disk_usage(self, node, free, total):
+        with self.__lock:
+            self.__disk[node["name"]] = (free, total)
+
+    def forget(self, node):
+        """Drop what is known about a node that left the cluster"""
+        with self.__lock:
+            self.__latency.pop(node["name"], None)
+            self.__in_flight.pop(node["name"], None)
+            self.__disk.pop(node["name"], None)
+
+    def score(self, node):
+        """Expected cost of one more request to node, lower is better.
+
+        Nodes without latency samples are assumed to be as fast as the average node,
+        and nodes with less than min_free_fraction of their disk free are avoided.
+        """
+        name = node["name"]
+        with self.__lock:
+            latency = self.__latency.get(name)
+            if latency is None:
+                known = list(self.__latency.values())
+                latency = sum(known) / len(known) if known else 1.0
+            in_flight = self.__in_flight.get(name, [0])[0]
+            free, total = self.__disk.get(name, (None, None))
+        score = latency * (1 + in_flight)
+        if total:
+            free_fraction = free / total
+            if free_fraction < self.__min_free_fraction:
+                return math.inf
+            score /= free_fraction
+        return score
+
+    def stats(self):
+        with self.__lock:
+            names = set(self.__latency) | set(self.__in_flight) | set(self.__disk)
+            return {
+                name: {
+                    "latency": self.__latency.get(name),
+                    "in_flight": self.__in_flight.get(name, [0])[0],
+                    "free_bytes": self.__disk.get(name, (None, None))[0],
+                    "total_bytes": self.__disk.get(name, (None, None))[1],
+                }
+                for name in sorted(names)
+            }
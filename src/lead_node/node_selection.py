@@ -1,24 +1,100 @@
+import hashlib
 import random
 import math
 
 RANDOM_SELECTION = "random"
 MIN_COPY_SETS_SELECTION = "min_copy_sets"
 BUDDY_SELECTION = "buddy"
+RENDEZVOUS_SELECTION = "rendezvous"
+
+# Load-aware variants of the strategies above, by the strategy they place like
+LOAD_AWARE_SELECTION = "load_aware"
+LOAD_AWARE_MIN_COPY_SETS_SELECTION = "load_aware_min_copy_sets"
+LOAD_AWARE_BUDDY_SELECTION = "load_aware_buddy"
+LOAD_AWARE_SELECTIONS = {
+    LOAD_AWARE_SELECTION: RANDOM_SELECTION,
+    LOAD_AWARE_MIN_COPY_SETS_SELECTION: MIN_COPY_SETS_SELECTION,
+    LOAD_AWARE_BUDDY_SELECTION: BUDDY_SELECTION,
+}
 
 
 class NodeSelectionStrategy:
     """Parent class for node selection strategies"""
 
     def __init__(self, nodes, no_fragments, no_replicas):
-        self.nodes = nodes 
+        self.nodes = list(nodes)
         self.no_nodes = len(nodes)
         self.no_fragments = no_fragments
         self.no_replicas = no_replicas
 
-    def choose_nodes(self):
-        """Select <no_replicas> nodes for each fragment"""
+    def choose_nodes(self, file_id=None, no_fragments=None):
+        """Select <no_replicas> nodes for each of the no_fragments fragments of file_id.
+
+        no_fragments defaults to the strategy's no_fragments.
+        """
         raise NotImplementedError("This method must be implemented by the subclass")
 
+    def choose_replacement(self, holders):
+        """Select a node for a new copy of a fragment held by holders, None if there is none.
+
+        Subclasses prefer nodes in the same replication group as the holders.
+        """
+        names = {node["name"] for node in holders}
+        candidates = [node for node in self.nodes if node["name"] not in names]
+        return random.choice(candidates) if candidates else None
+
+    def replacement_in_groups(self, groups, holders):
+        """Select a node from the first group containing a holder that does not hold the fragment yet"""
+        names = {node["name"] for node in holders}
+        for group in groups:
+            if any(node["name"] in names for node in group):
+                candidates = [node for node in group if node["name"] not in names]
+                if candidates:
+                    return random.choice(candidates)
+        return NodeSelectionStrategy.choose_replacement(self, holders)
+
+    def add_node(self, node):
+        """Start placing fragments on a node that joined the cluster"""
+        self.nodes.append(node)
+        self.no_nodes = len(self.nodes)
+
+    def remove_node(self, node):
+        """Stop placing fragments on a node that left the cluster"""
+        if node in self.nodes:
+            self.nodes.remove(node)
+        self.no_nodes = len(self.nodes)
+
+    @staticmethod
+    def join_replication_groups(groups, spares, node, group_size):
+        """Put a joining node in the first group short of group_size.
+
+        If no group is short the node becomes a spare, and once there are
+        group_size spares they form a new group. Other groups are left as they are.
+        """
+        for group in groups:
+            if len(group) < group_size:
+                group.append(node)
+                return
+        spares.append(node)
+        if len(spares) >= group_size:
+            groups.append(spares[:group_size])
+            del spares[:group_size]
+
+    @staticmethod
+    def leave_replication_groups(groups, spares, node):
+        """Take a leaving node out of its group, filling its place with a spare if there is one"""
+        if node in spares:
+            spares.remove(node)
+            return
+        for group in groups:
+            if node in group:
+                idx = group.index(node)
+                if spares:
+                    group[idx] = spares.pop(0)
+                else:
+                    group.pop(idx)
+                return
+
     def initiate_replication_groups(self, no_groups, group_size):
         """Initiate the replication group for all nodes"""
         replication_groups = []
@@ -35,13 +111,34 @@ class NodeSelectionStrategy:
         return replication_groups, available_nodes
 
 
+def rendezvous_nodes(nodes, key, count):
+    """Return count nodes for key by highest random weight.
+
+    The same nodes and key always give the same result, and removing a node only
+    changes the result for keys that had it among their count nodes.
+    """
+    if not nodes:
+        raise ValueError("No nodes to place fragments on")
+    ranked = sorted(
+        nodes,
+        key=lambda node: hashlib.blake2b(
+            f"{key}/{node['name']}".encode("utf-8"), digest_size=8
+        ).digest(),
+        reverse=True,
+    )
+    # With fewer nodes than copies some node holds two copies, as with random selection
+    return [ranked[i % len(ranked)] for i in range(count)]
+
+
 class RandomSelection(NodeSelectionStrategy):
     """Selects nodes randomly"""
 
-    def choose_nodes(self):
+    def choose_nodes(self, file_id=None, no_fragments=None):
+        if not self.nodes:
+            raise ValueError("No nodes to place fragments on")
         chosen = []
         for _ in range(self.no_replicas):
-            selected_nodes = random.choices(self.nodes, k=self.no_fragments)
+            selected_nodes = random.choices(self.nodes, k=no_fragments or self.no_fragments)
             chosen.append(selected_nodes)
         return chosen
 
@@ -53,11 +150,39 @@ class MinCopySetsSelection(NodeSelectionStrategy):
         super().__init__(nodes, no_fragments, no_replicas)
         self.copy_sets = None
         self.available_nodes = None
+        self.spare_nodes = None
         self.__initiate_copy_sets()
 
-    def choose_nodes(self):
+    def add_node(self, node):
+        super().add_node(node)
+        self.join_replication_groups(self.copy_sets, self.spare_nodes, node, self.no_replicas)
+        self.__update_available_nodes()
+        print("Copy sets:", self.copy_sets)
+
+    def remove_node(self, node):
+        super().remove_node(node)
+        self.leave_replication_groups(self.copy_sets, self.spare_nodes, node)
+        self.__update_available_nodes()
+        print("Copy sets:", self.copy_sets)
+
+    def __update_available_nodes(self):
+        # Copy sets that lost a node are not used until a new node fills them
+        self.available_nodes = [
+            node
+            for copy_set in self.copy_sets
+            if len(copy_set) == self.no_replicas
+            for node in copy_set
+        ]
+
+    def choose_nodes(self, file_id=None, no_fragments=None):
+        if not self.available_nodes:
+            # Every copy set lost a node and no spare filled it, so they are formed again from the nodes left
+            self.__initiate_copy_sets()
+            if not self.available_nodes:
+                raise ValueError(f"Fewer than {self.no_replicas} nodes left for a copy set")
+
         # choose no_fragments nodes at random
-        primary_nodes = random.choices(self.available_nodes, k=self.no_fragments)
+        primary_nodes = random.choices(self.available_nodes, k=no_fragments or self.no_fragments)
 
         # find the copy sets that contain the primary nodes
         copy_sets = []
@@ -69,6 +194,10 @@ class MinCopySetsSelection(NodeSelectionStrategy):
         # return transpose of copy_sets
         return list(map(list, zip(*copy_sets)))
 
+    def choose_replacement(self, holders):
+        # The node that took the lost node's place in the copy set keeps the copy set intact
+        return self.replacement_in_groups(self.copy_sets, holders)
+
     def __initiate_copy_sets(self):
         """Initiate the copy sets for all nodes"""
 
@@ -76,6 +205,7 @@ class MinCopySetsSelection(NodeSelectionStrategy):
         self.copy_sets, self.available_nodes = self.initiate_replication_groups(
             no_copysets, self.no_replicas
         )
+        self.spare_nodes = [node for node in self.nodes if node not in self.available_nodes]
         print("Copy sets:", self.copy_sets)
 
 
@@ -85,11 +215,34 @@ class BuddySelection(NodeSelectionStrategy):
     def __init__(self, nodes, no_fragments, no_replicas):
         super().__init__(nodes, no_fragments, no_replicas)
         self.buddies = None
+        self.spare_nodes = None
+        self.group_size = None
         self.__initiate_buddies()
 
-    def choose_nodes(self):
-        # choose no_fragments buddy groups at random
-        buddy_groups = random.choices(range(len(self.buddies)), k=self.no_fragments)
+    def add_node(self, node):
+        super().add_node(node)
+        self.join_replication_groups(self.buddies, self.spare_nodes, node, self.group_size)
+        print("Buddies:", self.buddies)
+
+    def remove_node(self, node):
+        super().remove_node(node)
+        self.leave_replication_groups(self.buddies, self.spare_nodes, node)
+        print("Buddies:", self.buddies)
+
+    def choose_nodes(self, file_id=None, no_fragments=None):
+        # choose no_fragments buddy groups at random, skipping groups with too few nodes left
+        usable = [
+            idx for idx, buddies in enumerate(self.buddies) if len(buddies) >= self.no_replicas
+        ]
+        if not usable:
+            # Every group lost too many nodes, so they are formed again from the nodes left
+            self.__initiate_buddies()
+            usable = [
+                idx for idx, buddies in enumerate(self.buddies) if len(buddies) >= self.no_replicas
+            ]
+            if not usable:
+                raise ValueError(f"Fewer than {self.no_replicas} nodes left for a buddy group")
+        buddy_groups = random.choices(usable, k=no_fragments or self.no_fragments)
 
         # within each buddy group, choose no_replicas nodes at random for each fragment
         chosen = []
@@ -98,10 +251,76 @@ class BuddySelection(NodeSelectionStrategy):
             chosen.append(selected_nodes)
         return list(map(list, zip(*chosen)))
 
+    def choose_replacement(self, holders):
+        return self.replacement_in_groups(self.buddies, holders)
+
     def __initiate_buddies(self):
         """Initiate the replication group for all nodes"""
-        no_groups = math.floor(math.sqrt(self.no_nodes / self.no_replicas))
-        self.buddies, _ = self.initiate_replication_groups(
-            no_groups, self.no_nodes // no_groups
+        # At least one group, which is too small to use if there are fewer nodes than replicas
+        no_groups = max(1, math.floor(math.sqrt(self.no_nodes / self.no_replicas)))
+        self.group_size = self.no_nodes // no_groups
+        self.buddies, grouped_nodes = self.initiate_replication_groups(
+            no_groups, self.group_size
         )
+        self.spare_nodes = [node for node in self.nodes if node not in grouped_nodes]
         print("Buddies:", self.buddies)
+
+
+class LoadAwareSelection(NodeSelectionStrategy):
+    """Selects nodes by power of two choices over the placements of another strategy.
+
+    Two placements are drawn from the wrapped strategy for every fragment and the
+    one whose most loaded node scores lower is kept. Copy sets and buddy groups
+    are respected, while slow, busy or full nodes receive fewer fragments.
+    """
+
+    def __init__(self, placement, node_load):
+        super().__init__(placement.nodes, placement.no_fragments, placement.no_replicas)
+        self.placement = placement
+        self.node_load = node_load
+
+    def choose_nodes(self, file_id=None, no_fragments=None):
+        no_fragments = no_fragments or self.no_fragments
+        first = self.placement.choose_nodes(file_id, no_fragments)
+        second = self.placement.choose_nodes(file_id, no_fragments)
+        chosen = []
+        for frag_idx in range(no_fragments):
+            candidates = [
+                [replica[frag_idx] for replica in first],
+                [replica[frag_idx] for replica in second],
+            ]
+            chosen.append(min(candidates, key=self.__load))
+        return list(map(list, zip(*chosen)))
+
+    def choose_replacement(self, holders):
+        candidates = [self.placement.choose_replacement(holders) for _ in range(2)]
+        candidates = [node for node in candidates if node is not None]
+        if not candidates:
+            return None
+        return min(candidates, key=self.node_load.score)
+
+    def add_node(self, node):
+        super().add_node(node)
+        self.placement.add_node(node)
+
+    def remove_node(self, node):
+        super().remove_node(node)
+        self.placement.remove_node(node)
+
+    def __load(self, nodes):
+        return max(self.node_load.score(node) for node in nodes)
+
+
+class RendezvousSelection(NodeSelectionStrategy):
+    """Selects nodes by rendezvous hashing of (file_id, frag_idx) over the current nodes.
+
+    Placement is a function of the file_id and the nodes, so a file's record only
+    needs the membership epoch it was stored in to find its fragments again.
+    """
+
+    def choose_nodes(self, file_id=None, no_fragments=None):
+        columns = [
+            rendezvous_nodes(self.nodes, f"{file_id}/{frag_idx}", self.no_replicas)
+            for frag_idx in range(no_fragments or self.no_fragments)
+        ]
+        return list(map(list, zip(*columns)))
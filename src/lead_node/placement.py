@@ -0,0 +1,85 @@
+import threading
+
+from erasure_coding import ERASURE_CODING
+from node_selection import rendezvous_nodes
+
+
+class PlacementEpochs:
+    """Numbered snapshots of the storage node membership.
+
+    Files placed by rendezvous hashing store the epoch they were placed in rather
+    than their nodes. Their nodes are computed again from that epoch's members
+    when the record is read, and only fragments whose nodes differ from the
+    computed ones, e.g. after a repair, are kept in the record as overrides.
+    """
+
+    def __init__(self, metadata):
+        self.__metadata = metadata
+        self.__lock = threading.Lock()
+        self.__epochs = {}  # epoch -> nodes sorted by name
+        self.current = None
+        latest = metadata.latest_epoch()
+        if latest is not None:
+            self.current, nodes = latest
+            self.__epochs[self.current] = nodes
+
+    def advance(self, nodes):
+        """Start a new epoch with nodes as its members, unless they are the current members"""
+        nodes = sorted(nodes, key=lambda node: node["name"])
+        with self.__lock:
+            if self.current is not None and self.__epochs[self.current] == nodes:
+                return self.current
+            epoch = 0 if self.current is None else self.current + 1
+            self.__metadata.put_epoch(epoch, nodes)
+            self.__epochs[epoch] = nodes
+            self.current = epoch
+            return epoch
+
+    def nodes(self, epoch):
+        with self.__lock:
+            nodes = self.__epochs.get(epoch)
+        if nodes is None:
+            nodes = self.__metadata.get_epoch(epoch)
+            with self.__lock:
+                self.__epochs[epoch] = nodes
+        return nodes
+
+    def compact(self, file_id, record):
+        """Return record as it is stored, without the nodes rendezvous hashing computes again"""
+        if "epoch" not in record:
+            return record
+        computed = self.__computed(file_id, record)
+        overrides = {}
+        for frag_idx in range(len(computed[0])):
+            column = [replica[frag_idx] for replica in record["assigned_nodes"]]
+            if column != [replica[frag_idx] for replica in computed]:
+                overrides[str(frag_idx)] = column
+        stored = {key: value for key, value in record.items() if key != "assigned_nodes"}
+        if overrides:
+            stored["overrides"] = overrides
+        return stored
+
+    def resolve(self, file_id, record):
+        """Return a stored record with its assigned_nodes filled in"""
+        if record is None or "assigned_nodes" in record:
+            return record
+        assigned_nodes = self.__computed(file_id, record)
+        for frag_idx, column in record.get("overrides", {}).items():
+            for replica, node in zip(assigned_nodes, column):
+                replica[int(frag_idx)] = node
+        resolved = {key: value for key, value in record.items() if key != "overrides"}
+        resolved["assigned_nodes"] = assigned_nodes
+        return resolved
+
+    def __computed(self, file_id, record):
+        """The [replica][fragment] nodes rendezvous hashing gives the file in its epoch"""
+        nodes = self.nodes(record["epoch"])
+        if record["storage_mode"] == ERASURE_CODING:
+            # A stripe is placed like the replicas of one fragment
+            ec = record["ec"]
+            return [rendezvous_nodes(nodes, f"{file_id}/0", ec["k"] + ec["m"])]
+        columns = [
+            rendezvous_nodes(nodes, f"{file_id}/{frag_idx}", record["replicas"])
+            for frag_idx in range(record["no_fragments"])
+        ]
+        return list(map(list, zip(*columns)))
@@ -0,0 +1,297 @@
+import heapq
+import itertools
+import threading
+import time
+
+import compression
+import erasure_coding
+from checksum import checksum
+from erasure_coding import ERASURE_CODING
+from file_records import storage_key, pending_slots, is_compressed
+from storage_node_client import upload_fragment_to_node
+
+
+class RepairEngine:
+    """Background re-replication of fragments that lost copies.
+
+    Fragments are queued with the number of copies they have left and repaired
+    by a pool of workers, fewest copies first. The bytes copied by all workers
+    together are throttled to bytes_per_second, so repairs do not starve client
+    traffic after a node failure.
+    """
+
+    def __init__(self, repair_fragment, workers, bytes_per_second):
+        # repair_fragment(file_id, frag_idx) copies a fragment to replacement nodes and
+        # returns the bytes copied, None if it needed no repair, raising if it cannot
+        self.__repair_fragment = repair_fragment
+        self.__bytes_per_second = bytes_per_second
+        self.__cond = threading.Condition()
+        self.__queue = []  # heap of (surviving copies, sequence, file_id, frag_idx)
+        self.__queued = {}  # (file_id, frag_idx) -> surviving copies it is queued with
+        self.__sequence = itertools.count()
+        self.__in_progress = 0
+        self.__failed = {}  # (file_id, frag_idx) -> surviving copies when the repair failed
+        self.__repaired = 0
+        self.__bytes_copied = 0
+        self.__last_error = None
+        self.__bucket_lock = threading.Lock()
+        self.__bucket_time = time.time()
+        self.__bucket_debt = 0.0  # seconds of copying that are ahead of the rate limit
+        self.__workers = workers
+        for _ in range(workers):
+            threading.Thread(target=self.__work_loop, daemon=True).start()
+
+    def enqueue(self, fragments):
+        """Queue a list of (surviving copies, file_id, frag_idx) for repair.
+
+        A fragment that is already queued moves up if it has fewer copies left now.
+        """
+        with self.__cond:
+            for copies, file_id, frag_idx in fragments:
+                key = (file_id, frag_idx)
+                if self.__queued.get(key, copies + 1) <= copies:
+                    continue
+                self.__queued[key] = copies
+                self.__failed.pop(key, None)
+                heapq.heappush(self.__queue, (copies, next(self.__sequence), file_id, frag_idx))
+            self.__cond.notify_all()
+
+    def retry_failed(self):
+        """Queue the fragments whose repair failed again, e.g. after a node joined"""
+        with self.__cond:
+            failed = [(copies, *key) for key, copies in self.__failed.items()]
+        self.enqueue(failed)
+
+    def clear(self):
+        with self.__cond:
+            self.__queue = []
+            self.__queued = {}
+            self.__failed = {}
+
+    def status(self):
+        with self.__cond:
+            by_copies = {}
+            for copies in self.__queued.values():
+                by_copies[copies] = by_copies.get(copies, 0) + 1
+            return {
+                "queued": len(self.__queued),
+                "queued_by_surviving_copies": by_copies,
+                "in_progress": self.__in_progress,
+                "repaired": self.__repaired,
+                "failed": len(self.__failed),
+                "bytes_copied": self.__bytes_copied,
+                "last_error": self.__last_error,
+                "workers": self.__workers,
+                "bytes_per_second": self.__bytes_per_second,
+            }
+
+    def __next(self):
+        """Wait for and take the most urgent queued fragment"""
+        with self.__cond:
+            while True:
+                while self.__queue:
+                    copies, _, file_id, frag_idx = heapq.heappop(self.__queue)
+                    key = (file_id, frag_idx)
+                    # Entries superseded by a more urgent one for the same fragment are skipped
+                    if self.__queued.get(key) == copies:
+                        del self.__queued[key]
+                        self.__in_progress += 1
+                        return copies, key
+                self.__cond.wait()
+
+    def __work_loop(self):
+        while True:
+            copies, key = self.__next()
+            copied = None
+            try:
+                copied = self.__repair_fragment(*key)
+                if copied is not None:
+                    with self.__cond:
+                        self.__repaired += 1
+                        self.__bytes_copied += copied
+            except Exception as e:
+                print(f"Repair of fragment {key[1]} of {key[0]} failed: {e}")
+                with self.__cond:
+                    self.__failed[key] = copies
+                    self.__last_error = str(e)
+            finally:
+                with self.__cond:
+                    self.__in_progress -= 1
+            self.__throttle(copied or 0)
+
+    def __throttle(self, size):
+        """Sleep off the copying that is ahead of bytes_per_second"""
+        with self.__bucket_lock:
+            now = time.time()
+            self.__bucket_debt = max(0.0, self.__bucket_debt - (now - self.__bucket_time))
+            self.__bucket_time = now
+            self.__bucket_debt += size / self.__bytes_per_second
+            delay = self.__bucket_debt
+        if delay > 0:
+            time.sleep(delay)
+
+
+class FragmentRepair:
+    """Copies a fragment to replacement nodes in place of its copies on nodes that left.
+
+    get_record(file_id) returns a file's record and put_record(file_id, record)
+    stores it, both called under lock, which is held by everything that changes a
+    record after reading it. Files in writes_in_flight still have pending replicas
+    being uploaded. fetch_fragment(file_id, frag_idx, record) returns a verified
+    stored copy of a fragment, None if there is none, and
+    delete_fragments(fragments) deletes a dict of (node name, file_id, frag_idx) -> node.
+    """
+
+    def __init__(self, get_record, put_record, lock, writes_in_flight,
+                 fetch_fragment, delete_fragments, dedup, upload_engine, executor):
+        self.__get_record = get_record
+        self.__put_record = put_record
+        self.__lock = lock
+        self.__writes_in_flight = writes_in_flight
+        self.__fetch_fragment = fetch_fragment
+        self.__delete_fragments = delete_fragments
+        self.__dedup = dedup
+        self.__upload_engine = upload_engine
+        self.__executor = executor
+
+    def repair(self, file_id, frag_idx, storage_nodes, node_selector):
+        """Repair a fragment onto nodes chosen by node_selector among storage_nodes.
+
+        Pending copies whose background write is over were never confirmed, so they are replaced too.
+        Returns the bytes copied, None if the fragment has no missing copies.
+        """
+        record = self.__get_record(file_id)
+        if record is None:
+            return None  # Deleted since it was queued
+        live_nodes = {node["name"] for node in storage_nodes}
+        with self.__lock:
+            pending = set() if file_id in self.__writes_in_flight else pending_slots(record)
+        lost = [
+            replica_idx
+            for replica_idx, replica in enumerate(record["assigned_nodes"])
+            if replica[frag_idx]["name"] not in live_nodes or (replica_idx, frag_idx) in pending
+        ]
+        if not lost:
+            return None
+        if node_selector is None:
+            raise IOError("No node selection strategy to choose replacement nodes")
+
+        # The fragments of a stripe are placed like the replicas of one fragment
+        if record["storage_mode"] == ERASURE_CODING:
+            group = record["assigned_nodes"][0]
+        else:
+            group = [
+                replica[frag_idx]
+                for replica_idx, replica in enumerate(record["assigned_nodes"])
+                if (replica_idx, frag_idx) not in pending_slots(record)
+            ]
+        holders = [node for node in group if node["name"] in live_nodes]
+        key = storage_key(file_id, frag_idx, record)
+        # Deduplicated content may already be on other live nodes for another file
+        reusable = []
+        if "fragment_keys" in record:
+            reusable = [node for node in self.__dedup.holders(key[0]) if node["name"] in live_nodes]
+
+        replacements = {}
+        for replica_idx in lost:
+            names = {node["name"] for node in holders}
+            node = next((node for node in reusable if node["name"] not in names), None)
+            if node is None:
+                node = node_selector.choose_replacement(holders)
+            if node is None:
+                break
+            replacements[replica_idx] = node
+            holders.append(node)
+        if not replacements:
+            raise IOError(f"No replacement node for fragment {frag_idx} of {file_id}")
+
+        uploads = {
+            replica_idx: node for replica_idx, node in replacements.items() if node not in reusable
+        }
+        copied = 0
+        if uploads:
+            if record["storage_mode"] == ERASURE_CODING:
+                fragment = self.__rebuild_shard(file_id, frag_idx, record)
+            else:
+                fragment = self.__fetch_fragment(file_id, frag_idx, record)
+            if fragment is None:
+                raise IOError(f"No intact copy of fragment {frag_idx} of {file_id} left")
+            fragment_checksum = record["checksums"][frag_idx] if "checksums" in record else None
+            futures = {
+                replica_idx: self.__upload_engine.submit(
+                    node, upload_fragment_to_node,
+                    node, node["ip"], key[0], key[1], fragment, fragment_checksum,
+                )
+                for replica_idx, node in uploads.items()
+            }
+            for replica_idx, future in futures.items():
+                if future.result():
+                    copied += len(fragment)
+                else:
+                    del replacements[replica_idx]
+            if not replacements:
+                raise IOError(f"Uploads of fragment {frag_idx} of {file_id} to replacement nodes failed")
+
+        self.__record_repair(file_id, frag_idx, record, replacements)
+        print(f"Repaired fragment {frag_idx} of {file_id} onto {list(replacements.values())}")
+        return copied
+
+    def __record_repair(self, file_id, frag_idx, record, replacements):
+        """Point a file's record at the replacement nodes of a repaired fragment"""
+        key = storage_key(file_id, frag_idx, record)
+        with self.__lock:
+            current = self.__get_record(file_id)
+            if current is not None:
+                for replica_idx, node in replacements.items():
+                    replica = current["assigned_nodes"][replica_idx]
+                    # A slot that another repair already refilled is left alone
+                    if replica[frag_idx]["name"] == record["assigned_nodes"][replica_idx][frag_idx]["name"]:
+                        replica[frag_idx] = node
+                        confirm_slot(current, replica_idx, frag_idx)
+                if "fragment_keys" in current:
+                    self.__dedup.add_copies(
+                        key[0], list(replacements.values()), current["fragment_sizes"][frag_idx]
+                    )
+                self.__put_record(file_id, current)
+
+        if current is None and "fragment_keys" not in record:
+            # Deleted during the repair, so the new copies are not referenced
+            self.__delete_fragments(
+                {(node["name"], file_id, frag_idx): node for node in replacements.values()}
+            )
+
+    def __rebuild_shard(self, file_id, shard_idx, record):
+        """Rebuild a fragment of an erasure coded file from the fragments that are left"""
+        k, m = record["ec"]["k"], record["ec"]["m"]
+        futures = {
+            idx: self.__executor.submit(self.__fetch_fragment, file_id, idx, record)
+            for idx in range(k + m)
+            if idx != shard_idx
+        }
+        shards = {}
+        for idx, future in futures.items():
+            shard = future.result()
+            if shard is not None and is_compressed(record, idx):
+                shard = compression.decompress(record["compression"]["codec"], shard)
+            if shard is not None:
+                shards[idx] = shard
+        if len(shards) < k:
+            return None
+        data_shards = erasure_coding.decode(shards, k, m)
+        shard = erasure_coding.encode(b"".join(data_shards)[: record["size"]], k, m)[shard_idx]
+        if is_compressed(record, shard_idx):
+            # Compression is deterministic, so the shard compresses to the bytes that were stored
+            shard = compression.compress(record["compression"]["codec"], shard)
+        if "checksums" in record and checksum(shard) != record["checksums"][shard_idx]:
+            print(f"Rebuilt fragment {shard_idx} of {file_id} does not match its checksum")
+            return None
+        return shard
+
+
+def confirm_slot(record, replica_idx, frag_idx):
+    """Drop a slot from the pending slots of record"""
+    if "pending" not in record:
+        return
+    record["pending"] = [slot for slot in record["pending"] if tuple(slot) != (replica_idx, frag_idx)]
+    if not record["pending"]:
+        del record["pending"]
@@ -1,35 +1,198 @@
+import threading
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from config import NODE_POOL_SIZE, CONNECT_TIMEOUT, READ_TIMEOUT
+from framing import encode_records, iter_records
+
+TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+# One keep-alive session per storage node, keyed by pod name
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def open_node_pool(node):
+    """Create the connection pool for a storage node"""
+    with _sessions_lock:
+        if node["name"] not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=NODE_POOL_SIZE)
+            session.mount("http://", adapter)
+            _sessions[node["name"]] = session
+        return _sessions[node["name"]]
+
+def close_node_pool(node):
+    """Close the connection pool of a storage node that left the cluster"""
+    with _sessions_lock:
+        session = _sessions.pop(node["name"], None)
+    if session is not None:
+        session.close()
+
+def _session(node):
+    session = _sessions.get(node["name"])
+    if session is None:
+        session = open_node_pool(node)
+    return session
 
-def upload_fragment_to_node(node, node_ip, file_id, frag_idx, fragment):
-    """Upload a fragment to a storage node"""
+def upload_fragment_to_node(node, node_ip, file_id, frag_idx, fragment, checksum=None):
+    """Upload a fragment to a storage node, return True on success.
+
+    The node rejects the fragment if it does not match checksum.
+    """
     try:
         # node_ip = self.storage_nodes[node - 1]["ip"]
         url = f"http://{node_ip}:5000/upload_fragment?file_id={file_id}&frag_idx={frag_idx}"
-        r = requests.post(url, data=fragment)
+        headers = {"X-Checksum": checksum} if checksum else None
+        r = _session(node).post(url, data=fragment, headers=headers, timeout=TIMEOUT)
         if r.status_code != 200:
             print(
                 f"Failed to upload fragment {frag_idx} of {file_id} to {node}, status code={r.status_code}"
             )
-        else:
+            return False
+        print(
+            f"Successfully uploaded fragment {frag_idx} of {file_id} to {node}"
+        )
+        return True
+    except Exception as e:
+        print(f"Upload error for fragment {frag_idx} of {file_id} to {node}: {e}")
+        return False
+
+def upload_fragment_stream_to_node(node, node_ip, file_id, frag_idx, chunks):
+    """Upload a fragment to a storage node from an iterable of byte chunks.
+
+    Returns the checksum of the fragment as stored by the node, None on failure.
+    """
+    try:
+        url = f"http://{node_ip}:5000/upload_fragment?file_id={file_id}&frag_idx={frag_idx}"
+        # A generator body is sent with chunked transfer encoding
+        r = _session(node).post(url, data=chunks, timeout=TIMEOUT)
+        if r.status_code != 200:
             print(
-                f"Successfully uploaded fragment {frag_idx} of {file_id} to {node}"
+                f"Failed to stream fragment {frag_idx} of {file_id} to {node}, status code={r.status_code}"
             )
+            return None
+        print(
+            f"Successfully streamed fragment {frag_idx} of {file_id} to {node}"
+        )
+        return r.headers.get("X-Checksum")
     except Exception as e:
-        print(f"Upload error for fragment {frag_idx} of {file_id} to {node}: {e}")
+        print(f"Streaming upload error for fragment {frag_idx} of {file_id} to {node}: {e}")
+        return None
+
+def upload_fragments_to_node(node, node_ip, records, checksums=None):
+    """Upload a batch of (file_id, frag_idx, fragment) records in one request, return True on success.
+
+    checksums lists the checksum of every record, the node rejects the batch if one does not match.
+    """
+    url = f"http://{node_ip}:5000/upload_fragments"
+    try:
+        headers = {"X-Checksums": ",".join(checksums)} if checksums else None
+        r = _session(node).post(
+            url, data=encode_records(records), headers=headers, timeout=TIMEOUT
+        )
+        if r.status_code != 200:
+            print(
+                f"Failed to upload batch of {len(records)} fragments to {node}, status code={r.status_code}"
+            )
+            return False
+        print(f"Successfully uploaded batch of {len(records)} fragments to {node}")
+        return True
+    except Exception as e:
+        print(f"Upload error for batch of {len(records)} fragments to {node}: {e}")
+        return False
+
+def download_fragments_from_node(node, node_ip, keys):
+    """Download a batch of (file_id, frag_idx) fragments in one request.
+
+    Returns a dict from (file_id, frag_idx) to fragment holding the fragments the
+    node had, or None if the request failed.
+    """
+    url = f"http://{node_ip}:5000/get_fragments"
+    try:
+        body = encode_records((file_id, frag_idx, b"") for file_id, frag_idx in keys)
+        r = _session(node).post(url, data=body, timeout=TIMEOUT)
+        if r.status_code != 200:
+            print(
+                f"Failed to download batch of {len(keys)} fragments from {node}, status code={r.status_code}"
+            )
+            return None
+        fragments = {
+            (file_id, frag_idx): bytes(data)
+            for file_id, frag_idx, data in iter_records(r.content)
+            if data is not None
+        }
+        print(f"Downloaded {len(fragments)} of {len(keys)} batched fragments from {node}")
+        return fragments
+    except Exception as e:
+        print(f"Download error for batch of {len(keys)} fragments from {node}: {e}")
+    return None
+
+def get_node_stats(node, node_ip):
+    """Return a storage node's free and total disk bytes, None if it did not answer"""
+    url = f"http://{node_ip}:5000/stats"
+    try:
+        r = _session(node).get(url, timeout=TIMEOUT)
+        if r.status_code == 200:
+            return r.json()
+        print(f"Failed to get stats from {node}, status code={r.status_code}")
+    except Exception as e:
+        print(f"Stats error for {node}: {e}")
+    return None
 
-def download_fragment_from_node(node, node_ip, file_id, frag_idx):
-    """Download a fragment from a storage node"""
+def delete_fragment_from_node(node, node_ip, file_id, frag_idx):
+    """Delete a fragment from a storage node, return True if it was removed"""
+    url = f"http://{node_ip}:5000/delete_fragment?file_id={file_id}&frag_idx={frag_idx}"
+    try:
+        r = _session(node).delete(url, timeout=TIMEOUT)
+        if r.status_code == 200:
+            print(f"Deleted fragment {frag_idx} of {file_id} from {node}")
+            return True
+        print(
+            f"Failed to delete fragment {frag_idx} of {file_id} from {node}, status code={r.status_code}"
+        )
+    except Exception as e:
+        print(f"Delete error for fragment {frag_idx} of {file_id} from {node}: {e}")
+    return False
+
+def download_fragment_from_node(node, node_ip, file_id, frag_idx, cancel_event=None, byte_range=None):
+    """Download a fragment from a storage node, giving up early once cancel_event is set.
+
+    byte_range is an inclusive (first, last) pair to download only part of the fragment.
+    """
     # node_ip = self.storage_nodes[node - 1]["ip"]
     url = (
         f"http://{node_ip}:5000/get_fragment?file_id={file_id}&frag_idx={frag_idx}"
     )
     try:
-        r = requests.get(url)
+        headers = None
+        if byte_range is not None:
+            headers = {"Range": f"bytes={byte_range[0]}-{byte_range[1]}"}
+        r = _session(node).get(
+            url, headers=headers, stream=cancel_event is not None, timeout=TIMEOUT
+        )
+        if r.status_code == 206:
+            print(f"Downloaded bytes {byte_range[0]}-{byte_range[1]} of fragment {frag_idx} of {file_id} from {node}")
+            return r.content
         if r.status_code == 200:
+            if byte_range is not None:
+                # The node ignored the range and sent the whole fragment
+                return r.content[byte_range[0] : byte_range[1] + 1]
+            if cancel_event is None:
+                content = r.content
+            else:
+                chunks = []
+                for chunk in r.iter_content(64 * 1024):
+                    if cancel_event.is_set():
+                        r.close()
+                        print(f"Cancelled download of fragment {frag_idx} of {file_id} from {node}")
+                        return None
+                    chunks.append(chunk)
+                content = b"".join(chunks)
             print(
-                f"Downloaded fragment {frag_idx} of {file_id} from {node}, size={len(r.content)}"
+                f"Downloaded fragment {frag_idx} of {file_id} from {node}, size={len(content)}"
             )
-            return r.content
+            return content
         else:
             print(
                 f"Fragment {frag_idx} of {file_id} not found on {node}, status code={r.status_code}"
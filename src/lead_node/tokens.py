@@ -0,0 +1,28 @@
+import hashlib
+import hmac
+import time
+
+# Tokens let clients read and write fragments on the storage nodes directly. The
+# lead node signs the operation, the fragment and an expiry time with a secret
+# it shares with the storage nodes. A copy of this module lives in both.
+
+UPLOAD = "upload"
+DOWNLOAD = "download"
+
+
+def sign(secret, op, file_id, frag_idx, expires):
+    """Token allowing op on fragment frag_idx of file_id until the unix time expires"""
+    message = f"{op}/{file_id}/{frag_idx}/{expires}".encode()
+    mac = hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+    return f"{expires}.{mac}"
+
+
+def verify(secret, token, op, file_id, frag_idx):
+    """Whether token allows op on fragment frag_idx of file_id now"""
+    try:
+        expires = int(token.split(".", 1)[0])
+    except ValueError:
+        return False
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(token, sign(secret, op, file_id, frag_idx, expires))
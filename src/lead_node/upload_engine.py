@@ -0,0 +1,150 @@
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class UploadEngine:
+    """Shared, bounded pool of fragment upload workers.
+
+    No storage node receives more than per_node_limit concurrent uploads. Uploads
+    to a node that is at its limit wait in that node's queue rather than on a
+    worker, so a slow node never holds up uploads to the others. Callers block in
+    submit while max_queued uploads are waiting, which pushes back on incoming
+    stores instead of growing an unbounded backlog.
+
+    Uploads made on an event loop with run_async share the per-node limits but
+    wait on the loop rather than on a worker.
+    """
+
+    def __init__(self, workers, per_node_limit, max_queued, stream_workers, node_load=None):
+        self.__executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="upload"
+        )
+        self.__queued = threading.BoundedSemaphore(max_queued)
+        self.__per_node_limit = per_node_limit
+        # node name -> {"running": uploads holding a slot, "waiting": deque of start(slots) of queued uploads}
+        self.__node_slots = {}
+        self.__node_slots_lock = threading.Lock()
+        # Latency and in-flight uploads are reported to node_load if one is given
+        self.__node_load = node_load
+
+        # Streaming uploads wait on the request that feeds them, so they run on their
+        # own workers and all replicas of a fragment are only started together
+        self.__stream_executor = ThreadPoolExecutor(
+            max_workers=stream_workers, thread_name_prefix="stream-upload"
+        )
+        self.__stream_workers = stream_workers
+        self.__stream_free = stream_workers
+        self.__stream_cond = threading.Condition()
+
+    def submit(self, node, fn, *args):
+        """Schedule fn(*args) as an upload to node and return its future"""
+        self.__queued.acquire()
+        future = Future()
+        future.add_done_callback(lambda _: self.__queued.release())
+        self.__take_node_slot(
+            node, lambda slots: self.__executor.submit(self.__run, slots, future, node, fn, args)
+        )
+        return future
+
+    async def run_async(self, node, fn, *args):
+        """Await fn(*args), a coroutine function uploading to node, once node has a free slot"""
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def wake(slots):
+            if ready.done():
+                # The caller was cancelled while it waited, so the slot goes to the next upload
+                self.__release_node_slot(slots)
+            else:
+                ready.set_result(slots)
+
+        self.__take_node_slot(node, lambda slots: loop.call_soon_threadsafe(wake, slots))
+        try:
+            slots = await ready
+        except asyncio.CancelledError:
+            if not ready.cancelled():
+                # Cancelled after the slot was handed over but before it was taken
+                self.__release_node_slot(ready.result())
+            raise
+        try:
+            if self.__node_load is None:
+                return await fn(*args)
+            return await self.__node_load.call_async(node, fn, *args)
+        finally:
+            self.__release_node_slot(slots)
+
+    def __take_node_slot(self, node, start):
+        """Call start(slots) once node has a free slot, now or when one of its uploads finishes"""
+        with self.__node_slots_lock:
+            slots = self.__node_slots.setdefault(node["name"], {"running": 0, "waiting": deque()})
+            if slots["running"] >= self.__per_node_limit:
+                slots["waiting"].append(start)
+                return
+            slots["running"] += 1
+        start(slots)
+
+    def submit_streams(self, uploads):
+        """Start a list of (fn, args) streaming uploads at once and return their futures.
+
+        Blocks until there is a free stream worker for every upload, so a caller
+        never feeds an upload that is still waiting in the queue.
+        """
+        if len(uploads) > self.__stream_workers:
+            raise ValueError(
+                f"Cannot run {len(uploads)} streaming uploads on {self.__stream_workers} workers"
+            )
+        with self.__stream_cond:
+            self.__stream_cond.wait_for(lambda: self.__stream_free >= len(uploads))
+            self.__stream_free -= len(uploads)
+
+        futures = []
+        for fn, args in uploads:
+            future = self.__stream_executor.submit(fn, *args)
+            future.add_done_callback(self.__release_stream_worker)
+            futures.append(future)
+        return futures
+
+    def __release_stream_worker(self, _):
+        with self.__stream_cond:
+            self.__stream_free += 1
+            self.__stream_cond.notify_all()
+
+    def __run(self, slots, future, node, fn, args):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    if self.__node_load is None:
+                        result = fn(*args)
+                    else:
+                        result = self.__node_load.call(node, fn, *args)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+        finally:
+            self.__release_node_slot(slots)
+
+    def __release_node_slot(self, slots):
+        """Hand a finished upload's slot to the next upload waiting for the same node"""
+        with self.__node_slots_lock:
+            if not slots["waiting"]:
+                slots["running"] -= 1
+                return
+            start = slots["waiting"].popleft()
+        start(slots)
+
+    def forget_node(self, node):
+        """Drop the concurrency slots of a node that left the cluster.
+
+        Uploads still waiting for the node are started, they fail fast now that it is gone.
+        """
+        with self.__node_slots_lock:
+            slots = self.__node_slots.pop(node["name"], None)
+            waiting = list(slots["waiting"]) if slots else []
+            if slots:
+                slots["waiting"].clear()
+                slots["running"] += len(waiting)
+        for start in waiting:
+            start(slots)
@@ -0,0 +1,75 @@
+import threading
+
+
+class WriteQuorum:
+    """Acknowledged replicas of files that are being uploaded.
+
+    A file is written once quorum replicas of each of its fragments are
+    acknowledged. Acknowledgements come per node and cover every replica of the
+    fragment placed on that node.
+    """
+
+    def __init__(self, files, quorum):
+        # files is a dict of file_id -> assigned_nodes
+        self.__cond = threading.Condition()
+        self.__files = files
+        self.__slots = {}  # (node name, file_id, frag_idx) -> replica indices on that node
+        self.__acked = {}  # file_id -> set of (replica_idx, frag_idx)
+        self.__counts = {}  # file_id -> acknowledged replicas per fragment
+        self.__short = {}  # file_id -> fragments short of quorum
+        self.__quorums = {}
+        self.__written = None
+        self.__finished = False
+        for file_id, assigned_nodes in files.items():
+            for replica_idx, replica in enumerate(assigned_nodes):
+                for frag_idx, node in enumerate(replica):
+                    self.__slots.setdefault((node["name"], file_id, frag_idx), []).append(replica_idx)
+            self.__acked[file_id] = set()
+            self.__counts[file_id] = [0] * len(assigned_nodes[0])
+            self.__short[file_id] = len(assigned_nodes[0])
+            self.__quorums[file_id] = min(quorum, len(assigned_nodes))
+
+    def ack(self, name, keys):
+        """Acknowledge the (file_id, frag_idx) fragments written to the node called name"""
+        with self.__cond:
+            for file_id, frag_idx in keys:
+                for replica_idx in self.__slots.get((name, file_id, frag_idx), ()):
+                    slot = (replica_idx, frag_idx)
+                    if slot in self.__acked[file_id]:
+                        continue
+                    self.__acked[file_id].add(slot)
+                    self.__counts[file_id][frag_idx] += 1
+                    if self.__counts[file_id][frag_idx] == self.__quorums[file_id]:
+                        self.__short[file_id] -= 1
+            self.__cond.notify_all()
+
+    def finish(self):
+        """Note that every upload is over, successful or not"""
+        with self.__cond:
+            self.__finished = True
+            self.__cond.notify_all()
+
+    def wait(self):
+        """Block until every file has quorum or the uploads are over, return the files with quorum"""
+        with self.__cond:
+            self.__cond.wait_for(lambda: self.__finished or not any(self.__short.values()))
+            self.__written = {file_id for file_id, short in self.__short.items() if not short}
+            return self.__written
+
+    def written(self):
+        """Files that had quorum when wait returned"""
+        return self.__written or set()
+
+    def assigned_nodes(self, file_id):
+        return self.__files[file_id]
+
+    def pending(self, file_id):
+        """Replica slots of file_id that are not acknowledged, as [replica_idx, frag_idx] lists"""
+        with self.__cond:
+            assigned_nodes = self.__files[file_id]
+            return [
+                [replica_idx, frag_idx]
+                for replica_idx in range(len(assigned_nodes))
+                for frag_idx in range(len(assigned_nodes[0]))
+                if (replica_idx, frag_idx) not in self.__acked[file_id]
+            ]
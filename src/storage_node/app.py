@@ -1,31 +1,348 @@
-from flask import Flask, request, send_file
+from flask import Flask, Response, request, send_file, jsonify
+from werkzeug.serving import WSGIRequestHandler
 import os
+import shutil
+import tempfile
+import threading
+import uuid
+from contextlib import nullcontext
+
+from segment_store import SegmentStore
+from framing import encode_records, iter_records
+from checksum import Checksum, checksum
+from scrubber import Scrubber
+import tokens
 
 app = Flask(__name__)
 
 storage_dir = "./data"
+CHUNK_SIZE = 64 * 1024
 if not os.path.exists(storage_dir):
     os.makedirs(storage_dir)
 
+# "files" stores every fragment as its own file, "segments" appends fragments to
+# large segment files, which avoids one inode and one open per small fragment
+STORAGE_ENGINE = os.environ.get("STORAGE_ENGINE", "files")
+SEGMENT_SIZE = int(os.environ.get("SEGMENT_SIZE", 64 * 1024 * 1024))
+COMPACTION_INTERVAL = float(os.environ.get("COMPACTION_INTERVAL", 30))
+COMPACTION_THRESHOLD = float(os.environ.get("COMPACTION_THRESHOLD", 0.5))
+# Segment appends are fsynced before an upload is acknowledged, so a fragment the
+# lead node counts as stored survives a crash of the node. SEGMENT_FSYNC=0 trades
+# that for write throughput: a crash can then lose the last acknowledged
+# fragments, and reads of them fail over to other replicas until they are repaired.
+SEGMENT_FSYNC = os.environ.get("SEGMENT_FSYNC", "1") == "1"
+# Uploads to the segment engine are buffered in memory up to this size, larger
+# ones in a temporary file, until their checksum is verified
+SEGMENT_SPOOL_SIZE = int(os.environ.get("SEGMENT_SPOOL_SIZE", 1024 * 1024))
+
+# Background scrubbing re-verifies every stored fragment against its checksum,
+# reading at most SCRUB_BYTES_PER_SEC and starting a pass every SCRUB_INTERVAL seconds
+SCRUB_BYTES_PER_SEC = int(os.environ.get("SCRUB_BYTES_PER_SEC", 8 * 1024 * 1024))
+SCRUB_INTERVAL = float(os.environ.get("SCRUB_INTERVAL", 3600))
+
+# Clients may read and write fragments directly with tokens the lead node signs
+# with TOKEN_SECRET. Without a secret the /direct endpoints refuse every request.
+TOKEN_SECRET = os.environ.get("TOKEN_SECRET")
+
+segment_store = None
+if STORAGE_ENGINE == "segments":
+    segment_store = SegmentStore(
+        os.path.join(storage_dir, "segments"), SEGMENT_SIZE, COMPACTION_INTERVAL, COMPACTION_THRESHOLD,
+        SEGMENT_FSYNC,
+    )
+
+# Write-once uploads look for an existing fragment and store theirs under this
+# lock, so two of them cannot both find the fragment missing
+write_once_lock = threading.Lock()
+
+class ChecksumMismatch(Exception):
+    pass
+
+class FragmentExists(Exception):
+    def __init__(self, checksum):
+        super().__init__(checksum)
+        self.checksum = checksum
+
+def write_fragment(file_id, frag_idx, chunks, expected=None, write_once=False):
+    """Store a fragment given as an iterable of byte chunks and return its checksum.
+
+    Raises ChecksumMismatch, without storing anything, if the data does not match
+    the expected checksum. With write_once, raises FragmentExists, without storing
+    anything, if the fragment is already stored.
+    """
+    key = f"{file_id}_{frag_idx}"
+    running = Checksum()
+    if segment_store is not None:
+        # The upload is verified before any of it is appended, and copied to the segment chunk by chunk
+        with tempfile.SpooledTemporaryFile(SEGMENT_SPOOL_SIZE, dir=storage_dir) as spool:
+            for chunk in chunks:
+                running.update(chunk)
+                spool.write(chunk)
+            if expected is not None and running.hexdigest() != expected:
+                raise ChecksumMismatch(f"{key}: checksum {running.hexdigest()}, expected {expected}")
+            length = spool.tell()
+            spool.seek(0)
+            with write_once_lock if write_once else nullcontext():
+                if write_once:
+                    existing = existing_checksum(file_id, frag_idx)
+                    if existing is not None:
+                        raise FragmentExists(existing)
+                segment_store.put(
+                    key, iter(lambda: spool.read(CHUNK_SIZE), b""), length, running.hexdigest()
+                )
+        scrubber.forget(key)
+        return running.hexdigest()
+    path = os.path.join(storage_dir, key)
+    # Write chunks to disk as they come so large or chunked uploads are never held
+    # in memory, and only expose the fragment under its final name once it is complete
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        for chunk in chunks:
+            running.update(chunk)
+            f.write(chunk)
+    if expected is not None and running.hexdigest() != expected:
+        os.remove(tmp_path)
+        raise ChecksumMismatch(f"{key}: checksum {running.hexdigest()}, expected {expected}")
+    with write_once_lock if write_once else nullcontext():
+        if write_once:
+            existing = existing_checksum(file_id, frag_idx)
+            if existing is not None:
+                os.remove(tmp_path)
+                raise FragmentExists(existing)
+        # The checksum sidecar is replaced first, a reader never sees new data with an old checksum
+        tmp_checksum_path = f"{path}.crc.{uuid.uuid4().hex}.tmp"
+        with open(tmp_checksum_path, "w") as f:
+            f.write(running.hexdigest())
+        os.replace(tmp_checksum_path, f"{path}.crc")
+        os.replace(tmp_path, path)
+    scrubber.forget(key)
+    return running.hexdigest()
+
+def stored_checksum(path):
+    """Checksum of a fragment file, None for fragments stored without one"""
+    try:
+        with open(f"{path}.crc") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def existing_checksum(file_id, frag_idx):
+    """Checksum of a stored fragment, "" for one stored without a checksum, None if there is none"""
+    key = f"{file_id}_{frag_idx}"
+    if segment_store is not None:
+        return segment_store.checksum(key)
+    path = os.path.join(storage_dir, key)
+    if not os.path.exists(path):
+        return None
+    return stored_checksum(path) or ""
+
+def read_fragment(file_id, frag_idx):
+    """Return a stored fragment as a bytes-like object and its checksum, None if it does not exist or is corrupt"""
+    key = f"{file_id}_{frag_idx}"
+    if scrubber.is_corrupt(key):
+        return None
+    if segment_store is not None:
+        return segment_store.get(key)
+    path = os.path.join(storage_dir, key)
+    try:
+        with open(path, "rb") as f:
+            return f.read(), stored_checksum(path)
+    except FileNotFoundError:
+        return None
+
+def list_fragments():
+    if segment_store is not None:
+        return segment_store.keys()
+    return [
+        name
+        for name in os.listdir(storage_dir)
+        if not name.endswith((".crc", ".tmp")) and os.path.isfile(os.path.join(storage_dir, name))
+    ]
+
+def fragment_chunks(key):
+    """Return a fragment as (chunks, checksum) for the scrubber, None if it does not exist"""
+    if segment_store is not None:
+        stored = segment_store.get(key)
+        if stored is None:
+            return None
+        data, crc = stored
+        return [data], crc
+    path = os.path.join(storage_dir, key)
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+
+    def chunks():
+        with f:
+            yield from iter(lambda: f.read(CHUNK_SIZE), b"")
+    return chunks(), stored_checksum(path)
+
+def view_chunks(view):
+    """Send a memoryview of a segment in CHUNK_SIZE pieces, the WSGI server wants bytes"""
+    for start in range(0, len(view), CHUNK_SIZE):
+        yield bytes(view[start : start + CHUNK_SIZE])
+
+scrubber = Scrubber(list_fragments, fragment_chunks, SCRUB_BYTES_PER_SEC, SCRUB_INTERVAL)
+
 @app.route('/upload_fragment', methods=['POST'])
 def upload_fragment():
     file_id = request.args.get('file_id')
     frag_idx = request.args.get('frag_idx')
-    fragment = request.data
-    path = os.path.join(storage_dir, f"{file_id}_{frag_idx}")
-    with open(path, "wb") as f:
-        f.write(fragment)
+    try:
+        crc = write_fragment(
+            file_id, frag_idx,
+            iter(lambda: request.stream.read(CHUNK_SIZE), b""),
+            request.headers.get("X-Checksum"),
+        )
+    except ChecksumMismatch as e:
+        print(f"Rejected upload of {e}")
+        return "Checksum mismatch", 400
+    return "OK", 200, {"X-Checksum": crc}
+
+@app.route('/upload_fragments', methods=['POST'])
+def upload_fragments():
+    """Store a batch of framed (file_id, frag_idx, data) records.
+
+    The X-Checksums header lists the expected checksum of every record in order.
+    The batch is rejected as a whole if any record does not match.
+    """
+    records = list(iter_records(request.get_data()))
+    expected = request.headers.get("X-Checksums")
+    if expected is not None:
+        for (file_id, frag_idx, data), crc in zip(records, expected.split(",")):
+            if checksum(data) != crc:
+                print(f"Rejected batch, fragment {frag_idx} of {file_id} does not match its checksum")
+                return "Checksum mismatch", 400
+    for file_id, frag_idx, data in records:
+        write_fragment(file_id, frag_idx, [data])
+    print(f"Stored batch of {len(records)} fragments")
     return "OK"
 
+@app.route('/get_fragments', methods=['POST'])
+def get_fragments():
+    """Return the fragments named by a batch of framed records, marking missing ones"""
+    records = []
+    for file_id, frag_idx, _ in iter_records(request.get_data()):
+        stored = read_fragment(file_id, frag_idx)
+        records.append((file_id, frag_idx, None if stored is None else stored[0]))
+    return Response(encode_records(records), mimetype="application/octet-stream")
+
 @app.route('/get_fragment', methods=['GET'])
 def get_fragment():
     file_id = request.args.get('file_id')
     frag_idx = request.args.get('frag_idx')
-    path = os.path.join(storage_dir, f"{file_id}_{frag_idx}")
+    key = f"{file_id}_{frag_idx}"
+    if scrubber.is_corrupt(key):
+        return "Corrupt", 404
+    if segment_store is not None:
+        # A single byte range is served from the segment directly, other requests get the whole fragment
+        length = segment_store.length(key)
+        if length is not None and request.range is not None and len(request.range.ranges) == 1:
+            byte_range = request.range.range_for_length(length)
+            if byte_range is None:
+                return "Range Not Satisfiable", 416, {"Content-Range": f"bytes */{length}"}
+            start, stop = byte_range
+            fragment = segment_store.get_range(key, start, stop)
+            if fragment is not None:
+                return Response(
+                    view_chunks(fragment), status=206, mimetype="application/octet-stream",
+                    headers={"Content-Range": f"bytes {start}-{stop - 1}/{length}",
+                             "Content-Length": len(fragment)},
+                )
+        stored = segment_store.get(key)
+        if stored is None:
+            return "Not Found", 404
+        fragment, crc = stored
+        return Response(
+            view_chunks(fragment), mimetype="application/octet-stream",
+            headers={"X-Checksum": crc, "Accept-Ranges": "bytes", "Content-Length": len(fragment)},
+        )
+    path = os.path.join(storage_dir, key)
     if os.path.exists(path):
-        return send_file(path, as_attachment=False)
+        # conditional lets send_file answer Range requests with only the requested bytes
+        response = send_file(path, as_attachment=False, conditional=True)
+        crc = stored_checksum(path)
+        if crc is not None:
+            response.headers["X-Checksum"] = crc
+        return response
     else:
         return "Not Found", 404
 
+@app.route('/delete_fragment', methods=['DELETE'])
+def delete_fragment():
+    file_id = request.args.get('file_id')
+    frag_idx = request.args.get('frag_idx')
+    key = f"{file_id}_{frag_idx}"
+    scrubber.forget(key)
+    if segment_store is not None:
+        if not segment_store.delete(key):
+            return "Not Found", 404
+        return "OK"
+    path = os.path.join(storage_dir, key)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return "Not Found", 404
+    try:
+        os.remove(f"{path}.crc")
+    except FileNotFoundError:
+        pass
+    return "OK"
+
+def authorized(op):
+    """Whether the request's X-Token allows op on the fragment in its arguments"""
+    token = request.headers.get("X-Token")
+    if not TOKEN_SECRET or not token:
+        return False
+    return tokens.verify(
+        TOKEN_SECRET, token, op, request.args.get('file_id'), request.args.get('frag_idx')
+    )
+
+@app.route('/direct/upload_fragment', methods=['POST'])
+def direct_upload_fragment():
+    """Store a fragment sent by a client with an upload token from the lead node"""
+    if not authorized(tokens.UPLOAD):
+        return "Forbidden", 403
+    # Tokens stay valid until they expire, so direct uploads are write-once and a
+    # token cannot be replayed to overwrite a fragment once its file is committed
+    expected = request.headers.get("X-Checksum")
+    if expected is None:
+        return "X-Checksum required", 400
+    try:
+        crc = write_fragment(
+            request.args.get('file_id'), request.args.get('frag_idx'),
+            iter(lambda: request.stream.read(CHUNK_SIZE), b""),
+            expected, write_once=True,
+        )
+    except ChecksumMismatch as e:
+        print(f"Rejected direct upload of {e}")
+        return "Checksum mismatch", 400
+    except FragmentExists as e:
+        # A client retrying an upload that already succeeded gets the same reply
+        if e.checksum == expected:
+            return "OK", 200, {"X-Checksum": e.checksum}
+        return "Fragment already stored", 409
+    return "OK", 200, {"X-Checksum": crc}
+
+@app.route('/direct/get_fragment', methods=['GET'])
+def direct_get_fragment():
+    """Return a fragment to a client with a download token from the lead node"""
+    if not authorized(tokens.DOWNLOAD):
+        return "Forbidden", 403
+    return get_fragment()
+
+@app.route('/scrub_report', methods=['GET'])
+def scrub_report():
+    return jsonify(scrubber.report())
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    # The lead node places fewer fragments on nodes that are running out of space
+    usage = shutil.disk_usage(storage_dir)
+    return jsonify({"free_bytes": usage.free, "total_bytes": usage.total})
+
 if __name__ == '__main__':
+    # HTTP/1.1 keeps connections from the lead node's pools alive between requests
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,37 @@
+import struct
+
+# Length-prefixed framing for batched fragment transfers. Each record is a header
+# (status, file_id length, frag_idx, data length) followed by file_id and data.
+# A copy of this module lives in both the lead node and the storage node.
+RECORD_HEADER = struct.Struct(">BHIQ")
+FOUND = 0
+MISSING = 1
+
+
+def encode_records(records):
+    """Frame (file_id, frag_idx, data) records, a data of None marks a missing fragment"""
+    parts = []
+    for file_id, frag_idx, data in records:
+        file_id_bytes = file_id.encode("utf-8")
+        status = MISSING if data is None else FOUND
+        data = b"" if data is None else data
+        parts.append(RECORD_HEADER.pack(status, len(file_id_bytes), int(frag_idx), len(data)))
+        parts.append(file_id_bytes)
+        parts.append(data)
+    return b"".join(parts)
+
+
+def iter_records(body):
+    """Yield the (file_id, frag_idx, data) records of a framed body without copying the data"""
+    view = memoryview(body)
+    pos = 0
+    while pos < len(view):
+        status, file_id_len, frag_idx, data_len = RECORD_HEADER.unpack_from(view, pos)
+        pos += RECORD_HEADER.size
+        file_id = bytes(view[pos : pos + file_id_len]).decode("utf-8")
+        pos += file_id_len
+        if pos + data_len > len(view):
+            raise ValueError("Truncated record in framed body")
+        data = view[pos : pos + data_len] if status == FOUND else None
+        pos += data_len
+        yield file_id, frag_idx, data
@@ -0,0 +1,99 @@
+import threading
+import time
+
+from checksum import Checksum
+
+
+class Scrubber:
+    """Background thread that re-reads every stored fragment and checks its checksum.
+
+    Reading is throttled to bytes_per_second so scrubbing does not compete with
+    client traffic, and a full pass starts every interval seconds. Fragments that
+    fail the check are remembered as corrupt until they are written again.
+    """
+
+    def __init__(self, list_fragments, read_fragment, bytes_per_second, interval):
+        # list_fragments() returns the keys of all fragments, read_fragment(key)
+        # returns (chunks, stored checksum) or None if the fragment is gone
+        self.__list_fragments = list_fragments
+        self.__read_fragment = read_fragment
+        self.__bytes_per_second = bytes_per_second
+        self.__lock = threading.Lock()
+        self.__corrupt = {}  # key -> time the corruption was found
+        self.__passes = 0
+        self.__fragments_checked = 0
+        self.__bytes_checked = 0
+        self.__last_pass = None
+        self.__thread = threading.Thread(
+            target=self.__scrub_loop, daemon=True, args=(interval,)
+        )
+        self.__thread.start()
+
+    def is_corrupt(self, key):
+        return key in self.__corrupt
+
+    def forget(self, key):
+        """Clear a fragment's corrupt mark after it was overwritten or deleted"""
+        with self.__lock:
+            self.__corrupt.pop(key, None)
+
+    def report(self):
+        with self.__lock:
+            return {
+                "passes": self.__passes,
+                "fragments_checked": self.__fragments_checked,
+                "bytes_checked": self.__bytes_checked,
+                "last_pass_finished": self.__last_pass,
+                "corrupt": sorted(self.__corrupt),
+            }
+
+    def __scrub_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.scrub()
+            except Exception as e:
+                print(f"Scrub failed: {e}")
+
+    def scrub(self):
+        """Check every stored fragment once"""
+        start = time.time()
+        budget_start, budget_bytes = time.time(), 0
+        corrupt = 0
+        for key in self.__list_fragments():
+            size, ok = self.__check(key)
+            # A fragment that was rewritten while it was read can look corrupt, so check twice
+            if ok is False:
+                size, ok = self.__check(key)
+            budget_bytes += size
+            with self.__lock:
+                self.__fragments_checked += 1
+                self.__bytes_checked += size
+                if ok is False:
+                    if key not in self.__corrupt:
+                        print(f"Fragment {key} is corrupt")
+                        self.__corrupt[key] = time.time()
+                    corrupt += 1
+            # Sleep off whatever was read ahead of the rate limit
+            ahead = budget_bytes / self.__bytes_per_second - (time.time() - budget_start)
+            if ahead > 0:
+                time.sleep(ahead)
+        with self.__lock:
+            self.__passes += 1
+            self.__last_pass = time.time()
+        print(f"Scrub pass finished in {time.time() - start:.1f}s, {corrupt} corrupt fragments")
+
+    def __check(self, key):
+        """Return the bytes read and whether the fragment matches its checksum, None if unknown"""
+        stored = self.__read_fragment(key)
+        if stored is None:
+            return 0, None  # Deleted since the listing
+        chunks, expected = stored
+        running = Checksum()
+        size = 0
+        for chunk in chunks:
+            running.update(chunk)
+            size += len(chunk)
+        if expected is None:
+            return size, None
+        return size, running.hexdigest() == expected
@@ -0,0 +1,282 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Record: magic, kind, key length, data length, data checksum, followed by the key
+# and the data
+RECORD_HEADER = struct.Struct(">4sBHQI")
+RECORD_MAGIC = b"FRG2"
+PUT = 0
+DELETE = 1
+
+# Sealed segments end with an index of their records (an entry plus the key for
+# each record) followed by the trailer
+FOOTER_ENTRY = struct.Struct(">BHQQI")
+FOOTER_TRAILER = struct.Struct(">Q8s")
+FOOTER_MAGIC = b"SEGFOOT2"
+
+
+class SegmentStore:
+    """Append-only fragment store that packs many fragments into large segment files.
+
+    Fragments are appended to the active segment and located through an in-memory
+    index of key -> (segment, offset, length). A full segment is sealed with a
+    footer listing its records, so startup rebuilds the index from footers and
+    only scans the unsealed tail. A background thread rewrites the live records
+    of mostly dead segments and removes them.
+
+    Reads return memoryviews into a read-only mmap of the segment, so a fragment
+    is not copied until it is sent. With fsync, every put and delete is on disk
+    before it returns.
+    """
+
+    def __init__(self, directory, segment_size, compaction_interval, compaction_threshold, fsync=True):
+        self.__directory = directory
+        self.__segment_size = segment_size
+        self.__compaction_threshold = compaction_threshold
+        self.__fsync = fsync
+        self.__lock = threading.Lock()
+        self.__index = {}  # key -> (segment_id, data offset, data length, checksum)
+        self.__segment_keys = {}  # segment_id -> keys whose latest put is in it
+        self.__segment_tombstones = {}  # segment_id -> keys deleted by it
+        self.__segment_sizes = {}
+        # segment_id -> mmap of the segment, replaced by a longer one as the active segment grows.
+        # Views handed out keep a dropped mmap alive until they are released.
+        self.__maps = {}
+        os.makedirs(directory, exist_ok=True)
+
+        self.__load()
+        self.__compactor = threading.Thread(
+            target=self.__compact_loop, daemon=True, args=(compaction_interval,)
+        )
+        self.__compactor.start()
+
+    def put(self, key, chunks, length, checksum):
+        """Store a fragment of length bytes, given as an iterable of byte chunks, with its hex checksum"""
+        with self.__lock:
+            self.__append(PUT, key, chunks, length, int(checksum, 16))
+
+    def get(self, key):
+        """Return a memoryview of the fragment stored under key and its checksum, None if there is none"""
+        with self.__lock:
+            location = self.__index.get(key)
+            if location is None:
+                return None
+            segment_id, offset, length, crc = location
+            return self.__view(segment_id, offset, length), f"{crc:08x}"
+
+    def length(self, key):
+        """Return the length of the fragment stored under key, None if there is none"""
+        with self.__lock:
+            location = self.__index.get(key)
+        return None if location is None else location[2]
+
+    def checksum(self, key):
+        """Return the hex checksum of the fragment stored under key, None if there is none"""
+        with self.__lock:
+            location = self.__index.get(key)
+        return None if location is None else f"{location[3]:08x}"
+
+    def get_range(self, key, start, stop):
+        """Return a memoryview of bytes start up to stop of the fragment stored under key, None if there is none"""
+        with self.__lock:
+            location = self.__index.get(key)
+            if location is None:
+                return None
+            segment_id, offset, length, _ = location
+            start, stop = min(start, length), min(stop, length)
+            return self.__view(segment_id, offset + start, stop - start)
+
+    def delete(self, key):
+        """Delete a fragment, return False if it did not exist"""
+        with self.__lock:
+            if key not in self.__index:
+                return False
+            self.__append(DELETE, key, (), 0, 0)
+            return True
+
+    def keys(self):
+        with self.__lock:
+            return list(self.__index)
+
+    def __append(self, kind, key, chunks, length, crc):
+        key_bytes = key.encode("utf-8")
+        record_size = RECORD_HEADER.size + len(key_bytes) + length
+        if self.__active_records and self.__active_size + record_size > self.__segment_size:
+            self.__seal_active()
+        header = RECORD_HEADER.pack(RECORD_MAGIC, kind, len(key_bytes), length, crc)
+        offset = self.__active_size + RECORD_HEADER.size + len(key_bytes)
+        try:
+            self.__active_file.write(header + key_bytes)
+            written = 0
+            for chunk in chunks:
+                self.__active_file.write(chunk)
+                written += len(chunk)
+            if written != length:
+                raise ValueError(f"{key}: got {written} bytes, expected {length}")
+            self.__active_file.flush()
+            if self.__fsync:
+                os.fsync(self.__active_file.fileno())
+        except BaseException:
+            # Nothing after the last complete record, so the segment still scans cleanly
+            self.__active_file.flush()
+            self.__active_file.truncate(self.__active_size)
+            raise
+        self.__active_size = offset + length
+        self.__segment_sizes[self.__active_id] = self.__active_size
+        self.__active_records.append([kind, key, offset, length, crc])
+        self.__apply(self.__active_id, kind, key, offset, length, crc)
+
+    def __apply(self, segment_id, kind, key, offset, length, crc):
+        old = self.__index.pop(key, None)
+        if old is not None:
+            self.__segment_keys[old[0]].discard(key)
+        if kind == PUT:
+            self.__index[key] = (segment_id, offset, length, crc)
+            self.__segment_keys.setdefault(segment_id, set()).add(key)
+        else:
+            self.__segment_tombstones.setdefault(segment_id, set()).add(key)
+
+    def __segment_path(self, segment_id):
+        return os.path.join(self.__directory, f"segment_{segment_id:08d}.log")
+
+    def __open_active(self, segment_id):
+        self.__active_id = segment_id
+        self.__active_file = open(self.__segment_path(segment_id), "ab")
+        self.__active_size = self.__active_file.tell()
+        self.__active_records = []
+        self.__segment_sizes[segment_id] = self.__active_size
+        self.__segment_keys.setdefault(segment_id, set())
+
+    def __seal_active(self):
+        entries = []
+        for kind, key, offset, length, crc in self.__active_records:
+            key_bytes = key.encode("utf-8")
+            entries.append(FOOTER_ENTRY.pack(kind, len(key_bytes), offset, length, crc) + key_bytes)
+        footer = b"".join(entries)
+        self.__active_file.write(footer + FOOTER_TRAILER.pack(len(footer), FOOTER_MAGIC))
+        self.__active_file.flush()
+        if self.__fsync:
+            os.fsync(self.__active_file.fileno())
+        self.__active_file.close()
+        self.__open_active(self.__active_id + 1)
+
+    def __view(self, segment_id, offset, length):
+        """A memoryview of length bytes at offset in a segment"""
+        mapped = self.__maps.get(segment_id)
+        if mapped is None or len(mapped) < offset + length:
+            # The active segment grew past the mapping, so the whole segment is mapped again
+            with open(self.__segment_path(segment_id), "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__maps[segment_id] = mapped
+        return memoryview(mapped)[offset : offset + length]
+
+    def __load(self):
+        """Rebuild the index from segment footers, scanning segments that were never sealed"""
+        start = time.time()
+        segment_ids = sorted(
+            int(name[len("segment_") : -len(".log")])
+            for name in os.listdir(self.__directory)
+            if name.startswith("segment_") and name.endswith(".log")
+        )
+        records, sealed = [], True
+        for segment_id in segment_ids:
+            records, sealed = self.__read_records(segment_id)
+            self.__segment_sizes[segment_id] = os.path.getsize(self.__segment_path(segment_id))
+            for kind, key, offset, length, crc in records:
+                self.__apply(segment_id, kind, key, offset, length, crc)
+
+        if not sealed:
+            # Keep appending to the segment that was active before the restart
+            self.__open_active(segment_ids[-1])
+            self.__active_records = records
+        else:
+            self.__open_active(segment_ids[-1] + 1 if segment_ids else 0)
+        print(
+            f"Loaded {len(self.__index)} fragments from {len(segment_ids)} segments in {time.time() - start:.2f}s"
+        )
+
+    def __read_records(self, segment_id):
+        """Return the records of a segment and whether it is sealed"""
+        path = self.__segment_path(segment_id)
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size >= FOOTER_TRAILER.size:
+                f.seek(size - FOOTER_TRAILER.size)
+                footer_len, magic = FOOTER_TRAILER.unpack(f.read(FOOTER_TRAILER.size))
+                if magic == FOOTER_MAGIC:
+                    f.seek(size - FOOTER_TRAILER.size - footer_len)
+                    footer = f.read(footer_len)
+                    records = []
+                    pos = 0
+                    while pos < footer_len:
+                        kind, key_len, offset, length, crc = FOOTER_ENTRY.unpack_from(footer, pos)
+                        pos += FOOTER_ENTRY.size
+                        key = footer[pos : pos + key_len].decode("utf-8")
+                        pos += key_len
+                        records.append([kind, key, offset, length, crc])
+                    return records, True
+
+            # Unsealed segment: scan the records and cut off a torn last write
+            records = []
+            offset = 0
+            f.seek(0)
+            while offset + RECORD_HEADER.size <= size:
+                magic, kind, key_len, data_len, crc = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                data_offset = offset + RECORD_HEADER.size + key_len
+                if magic != RECORD_MAGIC or data_offset + data_len > size:
+                    break
+                key = f.read(key_len).decode("utf-8")
+                records.append([kind, key, data_offset, data_len, crc])
+                offset = data_offset + data_len
+                f.seek(offset)
+        if offset < size:
+            print(f"Truncating torn write at offset {offset} of {path}")
+            os.truncate(path, offset)
+        return records, False
+
+    def __compact_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.compact()
+            except Exception as e:
+                print(f"Compaction failed: {e}")
+
+    def compact(self):
+        """Rewrite the live fragments of sealed segments that are mostly garbage"""
+        with self.__lock:
+            oldest = min(self.__segment_sizes)
+            candidates = [
+                segment_id
+                for segment_id, size in self.__segment_sizes.items()
+                if segment_id != self.__active_id
+                and self.__live_bytes(segment_id) < self.__compaction_threshold * size
+            ]
+
+        for segment_id in candidates:
+            with self.__lock:
+                reclaimed = self.__segment_sizes[segment_id]
+                for key in list(self.__segment_keys.get(segment_id, ())):
+                    # The stored checksum is carried over, so corruption stays detectable
+                    _, offset, length, crc = self.__index[key]
+                    data = self.__view(segment_id, offset, length)
+                    self.__append(PUT, key, [data], length, crc)
+                # Tombstones still hide older puts of their key unless this is the oldest segment
+                if segment_id != oldest:
+                    for key in self.__segment_tombstones.get(segment_id, ()):
+                        if key not in self.__index:
+                            self.__append(DELETE, key, (), 0, 0)
+
+                self.__segment_keys.pop(segment_id, None)
+                self.__segment_tombstones.pop(segment_id, None)
+                self.__segment_sizes.pop(segment_id, None)
+                # Reads still holding views of the segment keep its mapping, and the removed file, until they finish
+                self.__maps.pop(segment_id, None)
+                os.remove(self.__segment_path(segment_id))
+            print(f"Compacted segment {segment_id}, reclaimed up to {reclaimed} bytes")
+
+    def __live_bytes(self, segment_id):
+        return sum(self.__index[key][2] for key in self.__segment_keys.get(segment_id, ()))
@@ -3,17 +3,22 @@ import tqdm
 import requests
 import json
 
-from shared_utils import send_store_request, generate_file
+from shared_utils import send_store_batch_request, generate_file
 
 RANDOM_SELECTION = "random"
 MIN_COPY_SETS_SELECTION = "min_copy_sets"
 BUDDY_SELECTION = "buddy"
 
+REPLICATION = "replication"
+ERASURE_CODING = "erasure_coding"
+
 # N is determined by the deployment and is changed manually (12, 24, 36)
 N = 24  # currently testing
 K = 3  # default value
 STRATEGIES = [MIN_COPY_SETS_SELECTION, RANDOM_SELECTION, BUDDY_SELECTION]
 S = [2, 3, 4, 6, 8, 10] # number of nodes to kill
+STORAGE_MODE = REPLICATION  # or ERASURE_CODING (4 data + 2 parity fragments by default)
+BATCH_SIZE = 100  # files stored per /store_batch request
 
 
 def store_n_files(n, file_size):
@@ -21,10 +26,9 @@ def store_n_files(n, file_size):
 
     file_ids = []
     file_bytes = generate_file(file_size)
-    for _ in tqdm.tqdm(range(n), desc="Storing files", leave=False):
-        # Store file and measure time
-        file_id = send_store_request(file_bytes)
-        file_ids.append(file_id)
+    for start in tqdm.tqdm(range(0, n, BATCH_SIZE), desc="Storing files", leave=False):
+        batch = [file_bytes] * min(BATCH_SIZE, n - start)
+        file_ids.extend(send_store_batch_request(batch))
 
     return file_ids
 
@@ -47,6 +51,9 @@ def run_tests():
                 requests.post(
                     "http://localhost:4000/change_replication_strategy", data=strategy, timeout=10
                 )
+                requests.post(
+                    "http://localhost:4000/change_storage_mode", data=STORAGE_MODE, timeout=10
+                )
                 # Store n files
                 _ = store_n_files(100, 10)  # 100 files of 10 bytes
                 # Kill s nodes
@@ -68,5 +75,6 @@ def run_tests():
 if __name__ == "__main__":
     results = run_tests()
     print(results)
-    with open(f"tests/out/{N}_nodes_data_loss_test_results.json", "w", encoding="utf-8") as f:
+    mode_suffix = "" if STORAGE_MODE == REPLICATION else f"_{STORAGE_MODE}"
+    with open(f"tests/out/{N}_nodes{mode_suffix}_data_loss_test_results.json", "w", encoding="utf-8") as f:
         json.dump({str(k): v for k, v in results.items()}, f)
@@ -0,0 +1,128 @@
+import time
+import zlib
+import lzma
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from shared_utils import URL, send_store_request
+
+# The lead node only places fragments and records metadata, fragments go straight
+# between this client and the storage nodes, WORKERS transfers at a time
+WORKERS = 32
+TIMEOUT = (2, 30)
+
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=64, pool_maxsize=WORKERS))
+executor = ThreadPoolExecutor(max_workers=WORKERS)
+
+DECOMPRESS = {"zlib": zlib.decompress, "lzma": lzma.decompress}
+try:
+    import zstandard
+    DECOMPRESS["zstd"] = lambda data: zstandard.ZstdDecompressor().decompress(data)
+except ImportError:
+    pass
+
+def checksum(data):
+    """CRC32 of a fragment in hex, as the lead and storage nodes compute it"""
+    return f"{zlib.crc32(data):08x}"
+
+def upload_fragment(node, file_id, frag_idx, fragment, token):
+    """Upload a fragment straight to a storage node, return True on success"""
+    url = f"http://{node['ip']}:5000/direct/upload_fragment?file_id={file_id}&frag_idx={frag_idx}"
+    headers = {"X-Token": token, "X-Checksum": checksum(fragment)}
+    try:
+        return session.post(url, data=fragment, headers=headers, timeout=TIMEOUT).status_code == 200
+    except requests.RequestException as e:
+        print(f"Upload error for fragment {frag_idx} of {file_id} to {node}: {e}")
+        return False
+
+def download_fragment(fragment, codec):
+    """Download a fragment from the first of its nodes that has an intact copy, None if none has"""
+    url_args = f"file_id={fragment['file_id']}&frag_idx={fragment['frag_idx']}"
+    for node in fragment["nodes"]:
+        try:
+            r = session.get(
+                f"http://{node['ip']}:5000/direct/get_fragment?{url_args}",
+                headers={"X-Token": fragment["token"]}, timeout=TIMEOUT,
+            )
+        except requests.RequestException as e:
+            print(f"Download error for fragment {fragment['frag_idx']} from {node}: {e}")
+            continue
+        if r.status_code != 200:
+            continue
+        if fragment["checksum"] is not None and checksum(r.content) != fragment["checksum"]:
+            continue
+        return DECOMPRESS[codec](r.content) if fragment["compressed"] else r.content
+    return None
+
+def direct_store(file_bytes):
+    """Store a file by uploading its fragments to the storage nodes in parallel, return its file_id.
+
+    Files the lead node does not plan, e.g. erasure coded ones, are sent through it.
+    Returns None if the store could not be committed.
+    """
+    r = session.post(f"{URL}/plan_store", params={"size": len(file_bytes)}, timeout=TIMEOUT)
+    if r.status_code != 200:
+        return send_store_request(file_bytes)
+    plan = r.json()
+    file_id = plan["file_id"]
+
+    fragments = []
+    start = 0
+    for size in plan["fragment_sizes"]:
+        fragments.append(file_bytes[start : start + size])
+        start += size
+
+    # A fragment is uploaded once per node, even if the node holds two of its replicas
+    uploads = {}
+    for replica_idx, replica in enumerate(plan["assigned_nodes"]):
+        for frag_idx, node in enumerate(replica):
+            key = (node["name"], frag_idx)
+            if key not in uploads:
+                uploads[key] = executor.submit(
+                    upload_fragment, node, file_id, frag_idx, fragments[frag_idx], plan["tokens"][frag_idx]
+                )
+    failed = [
+        [replica_idx, frag_idx]
+        for replica_idx, replica in enumerate(plan["assigned_nodes"])
+        for frag_idx, node in enumerate(replica)
+        if not uploads[(node["name"], frag_idx)].result()
+    ]
+
+    r = session.post(
+        f"{URL}/commit_store",
+        json={"file_id": file_id, "checksums": [checksum(f) for f in fragments], "failed": failed},
+        timeout=TIMEOUT,
+    )
+    if r.status_code != 200:
+        print(f"Failed to commit {file_id}: {r.text}")
+        return None
+    return file_id
+
+def direct_retrieve(file_id):
+    """Retrieve a file by downloading its fragments from the storage nodes in parallel"""
+    r = session.get(f"{URL}/plan_retrieve", params={"file_id": file_id}, timeout=TIMEOUT)
+    if r.status_code != 200:
+        return session.get(f"{URL}/retrieve", params={"file_id": file_id}, timeout=TIMEOUT).content
+    plan = r.json()
+    futures = [
+        executor.submit(download_fragment, fragment, plan["codec"]) for fragment in plan["fragments"]
+    ]
+    fragments = [future.result() for future in futures]
+    if any(fragment is None for fragment in fragments):
+        raise IOError(f"A fragment of {file_id} is not on any of its nodes")
+    return b"".join(fragments)
+
+def store_file(file_bytes):
+    """Store a file over the direct path, return the time it took and its file_id"""
+    start_time = time.time()
+    file_id = direct_store(file_bytes)
+    return time.time() - start_time, file_id
+
+def download_file(file_id):
+    """Download a file over the direct path, return the time it took"""
+    start_time = time.time()
+    direct_retrieve(file_id)
+    return time.time() - start_time
@@ -10,13 +10,23 @@ from shared_utils import generate_file, download_file, store_file, change_replic
 RANDOM_SELECTION = "random"
 MIN_COPY_SETS_SELECTION = "min_copy_sets"
 BUDDY_SELECTION = "buddy"
+LOAD_AWARE_SELECTION = "load_aware"
+LOAD_AWARE_MIN_COPY_SETS_SELECTION = "load_aware_min_copy_sets"
+LOAD_AWARE_BUDDY_SELECTION = "load_aware_buddy"
 
 # configuration parameters
 NO_NODES = 3  # 3, 6, 12, 24
 NO_REPLICAS = 3 # default
 FILE_SIZES = [1e5, 1e6, 1e7, 1e8]  # 100 KB, 1 MB, 10 MB, 100 MB
 NO_FILES = 100
-NODE_SELECTION_STRATEGIES = [MIN_COPY_SETS_SELECTION, BUDDY_SELECTION, RANDOM_SELECTION]
+NODE_SELECTION_STRATEGIES = [
+    MIN_COPY_SETS_SELECTION,
+    BUDDY_SELECTION,
+    RANDOM_SELECTION,
+    LOAD_AWARE_MIN_COPY_SETS_SELECTION,
+    LOAD_AWARE_BUDDY_SELECTION,
+    LOAD_AWARE_SELECTION,
+]
 
 # get cli first argument
 if len(sys.argv) > 1:
@@ -27,6 +37,12 @@ if len(sys.argv) > 1:
         NODE_SELECTION_STRATEGIES = [MIN_COPY_SETS_SELECTION]
     elif selection_strategy == 2:
         NODE_SELECTION_STRATEGIES = [BUDDY_SELECTION]
+    elif selection_strategy == 3:
+        NODE_SELECTION_STRATEGIES = [LOAD_AWARE_SELECTION]
+    elif selection_strategy == 4:
+        NODE_SELECTION_STRATEGIES = [LOAD_AWARE_MIN_COPY_SETS_SELECTION]
+    elif selection_strategy == 5:
+        NODE_SELECTION_STRATEGIES = [LOAD_AWARE_BUDDY_SELECTION]
 
 print(f"Testing: {NODE_SELECTION_STRATEGIES}")
 
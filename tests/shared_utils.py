@@ -1,14 +1,27 @@
 import time
+import struct
 import numpy as np
 import requests
 
 URL = "http://localhost:4000"
 
+# Header of a framed record: status, file_id length, index, data length (see lead_node/framing.py)
+RECORD_HEADER = struct.Struct(">BHIQ")
+
 def send_store_request(file_bytes):
     """Send store request to the lead node"""
     response = requests.post(f"{URL}/store", data=file_bytes)
     return response.json()["file_id"]
 
+def send_store_batch_request(files):
+    """Store a list of files with one request, return their file_ids in order"""
+    body = b"".join(
+        RECORD_HEADER.pack(0, 0, idx, len(file_bytes)) + file_bytes
+        for idx, file_bytes in enumerate(files)
+    )
+    response = requests.post(f"{URL}/store_batch", data=body)
+    return response.json()["file_ids"]
+
 # Mock storage and download functions
 def store_file(file_bytes):
     """Store file and generate redundancy"""
@@ -32,6 +45,11 @@ def change_replication_strategy(node_selection_strategy):
     )
     return res
 
+def change_storage_mode(storage_mode):
+    """Change the storage mode to replication or erasure_coding"""
+    res = requests.post(f"{URL}/change_storage_mode", data=storage_mode, timeout=10)
+    return res
+
 def reset_metadata():
     """Clear metadata"""
     res = requests.post(f"{URL}/reset_metadata", timeout=10)
@@ -0,0 +1,55 @@
+import importlib.util
+import os
+import sys
+import threading
+
+import pytest
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+# The lead and storage node modules import each other by file name, as they do in their containers.
+# framing.py, checksum.py and tokens.py are identical copies in both, so either can be found first.
+SRC = os.path.join(os.path.dirname(__file__), "..", "..", "src")
+sys.path.insert(0, os.path.join(SRC, "storage_node"))
+sys.path.insert(0, os.path.join(SRC, "lead_node"))
+
+STORAGE_NODE_APP = os.path.join(SRC, "storage_node", "app.py")
+
+
+def load_storage_node(name):
+    """Load the storage node's app.py as module name, keeping its fragments in ./data.
+
+    The lead node has an app.py too, so it is loaded by path. Its settings come from the environment.
+    """
+    spec = importlib.util.spec_from_file_location(name, STORAGE_NODE_APP)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class KeepAliveHandler(WSGIRequestHandler):
+    # As in app.py, so the lead node's pooled connections and chunked uploads work
+    protocol_version = "HTTP/1.1"
+
+
+@pytest.fixture
+def storage_nodes(tmp_path, monkeypatch):
+    """Four storage nodes serving on 127.0.0.150-153:5000, as (member, app module) pairs"""
+    nodes, servers = [], []
+    for i in range(4):
+        directory = tmp_path / f"storage-{i}"
+        directory.mkdir()
+        monkeypatch.chdir(directory)
+        module = load_storage_node(f"storage_node_{i}")
+        module.storage_dir = str(directory / "data")
+        server = make_server(
+            f"127.0.0.{150 + i}", 5000, module.app, threaded=True, request_handler=KeepAliveHandler
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        nodes.append(({"name": f"storage-{i}", "ip": f"127.0.0.{150 + i}"}, module))
+    try:
+        yield nodes
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,281 @@
+import asyncio
+import os
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import async_app
+import file_handler
+from checksum import checksum
+from file_handler import FileHandler
+from framing import encode_records, iter_records
+from membership import FakeMembership
+from metadata_store import InMemoryMetadataStore
+
+
+class FakeStorageNode:
+    """The fragment endpoints of a storage node, keeping fragments in a dict"""
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.fragments = {}
+        self.slow = {}  # key -> seconds get_fragment waits before answering
+        self.upload_delay = 0
+        self.gets = []
+        self.uploading = 0
+        self.most_uploading = 0
+        app = web.Application(client_max_size=0)
+        app.router.add_post("/upload_fragment", self.upload_fragment)
+        app.router.add_get("/get_fragment", self.get_fragment)
+        app.router.add_post("/upload_fragments", self.upload_fragments)
+        app.router.add_post("/get_fragments", self.get_fragments)
+        app.router.add_delete("/delete_fragment", self.delete_fragment)
+        self.runner = web.AppRunner(app, access_log=None)
+
+    async def start(self):
+        await self.runner.setup()
+        # The lead node always reaches storage nodes on port 5000
+        await web.TCPSite(self.runner, self.ip, 5000).start()
+
+    @staticmethod
+    def key(request):
+        return request.query["file_id"], int(request.query["frag_idx"])
+
+    async def upload_fragment(self, request):
+        self.uploading += 1
+        self.most_uploading = max(self.most_uploading, self.uploading)
+        try:
+            data = await request.read()
+            await asyncio.sleep(self.upload_delay)
+        finally:
+            self.uploading -= 1
+        expected = request.headers.get("X-Checksum")
+        if expected is not None and checksum(data) != expected:
+            return web.Response(status=400)
+        self.fragments[self.key(request)] = data
+        return web.Response(text="OK", headers={"X-Checksum": checksum(data)})
+
+    async def get_fragment(self, request):
+        self.gets.append(self.key(request))
+        await asyncio.sleep(self.slow.get(self.key(request), 0))
+        data = self.fragments.get(self.key(request))
+        if data is None:
+            return web.Response(status=404)
+        return web.Response(body=data)
+
+    async def delete_fragment(self, request):
+        if self.fragments.pop(self.key(request), None) is None:
+            return web.Response(status=404)
+        return web.Response(text="OK")
+
+    async def upload_fragments(self, request):
+        for file_id, frag_idx, data in iter_records(await request.read()):
+            self.fragments[(file_id, frag_idx)] = bytes(data)
+        return web.Response(text="OK")
+
+    async def get_fragments(self, request):
+        records = [
+            (file_id, frag_idx, self.fragments.get((file_id, frag_idx)))
+            for file_id, frag_idx, _ in iter_records(await request.read())
+        ]
+        return web.Response(body=encode_records(records))
+
+
+def run_with_lead_node(test):
+    """Run test(client, handler, storage_nodes) against the async lead node and four fake storage nodes"""
+
+    async def main():
+        storage_nodes = [FakeStorageNode(f"127.0.0.{200 + i}") for i in range(4)]
+        for node in storage_nodes:
+            await node.start()
+        members = [{"name": f"storage-{i}", "ip": node.ip} for i, node in enumerate(storage_nodes)]
+        handler = FileHandler(InMemoryMetadataStore(), FakeMembership(members))
+        client = TestClient(TestServer(async_app.create_app(handler)))
+        await client.start_server()
+        try:
+            await test(client, handler, storage_nodes)
+        finally:
+            await client.close()
+            for node in storage_nodes:
+                await node.runner.cleanup()
+
+    asyncio.run(main())
+
+
+def stored_copies(storage_nodes, file_id):
+    return sum(1 for node in storage_nodes for key in node.fragments if key[0] == file_id)
+
+
+def test_stores_and_retrieves_through_the_storage_nodes():
+    async def test(client, handler, storage_nodes):
+        data = os.urandom(300_000)
+        # A known length is streamed to the nodes, a chunked body is read whole first
+        reply = await client.post("/store", data=data)
+        streamed = (await reply.json())["file_id"]
+
+        async def chunks():
+            yield data[:1000]
+            yield data[1000:]
+
+        reply = await client.post("/store", data=chunks())
+        buffered = (await reply.json())["file_id"]
+
+        for file_id in (streamed, buffered):
+            assert 0 < stored_copies(storage_nodes, file_id) <= 12
+            reply = await client.get("/retrieve", params={"file_id": file_id})
+            assert await reply.read() == data
+
+    run_with_lead_node(test)
+
+
+def test_small_files_are_batched_and_corrupt_copies_are_skipped(monkeypatch):
+    # Reads have to go to the storage nodes
+    monkeypatch.setattr(file_handler, "CACHE_WRITE_THROUGH", False)
+
+    async def test(client, handler, storage_nodes):
+        files = [os.urandom(100 + i) for i in range(5)]
+        body = encode_records((f"upload_{i}", 0, data) for i, data in enumerate(files))
+        file_ids = (await (await client.post("/store_batch", data=body)).json())["file_ids"]
+        assert None not in file_ids
+
+        # Only the last node of every fragment keeps an intact copy, reads fail over to it
+        by_ip = {node.ip: node for node in storage_nodes}
+        for file_id in file_ids:
+            for fragment in handler.retrieve_sources(file_id)["fragments"]:
+                key = (fragment["file_id"], fragment["frag_idx"])
+                intact = fragment["nodes"][-1]
+                for node in fragment["nodes"]:
+                    if node["name"] != intact["name"]:
+                        by_ip[node["ip"]].fragments[key] = bytes(fragment["size"])
+        for file_id, data in zip(file_ids, files):
+            reply = await client.get("/retrieve", params={"file_id": file_id})
+            assert await reply.read() == data
+        assert handler.checksum_mismatches > 0
+
+    run_with_lead_node(test)
+
+
+def test_missing_files_get_an_empty_reply():
+    async def test(client, handler, storage_nodes):
+        reply = await client.get("/retrieve", params={"file_id": "file_0"})
+        assert reply.status == 200 and await reply.read() == b""
+
+    run_with_lead_node(test)
+
+
+def test_single_byte_ranges_are_served_and_others_get_the_whole_file():
+    async def test(client, handler, storage_nodes):
+        data = os.urandom(100_000)
+        file_id = (await (await client.post("/store", data=data)).json())["file_id"]
+        params = {"file_id": file_id}
+
+        reply = await client.get("/retrieve", params=params, headers={"Range": "bytes=20000-79999"})
+        assert reply.status == 206 and await reply.read() == data[20_000:80_000]
+        assert reply.headers["Content-Range"] == "bytes 20000-79999/100000"
+        reply = await client.get("/retrieve", params=params, headers={"Range": "bytes=-10"})
+        assert reply.status == 206 and await reply.read() == data[-10:]
+        reply = await client.get("/retrieve", params=params, headers={"Range": "bytes=200000-"})
+        assert reply.status == 416 and reply.headers["Content-Range"] == "bytes */100000"
+        reply = await client.get("/retrieve", params=params, headers={"Range": "bytes=0-9,20-29"})
+        assert reply.status == 200 and await reply.read() == data
+
+    run_with_lead_node(test)
+
+
+class ShortBody:
+    """A request body that ends after data, whatever length it announced"""
+
+    def __init__(self, data):
+        self.data = data
+
+    async def read(self, n=-1):
+        chunk, self.data = (self.data, b"") if n < 0 else (self.data[:n], self.data[n:])
+        return chunk
+
+
+def test_a_short_stream_leaves_no_fragments_behind():
+    async def test(client, handler, storage_nodes):
+        async def blocking(fn, *args):
+            return await asyncio.to_thread(fn, *args)
+
+        transfers = async_app.FragmentTransfers(handler, blocking)
+        await transfers.start(None)
+        try:
+            data = os.urandom(300_000)
+            assert await transfers.store_stream(ShortBody(data[:200_000]), len(data), None) is None
+        finally:
+            await transfers.close(None)
+        assert all(not node.fragments for node in storage_nodes)
+
+    run_with_lead_node(test)
+
+
+def test_uploads_keep_to_the_per_node_limit(monkeypatch):
+    monkeypatch.setattr(file_handler, "PER_NODE_UPLOAD_LIMIT", 1)
+
+    async def test(client, handler, storage_nodes):
+        for node in storage_nodes:
+            node.upload_delay = 0.02
+
+        async def store():
+            # A chunked body is stored whole, one upload per fragment copy
+            async def chunks():
+                yield os.urandom(2_000_000)
+
+            return (await (await client.post("/store", data=chunks())).json())["file_id"]
+
+        assert None not in await asyncio.gather(*(store() for _ in range(8)))
+        assert max(node.most_uploading for node in storage_nodes) == 1
+        # Every transfer counts towards the load of its node
+        node_load = handler.stats()["node_load"]
+        assert sorted(node_load) == [f"storage-{i}" for i in range(4)]
+        assert all(load["latency"] is not None and load["in_flight"] == 0 for load in node_load.values())
+
+    run_with_lead_node(test)
+
+
+def test_concurrent_retrieves_download_each_fragment_once(monkeypatch):
+    monkeypatch.setattr(file_handler, "CACHE_WRITE_THROUGH", False)
+
+    async def test(client, handler, storage_nodes):
+        data = os.urandom(2_000_000)
+        file_id = (await (await client.post("/store", data=data)).json())["file_id"]
+        for node in storage_nodes:
+            node.slow = {key: 0.1 for key in node.fragments}
+
+        async def retrieve():
+            return await (await client.get("/retrieve", params={"file_id": file_id})).read()
+
+        assert await asyncio.gather(*(retrieve() for _ in range(5))) == [data] * 5
+        gets = [key for node in storage_nodes for key in node.gets]
+        assert len(gets) == len(set(gets)) == len(handler.retrieve_sources(file_id)["fragments"])
+
+    run_with_lead_node(test)
+
+
+def test_slow_replicas_are_hedged(monkeypatch):
+    monkeypatch.setattr(file_handler, "CACHE_WRITE_THROUGH", False)
+    monkeypatch.setattr(file_handler, "FRAGMENT_CACHE_BYTES", 0)
+    monkeypatch.setattr(file_handler, "HEDGED_READS", True)
+    monkeypatch.setattr(file_handler, "HEDGE_MIN_DELAY", 0.2)
+    # Every copy of a fragment on a node of its own
+    monkeypatch.setattr(file_handler, "NODE_SELECTION_STRATEGY", None)
+
+    async def test(client, handler, storage_nodes):
+        handler.change_replication_strategy("min_copy_sets")
+        data = os.urandom(2_000_000)
+        file_id = (await (await client.post("/store", data=data)).json())["file_id"]
+        # The first copy of every fragment takes far longer than the hedge delay
+        by_ip = {node.ip: node for node in storage_nodes}
+        fragments = handler.retrieve_sources(file_id)["fragments"]
+        for fragment in fragments:
+            by_ip[fragment["nodes"][0]["ip"]].slow[(fragment["file_id"], fragment["frag_idx"])] = 2
+
+        start = time.time()
+        reply = await client.get("/retrieve", params={"file_id": file_id})
+        assert await reply.read() == data
+        assert time.time() - start < 1.5
+        assert handler.hedges_won == len(fragments) and handler.hedges_issued >= len(fragments)
+
+    run_with_lead_node(test)
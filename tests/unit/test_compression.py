@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+import compression
+from compression import Compressor, validate_codec
+
+
+@pytest.mark.parametrize("codec", sorted(compression.CODECS))
+def test_every_codec_round_trips(codec):
+    data = b"fragment " * 1000
+    compressed = compression.compress(codec, data)
+    assert len(compressed) < len(data)
+    assert compression.decompress(codec, compressed) == data
+
+
+def test_unknown_codecs_are_refused():
+    assert validate_codec(None) is None and validate_codec("none") == "none"
+    assert validate_codec("zlib") == "zlib"
+    with pytest.raises(ValueError):
+        validate_codec("snappy")
+    with pytest.raises(ValueError):
+        Compressor(1, 0).compress_fragments("snappy", [b"data"])
+
+
+def test_small_and_incompressible_fragments_are_stored_as_they_are():
+    compressor = Compressor(2, 100)
+    text, noise, small = b"a" * 1000, os.urandom(1000), b"a" * 99
+    stored, flags = compressor.compress_fragments("zlib", [text, noise, small])
+
+    assert flags == [True, False, False]
+    assert stored[1:] == [noise, small] and compression.decompress("zlib", stored[0]) == text
+    stats = compressor.stats()
+    assert stats["bytes_in"] == 2099 and stats["bytes_stored"] == len(stored[0]) + 1099
@@ -0,0 +1,118 @@
+from checksum import checksum
+from dedup import Deduplicator, content_address
+from metadata_store import InMemoryMetadataStore
+
+NODES = [{"name": f"storage-{i}", "ip": f"127.0.0.{100 + i}"} for i in range(4)]
+LIVE = {node["name"] for node in NODES}
+
+
+def placed_file(fragments, nodes):
+    """(fragments, record) of a file whose replicas are on nodes, one node per replica"""
+    return fragments, {
+        "assigned_nodes": [[node] * len(fragments) for node in nodes],
+        "checksums": [checksum(fragment) for fragment in fragments],
+    }
+
+
+class Uploads:
+    """upload_files and record_files for Deduplicator.store, failing the uploads to failing_nodes"""
+
+    def __init__(self, failing_nodes=()):
+        self.uploaded = []  # (address, node name)
+        self.recorded = []
+        self.failing_nodes = set(failing_nodes)
+
+    def upload_files(self, files):
+        failed = set()
+        for address, (_, _, assigned_nodes) in files.items():
+            for (node,) in assigned_nodes:
+                if node["name"] in self.failing_nodes:
+                    failed.add(address)
+                else:
+                    self.uploaded.append((address, node["name"]))
+        return failed
+
+    def record_files(self, records):
+        self.recorded.extend(file_id for file_id, _ in records)
+
+
+def test_repeated_content_is_uploaded_once_and_counted_per_reference():
+    dedup = Deduplicator(InMemoryMetadataStore())
+    uploads = Uploads()
+    placed = {
+        "file_1": placed_file([b"a" * 100, b"b" * 100], NODES[:3]),
+        "file_2": placed_file([b"a" * 100, b"a" * 100], NODES[1:]),
+    }
+
+    assert dedup.store(placed, LIVE, uploads.upload_files, uploads.record_files) == set()
+    a, b = content_address(b"a" * 100), content_address(b"b" * 100)
+    assert sorted(address for address, _ in uploads.uploaded) == sorted([a] * 3 + [b] * 3)
+    assert sorted(uploads.recorded) == ["file_1", "file_2"]
+    assert placed["file_2"][1]["fragment_keys"] == [a, a]
+    # Every reference points at the nodes the content was uploaded to
+    assert placed["file_2"][1]["assigned_nodes"] == placed["file_1"][1]["assigned_nodes"][:3]
+    assert dedup.begin([a])[a]["refs"] == 3
+    dedup.end([a])
+    assert dedup.stats() == {"fragments_deduplicated": 2, "bytes_saved": 200}
+
+
+def test_content_on_too_few_live_nodes_is_uploaded_again():
+    dedup = Deduplicator(InMemoryMetadataStore())
+    uploads = Uploads()
+    dedup.store({"file_1": placed_file([b"a"], NODES[:3])}, LIVE, uploads.upload_files, uploads.record_files)
+    uploads.uploaded = []
+
+    dedup.store({"file_2": placed_file([b"a"], NODES[1:])}, LIVE, uploads.upload_files, uploads.record_files)
+    assert uploads.uploaded == []
+    dedup.store(
+        {"file_3": placed_file([b"a"], NODES[1:])}, LIVE - {"storage-0"},
+        uploads.upload_files, uploads.record_files,
+    )
+    assert sorted(name for _, name in uploads.uploaded) == ["storage-1", "storage-2", "storage-3"]
+
+
+def test_files_whose_content_failed_to_upload_are_not_recorded():
+    metadata = InMemoryMetadataStore()
+    dedup = Deduplicator(metadata)
+    uploads = Uploads(failing_nodes={"storage-0"})
+    placed = {
+        "file_1": placed_file([b"a", b"b"], NODES[:3]),
+        "file_2": placed_file([b"c"], NODES[1:]),
+    }
+
+    assert dedup.store(placed, LIVE, uploads.upload_files, uploads.record_files) == {"file_1"}
+    assert uploads.recorded == ["file_2"]
+    assert metadata.get_chunk(content_address(b"a")) is None
+    assert metadata.get_chunk(content_address(b"c"))["refs"] == 1
+
+
+def test_content_is_deleted_with_its_last_reference():
+    dedup = Deduplicator(InMemoryMetadataStore())
+    uploads = Uploads()
+    placed = {
+        "file_1": placed_file([b"a", b"b"], NODES[:3]),
+        "file_2": placed_file([b"a"], NODES[1:]),
+    }
+    dedup.store(placed, LIVE, uploads.upload_files, uploads.record_files)
+    deleted = []
+
+    def delete_fragments(fragments):
+        deleted.extend(sorted(fragments))
+        return len(fragments)
+
+    a, b = content_address(b"a"), content_address(b"b")
+    assert dedup.release(placed["file_1"][1], delete_fragments) == 3
+    assert deleted == [(f"storage-{i}", b, 0) for i in range(3)]
+    assert dedup.release(placed["file_2"][1], delete_fragments) == 3
+    assert deleted[3:] == [(f"storage-{i}", a, 0) for i in range(3)]
+
+
+def test_repaired_copies_are_added_to_the_holders_of_content():
+    dedup = Deduplicator(InMemoryMetadataStore())
+    uploads = Uploads()
+    dedup.store({"file_1": placed_file([b"a"], NODES[:3])}, LIVE, uploads.upload_files, uploads.record_files)
+    a = content_address(b"a")
+
+    dedup.add_copies(a, [NODES[0], NODES[3]], 1)
+    assert dedup.holders(a) == NODES
+    assert dedup.holders(content_address(b"b")) == []
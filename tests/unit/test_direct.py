@@ -0,0 +1,106 @@
+import time
+
+from direct import DirectTransfers
+
+NODES = [{"name": f"storage-{i}", "ip": f"127.0.0.{100 + i}"} for i in range(3)]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class Cluster:
+    """The steps DirectTransfers takes from FileHandler, noting what they are asked to do"""
+
+    def __init__(self):
+        self.recorded = {}
+        self.deleted = []
+        self.fail_records = False
+        self.next_id = 0
+
+    def record_file(self, file_id, record):
+        if self.fail_records:
+            raise IOError("metadata is down")
+        self.recorded[file_id] = record
+
+    def delete_fragments(self, fragments):
+        self.deleted.extend(sorted(fragments))
+        return len(fragments)
+
+    def new_file_id(self):
+        self.next_id += 1
+        return f"file_{self.next_id}"
+
+
+def place(file_id):
+    return {
+        "storage_mode": "replication",
+        "assigned_nodes": [[node, node] for node in NODES],
+        "size": 20,
+        "no_fragments": 2,
+        "fragment_sizes": [10, 10],
+    }
+
+
+def direct_transfers(cluster, ttl=60):
+    return DirectTransfers("secret", ttl, cluster.record_file, cluster.delete_fragments)
+
+
+def test_a_planned_store_is_recorded_once_committed():
+    cluster = Cluster()
+    direct = direct_transfers(cluster)
+    plan = direct.plan_store(cluster.new_file_id, place)
+    file_id = plan["file_id"]
+    assert len(plan["tokens"]) == 2 and direct.planned(file_id)
+
+    assert "message" in direct.commit_store(file_id, ["crc"], [], None)
+    assert direct.commit_store(file_id, ["crc0", "crc1"], [], None) == {"file_id": file_id}
+    assert cluster.recorded[file_id]["checksums"] == ["crc0", "crc1"]
+    assert not direct.planned(file_id)
+    assert "message" in direct.commit_store(file_id, ["crc0", "crc1"], [], None)
+
+
+def test_failed_replicas_are_recorded_as_pending_while_the_quorum_holds():
+    cluster = Cluster()
+    direct = direct_transfers(cluster)
+    file_id = direct.plan_store(cluster.new_file_id, place)["file_id"]
+
+    reply = direct.commit_store(file_id, ["crc0", "crc1"], [[0, 1], [1, 1]], 2)
+    assert reply == {"message": f"Too few replicas of file_id={file_id} were written"}
+    assert direct.commit_store(file_id, ["crc0", "crc1"], [[0, 1]], 2) == {"file_id": file_id}
+    assert cluster.recorded[file_id]["pending"] == [[0, 1]]
+
+
+def test_a_commit_whose_record_fails_can_be_retried():
+    cluster = Cluster()
+    direct = direct_transfers(cluster)
+    file_id = direct.plan_store(cluster.new_file_id, place)["file_id"]
+    cluster.fail_records = True
+    assert "message" in direct.commit_store(file_id, ["crc0", "crc1"], [], None)
+    cluster.fail_records = False
+    assert direct.commit_store(file_id, ["crc0", "crc1"], [], None) == {"file_id": file_id}
+
+
+def test_stores_that_are_not_committed_are_deleted_once_they_expire():
+    cluster = Cluster()
+    direct = direct_transfers(cluster, ttl=1)
+    file_id = direct.plan_store(cluster.new_file_id, place)["file_id"]
+
+    # Expired a ttl after the tokens, by the expiry timer
+    assert wait_for(lambda: cluster.deleted, timeout=4)
+    assert not direct.planned(file_id)
+    assert cluster.deleted == sorted(
+        (node["name"], file_id, frag_idx) for node in NODES for frag_idx in range(2)
+    )
+    assert "message" in direct.commit_store(file_id, ["crc0", "crc1"], [], None)
+
+
+def test_plans_are_refused_without_a_secret():
+    cluster = Cluster()
+    assert not DirectTransfers(None, 60, cluster.record_file, cluster.delete_fragments).enabled()
+    assert direct_transfers(cluster).enabled()
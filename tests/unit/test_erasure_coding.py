@@ -0,0 +1,36 @@
+import itertools
+import os
+
+import pytest
+
+import erasure_coding
+
+
+@pytest.mark.parametrize("k,m", [(1, 1), (2, 1), (4, 2), (3, 3), (6, 3)])
+def test_any_k_shards_rebuild_the_data(k, m):
+    data = os.urandom(1000 + k * 37 + 5)
+    shards = erasure_coding.encode(data, k, m)
+    assert len(shards) == k + m
+    for indices in itertools.combinations(range(k + m), k):
+        data_shards = erasure_coding.decode({i: shards[i] for i in indices}, k, m)
+        assert b"".join(data_shards)[: len(data)] == data, indices
+
+
+def test_data_shards_are_the_file():
+    data = os.urandom(4001)
+    shards = erasure_coding.encode(data, 4, 2)
+    assert b"".join(shards[:4])[: len(data)] == data
+    assert len({len(shard) for shard in shards}) == 1
+
+
+@pytest.mark.parametrize("data", [b"", b"x", b"abc"])
+def test_tiny_files(data):
+    shards = erasure_coding.encode(data, 4, 2)
+    data_shards = erasure_coding.decode({i: shards[i] for i in (1, 3, 4, 5)}, 4, 2)
+    assert b"".join(data_shards)[: len(data)] == data
+
+
+def test_too_few_shards():
+    shards = erasure_coding.encode(b"some data", 4, 2)
+    with pytest.raises(ValueError):
+        erasure_coding.decode({0: shards[0], 4: shards[4], 5: shards[5]}, 4, 2)
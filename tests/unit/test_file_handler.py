@@ -0,0 +1,449 @@
+import io
+import os
+import threading
+import time
+from urllib.parse import parse_qs
+
+import pytest
+import requests
+
+import file_handler
+from checksum import checksum
+from file_handler import FileHandler
+from membership import FakeMembership
+from metadata_store import InMemoryMetadataStore
+
+
+def wait_for(condition, timeout=5):
+    """Wait for condition() to hold, for work the lead node finishes in the background"""
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def handler():
+    # Nothing listens on these, so nothing is stored, but placement and metadata work
+    nodes = [{"name": f"storage-{i}", "ip": f"127.0.0.{100 + i}"} for i in range(4)]
+    return FileHandler(InMemoryMetadataStore(), FakeMembership(nodes))
+
+
+def test_set_fragments_turns_the_size_policy_off(handler):
+    no_fragments = file_handler.NO_FRAGMENTS
+    assert file_handler.FRAGMENT_TARGET_SIZE == 0
+    try:
+        handler.set_fragment_policy(1024, 1, 8)
+        assert file_handler.FRAGMENT_TARGET_SIZE == 1024
+
+        reply = handler.set_fragments(6)
+        assert "size policy turned off" in reply["message"]
+        assert file_handler.FRAGMENT_TARGET_SIZE == 0
+        assert file_handler.NO_FRAGMENTS == 6
+        assert "turned off" not in handler.set_fragments(no_fragments)["message"]
+    finally:
+        handler.set_fragment_policy(0, 1, 16)
+        handler.set_fragments(no_fragments)
+
+
+@pytest.fixture
+def lead_node(storage_nodes):
+    return FileHandler(InMemoryMetadataStore(), FakeMembership([member for member, _ in storage_nodes]))
+
+
+def stored_fragments(storage_nodes):
+    return sorted(key for _, node in storage_nodes for key in node.list_fragments())
+
+
+class RequestLog:
+    """The requests the storage nodes served, and the most that ran at once"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []  # (node name, path, query, Range header)
+        self.running = 0
+        self.most_running = 0
+
+    def paths(self, path, node=None):
+        return [query for name, p, query, _ in self.requests if p == path and node in (None, name)]
+
+    def ranges(self, path):
+        return [byte_range for _, p, _, byte_range in self.requests if p == path]
+
+
+def log_requests(monkeypatch, storage_nodes, delay=lambda name, path, query: 0):
+    """Log every request to the storage nodes, holding each one for delay(node name, path, query) seconds"""
+    log = RequestLog()
+    for member, node in storage_nodes:
+        def logged(environ, start_response, name=member["name"], wsgi_app=node.app.wsgi_app):
+            path = environ["PATH_INFO"]
+            query = {key: values[0] for key, values in parse_qs(environ["QUERY_STRING"]).items()}
+            with log.lock:
+                log.requests.append((name, path, query, environ.get("HTTP_RANGE")))
+                log.running += 1
+                log.most_running = max(log.most_running, log.running)
+            try:
+                time.sleep(delay(name, path, query))
+                return wsgi_app(environ, start_response)
+            finally:
+                with log.lock:
+                    log.running -= 1
+        monkeypatch.setattr(node.app, "wsgi_app", logged)
+    return log
+
+
+@pytest.fixture
+def uncached(monkeypatch):
+    """Every fragment is downloaded one by one from the storage nodes"""
+    monkeypatch.setattr(file_handler, "CACHE_WRITE_THROUGH", False)
+    monkeypatch.setattr(file_handler, "BATCH_TRANSFERS", False)
+
+
+@pytest.mark.parametrize("quorum", [0, 2])
+def test_a_short_stream_leaves_no_fragments_behind(lead_node, storage_nodes, monkeypatch, quorum):
+    monkeypatch.setattr(file_handler, "WRITE_QUORUM", quorum)
+    data = os.urandom(100_000)
+    assert lead_node.store_file_stream(io.BytesIO(data[:70_000]), len(data)) is None
+    # Replicas of the first fragments were written before the stream ended, and are deleted again
+    assert wait_for(lambda: stored_fragments(storage_nodes) == [])
+    assert len(lead_node.metadata) == 0
+
+    file_id = lead_node.store_file_stream(io.BytesIO(data), len(data))
+    assert lead_node.retrieve_file(file_id) == data
+
+
+def test_retrieve_streams_fragments_in_order_with_a_bounded_window(lead_node, storage_nodes, monkeypatch, uncached):
+    monkeypatch.setattr(file_handler, "NO_FRAGMENTS", 8)
+    data = os.urandom(80_000)
+    file_id = lead_node.store_file(data)
+    # The first fragment is the slowest, the ones after it are downloaded while it is awaited
+    log = log_requests(
+        monkeypatch, storage_nodes,
+        lambda name, path, query: 0.3 if query.get("frag_idx") == "0" else 0.02,
+    )
+
+    fragments = list(lead_node.retrieve_file_stream(file_id, window=3))
+    assert b"".join(fragments) == data
+    assert [len(fragment) for fragment in fragments] == [10_000] * 8
+    assert log.most_running == 3
+
+
+def test_retrieve_stops_prefetching_when_the_client_goes_away(lead_node, storage_nodes, monkeypatch, uncached):
+    monkeypatch.setattr(file_handler, "NO_FRAGMENTS", 8)
+    file_id = lead_node.store_file(os.urandom(80_000))
+    log = log_requests(monkeypatch, storage_nodes, lambda name, path, query: 0.05)
+
+    stream = lead_node.retrieve_file_stream(file_id, window=2)
+    next(stream)
+    stream.close()
+    time.sleep(0.3)
+    # The first fragment and the window after it, the rest is never asked for
+    assert len(log.paths("/get_fragment")) <= 3
+
+
+def test_retrieve_file_downloads_every_fragment_at_once(lead_node, storage_nodes, monkeypatch, uncached):
+    data = os.urandom(40_000)
+    file_id = lead_node.store_file(data)
+    log = log_requests(monkeypatch, storage_nodes, lambda name, path, query: 0.1)
+
+    assert lead_node.retrieve_file(file_id) == data
+    assert log.most_running == 4
+
+
+def test_retrieve_skips_nodes_that_left_and_fails_over_missing_replicas(
+    lead_node, storage_nodes, monkeypatch, uncached
+):
+    monkeypatch.setattr(file_handler, "AUTO_REPAIR", False)
+    monkeypatch.setattr(file_handler, "NODE_SELECTION_STRATEGY", None)
+    # Every fragment is on the three nodes of one copy set
+    lead_node.change_replication_strategy("min_copy_sets")
+    data = os.urandom(40_000)
+    file_id = lead_node.store_file(data)
+    copy_set = [replica[0]["name"] for replica in lead_node.metadata.get(file_id)["assigned_nodes"]]
+    nodes = {member["name"]: (member, node) for member, node in storage_nodes}
+    gone, emptied = nodes[copy_set[0]][0], nodes[copy_set[1]][1]
+    lead_node.membership.remove_node(gone)
+    for name in os.listdir(emptied.storage_dir):
+        os.remove(os.path.join(emptied.storage_dir, name))
+    log = log_requests(monkeypatch, storage_nodes)
+
+    assert lead_node.retrieve_file(file_id) == data
+    assert log.paths("/get_fragment", gone["name"]) == []
+    assert len(log.paths("/get_fragment", copy_set[1])) > 0
+
+
+def test_hedged_reads_answer_from_another_replica_when_one_is_slow(
+    lead_node, storage_nodes, monkeypatch, uncached
+):
+    monkeypatch.setattr(file_handler, "HEDGED_READS", True)
+    monkeypatch.setattr(file_handler, "HEDGE_MIN_DELAY", 0.2)
+    monkeypatch.setattr(file_handler, "NODE_SELECTION_STRATEGY", None)
+    lead_node.change_replication_strategy("min_copy_sets")
+    data = os.urandom(40_000)
+    file_id = lead_node.store_file(data)
+    slow = lead_node.metadata.get(file_id)["assigned_nodes"][0][0]["name"]
+    log = log_requests(
+        monkeypatch, storage_nodes,
+        lambda name, path, query: 2 if name == slow and path == "/get_fragment" else 0,
+    )
+
+    start = time.time()
+    assert lead_node.retrieve_file(file_id) == data
+    assert time.time() - start < 1
+    hedged_reads = lead_node.stats()["hedged_reads"]
+    # A busy hedge target can be hedged again, but every fragment came from a hedge
+    assert hedged_reads["hedges_won"] == 4
+    assert hedged_reads["hedges_issued"] >= 4
+    assert len(log.paths("/get_fragment", slow)) == 4
+
+
+def test_the_hedge_delay_follows_recent_download_latency(lead_node, monkeypatch, uncached):
+    monkeypatch.setattr(file_handler, "HEDGE_MIN_DELAY", 0.05)
+    assert lead_node.hedge_delay() == 0.05
+    file_id = lead_node.store_file(os.urandom(40_000))
+    lead_node.retrieve_file(file_id)
+    # Local downloads are far faster than the floor
+    assert lead_node.hedge_delay() == 0.05
+    monkeypatch.setattr(file_handler, "HEDGE_MIN_DELAY", 0)
+    assert 0 < lead_node.hedge_delay() < 0.05
+
+
+def test_store_files_sends_one_batch_per_node(lead_node, storage_nodes, monkeypatch):
+    files = [os.urandom(1000) for _ in range(20)]
+    log = log_requests(monkeypatch, storage_nodes)
+
+    file_ids = lead_node.store_files(files)
+    assert None not in file_ids and len(set(file_ids)) == 20
+    assert log.paths("/upload_fragment") == []
+    for member, _ in storage_nodes:
+        assert len(log.paths("/upload_fragments", member["name"])) <= 1
+    assert [lead_node.retrieve_file(file_id) for file_id in file_ids] == files
+
+
+def test_small_files_are_fetched_in_one_batch_per_node(lead_node, storage_nodes, monkeypatch, uncached):
+    monkeypatch.setattr(file_handler, "BATCH_TRANSFERS", True)
+    data = os.urandom(4000)
+    file_id = lead_node.store_file(data)
+    log = log_requests(monkeypatch, storage_nodes)
+
+    assert lead_node.retrieve_file(file_id) == data
+    assert log.paths("/get_fragment") == []
+    assert 1 <= len(log.paths("/get_fragments")) <= 4
+
+
+def test_deduplicated_files_share_their_fragments_until_the_last_is_deleted(
+    lead_node, storage_nodes, monkeypatch
+):
+    monkeypatch.setattr(file_handler, "DEDUPLICATION", True)
+    data = os.urandom(40_000)
+    first = lead_node.store_file(data)
+    log = log_requests(monkeypatch, storage_nodes)
+    second = lead_node.store_file(data)
+    assert log.requests == []
+    stored = stored_fragments(storage_nodes)
+    assert len(set(stored)) == 4
+
+    lead_node.delete_file(first)
+    assert stored_fragments(storage_nodes) == stored
+    assert lead_node.retrieve_file(second) == data
+    lead_node.delete_file(second)
+    assert stored_fragments(storage_nodes) == []
+
+
+def test_corrupt_replicas_are_skipped_and_counted(lead_node, storage_nodes, monkeypatch, uncached):
+    monkeypatch.setattr(file_handler, "NODE_SELECTION_STRATEGY", None)
+    lead_node.change_replication_strategy("min_copy_sets")
+    data = os.urandom(40_000)
+    file_id = lead_node.store_file(data)
+    first = lead_node.metadata.get(file_id)["assigned_nodes"][0][0]["name"]
+    node = next(node for member, node in storage_nodes if member["name"] == first)
+    for frag_idx in range(4):
+        # Same length, other bytes, and the checksum the node keeps still describes the original
+        with open(os.path.join(node.storage_dir, f"{file_id}_{frag_idx}"), "r+b") as f:
+            f.write(b"\0" * 16)
+
+    assert lead_node.retrieve_file(file_id) == data
+    assert lead_node.stats()["checksum_mismatches"] == 4
+
+
+def test_stored_files_are_read_back_from_the_cache(lead_node, storage_nodes, monkeypatch):
+    data = os.urandom(40_000)
+    file_id = lead_node.store_file(data)
+    log = log_requests(monkeypatch, storage_nodes)
+
+    assert lead_node.retrieve_file(file_id) == data
+    assert b"".join(lead_node.retrieve_range_stream(file_id, 5000, 25_000)) == data[5000:25_000]
+    assert log.requests == []
+    assert lead_node.stats()["fragment_cache"]["hits"] >= 4
+
+    lead_node.delete_file(file_id)
+    assert lead_node.stats()["fragment_cache"]["fragments"] == 0
+
+
+@pytest.mark.parametrize(
+    "start, stop", [(0, 40_000), (0, 1), (39_999, 40_000), (9_999, 10_001), (2_500, 37_500), (10_000, 20_000)]
+)
+def test_ranges_are_read_from_the_fragments_that_hold_them(
+    lead_node, storage_nodes, monkeypatch, uncached, start, stop
+):
+    data = os.urandom(40_000)
+    file_id = lead_node.store_file(data)
+    log = log_requests(monkeypatch, storage_nodes)
+
+    assert b"".join(lead_node.retrieve_range_stream(file_id, start, stop)) == data[start:stop]
+    needed = {frag_idx for frag_idx in range(4) if frag_idx * 10_000 < stop and start < (frag_idx + 1) * 10_000}
+    assert {int(query["frag_idx"]) for query in log.paths("/get_fragment")} == needed
+
+
+def test_only_the_bytes_of_a_range_are_downloaded(lead_node, storage_nodes, monkeypatch, uncached):
+    data = os.urandom(40_000)
+    file_id = lead_node.store_file(data)
+    log = log_requests(monkeypatch, storage_nodes)
+
+    assert b"".join(lead_node.retrieve_range_stream(file_id, 9_000, 11_000)) == data[9_000:11_000]
+    # The end of fragment 0 and the start of fragment 1
+    assert sorted(log.ranges("/get_fragment")) == ["bytes=0-999", "bytes=9000-9999"]
+
+
+def copies_on_live_nodes(lead_node, file_id):
+    """The live nodes holding a confirmed copy, per fragment of a file"""
+    record = lead_node.metadata.get(file_id)
+    live = {node["name"] for node in lead_node.storage_nodes}
+    return [
+        sorted(replica[frag_idx]["name"] for replica in record["assigned_nodes"] if replica[frag_idx]["name"] in live)
+        for frag_idx in range(record["no_fragments"])
+    ]
+
+
+def test_fragments_are_copied_to_replacement_nodes_after_a_node_leaves(
+    lead_node, storage_nodes, monkeypatch, uncached
+):
+    monkeypatch.setattr(file_handler, "NODE_SELECTION_STRATEGY", None)
+    lead_node.change_replication_strategy("min_copy_sets")
+    data = os.urandom(40_000)
+    file_id = lead_node.store_file(data)
+    copy_set = copies_on_live_nodes(lead_node, file_id)[0]
+    spare = next(node for member, node in storage_nodes if member["name"] not in copy_set)
+    gone = next(member for member, _ in storage_nodes if member["name"] == copy_set[0])
+
+    lead_node.membership.remove_node(gone)
+    assert wait_for(lambda: lead_node.repair_status()["repaired"] == 4)
+    assert all(len(set(nodes)) == 3 for nodes in copies_on_live_nodes(lead_node, file_id))
+    assert sorted(spare.list_fragments()) == [f"{file_id}_{frag_idx}" for frag_idx in range(4)]
+    assert lead_node.at_risk_files() == {"lost": [], "under_replicated": []}
+    assert lead_node.retrieve_file(file_id) == data
+
+
+def test_erasure_coded_fragments_are_rebuilt_from_the_others(lead_node, storage_nodes, monkeypatch, uncached):
+    monkeypatch.setattr(file_handler, "STORAGE_MODE", None)
+    monkeypatch.setattr(file_handler, "EC_DATA_FRAGMENTS", 2)
+    monkeypatch.setattr(file_handler, "EC_PARITY_FRAGMENTS", 1)
+    monkeypatch.setattr(file_handler, "NODE_SELECTION_STRATEGY", None)
+    lead_node.change_storage_mode("erasure_coding")
+    # The stripe is on three distinct nodes
+    lead_node.change_replication_strategy("min_copy_sets")
+    data = os.urandom(40_000)
+    file_id = lead_node.store_file(data)
+    stripe = [node["name"] for node in lead_node.metadata.get(file_id)["assigned_nodes"][0]]
+    spare = next(node for member, node in storage_nodes if member["name"] not in stripe)
+    gone = next(member for member, _ in storage_nodes if member["name"] == stripe[1])
+
+    lead_node.membership.remove_node(gone)
+    assert wait_for(lambda: lead_node.repair_status()["repaired"] == 1)
+    assert spare.list_fragments() == [f"{file_id}_1"]
+    assert lead_node.quantify_file_loss()["files_lost"] == 0
+    assert lead_node.retrieve_file(file_id) == data
+
+
+def test_load_aware_placement_learns_node_load_from_transfers(lead_node, storage_nodes, monkeypatch, uncached):
+    monkeypatch.setattr(file_handler, "NODE_SELECTION_STRATEGY", None)
+    lead_node.change_replication_strategy("load_aware")
+    data = os.urandom(40_000)
+    file_id = lead_node.store_file(data)
+    assert lead_node.retrieve_file(file_id) == data
+
+    node_load = lead_node.stats()["node_load"]
+    used = {node["name"] for replica in lead_node.metadata.get(file_id)["assigned_nodes"] for node in replica}
+    for name in used:
+        assert node_load[name]["latency"] > 0 and node_load[name]["in_flight"] == 0
+
+
+def test_compressed_fragments_are_stored_smaller_and_read_back_whole(
+    lead_node, storage_nodes, monkeypatch, uncached
+):
+    data = b"".join(f"line {i}\n".encode() for i in range(10_000))
+    file_id = lead_node.store_file(data, "zlib")
+    record = lead_node.metadata.get(file_id)
+    assert record["compression"] == {"codec": "zlib", "fragments": [True] * 4}
+    node = next(node for member, node in storage_nodes if member["name"] == record["assigned_nodes"][0][0]["name"])
+    assert os.path.getsize(os.path.join(node.storage_dir, f"{file_id}_0")) < record["fragment_sizes"][0] / 2
+
+    assert lead_node.retrieve_file(file_id) == data
+    assert b"".join(lead_node.retrieve_range_stream(file_id, 1000, 30_000)) == data[1000:30_000]
+    assert "Unknown" in lead_node.set_compression("snappy")["message"]
+    assert "compression" not in lead_node.metadata.get(lead_node.store_file(data, "none"))
+
+
+@pytest.fixture
+def direct_lead_node(storage_nodes, monkeypatch):
+    # The secret is read when the lead node starts, and by the storage nodes on each request
+    monkeypatch.setattr(file_handler, "TOKEN_SECRET", "secret")
+    for _, node in storage_nodes:
+        monkeypatch.setattr(node, "TOKEN_SECRET", "secret")
+    return FileHandler(InMemoryMetadataStore(), FakeMembership([member for member, _ in storage_nodes]))
+
+
+def test_clients_store_and_retrieve_files_through_the_storage_nodes(direct_lead_node, monkeypatch, uncached):
+    monkeypatch.setattr(file_handler, "NODE_SELECTION_STRATEGY", None)
+    direct_lead_node.change_replication_strategy("min_copy_sets")
+    data = os.urandom(10_000)
+    plan = direct_lead_node.plan_store(len(data))
+    file_id = plan["file_id"]
+
+    offset, checksums = 0, []
+    for frag_idx, size in enumerate(plan["fragment_sizes"]):
+        frag = data[offset:offset + size]
+        offset += size
+        checksums.append(checksum(frag))
+        for replica in plan["assigned_nodes"]:
+            node = replica[frag_idx]
+            reply = requests.post(
+                f"http://{node['ip']}:5000/direct/upload_fragment",
+                params={"file_id": file_id, "frag_idx": frag_idx},
+                data=frag,
+                headers={"X-Token": plan["tokens"][frag_idx], "X-Checksum": checksums[-1]},
+            )
+            assert reply.status_code == 200
+    # A token only lets its own fragment be uploaded
+    node = plan["assigned_nodes"][0][1]
+    reply = requests.post(
+        f"http://{node['ip']}:5000/direct/upload_fragment",
+        params={"file_id": file_id, "frag_idx": 1},
+        data=b"x",
+        headers={"X-Token": plan["tokens"][0]},
+    )
+    assert reply.status_code == 403
+
+    assert direct_lead_node.retrieve_file(file_id) == b""
+    assert direct_lead_node.commit_store(file_id, checksums) == {"file_id": file_id}
+    assert direct_lead_node.retrieve_file(file_id) == data
+
+    retrieved = b""
+    for fragment in direct_lead_node.plan_retrieve(file_id)["fragments"]:
+        reply = requests.get(
+            f"http://{fragment['nodes'][0]['ip']}:5000/direct/get_fragment",
+            params={"file_id": fragment["file_id"], "frag_idx": fragment["frag_idx"]},
+            headers={"X-Token": fragment["token"]},
+        )
+        assert reply.status_code == 200
+        retrieved += reply.content
+    assert retrieved == data
+
+
+def test_direct_transfers_need_a_secret_and_plain_replication(lead_node, direct_lead_node, monkeypatch):
+    assert "disabled" in lead_node.plan_store(1000)["message"]
+    assert "disabled" in lead_node.plan_retrieve("file_1")["message"]
+    monkeypatch.setattr(file_handler, "COMPRESSION", "zlib")
+    assert "use /store" in direct_lead_node.plan_store(1000)["message"]
@@ -0,0 +1,116 @@
+import asyncio
+import threading
+
+import pytest
+
+from fragment_cache import FragmentCache
+
+
+def test_least_recently_used_fragments_are_evicted_to_stay_within_budget():
+    cache = FragmentCache(30)
+    for frag_idx in range(3):
+        cache.put(("file_1", frag_idx), bytes(10))
+    cache.get(("file_1", 0))
+    cache.put(("file_1", 3), bytes(10))
+
+    assert cache.get(("file_1", 1)) is None
+    assert cache.get(("file_1", 0)) is not None
+    stats = cache.stats()
+    assert stats["bytes"] == 30 and stats["fragments"] == 3 and stats["evictions"] == 1
+
+
+def test_fragments_larger_than_the_budget_are_not_cached():
+    cache = FragmentCache(10)
+    cache.put(("file_1", 0), bytes(11))
+    assert cache.get(("file_1", 0)) is None
+    assert cache.stats()["bytes"] == 0
+
+
+def test_invalidate_drops_every_fragment_of_a_file():
+    cache = FragmentCache(100)
+    for file_id in ("file_1", "file_2"):
+        for frag_idx in range(2):
+            cache.put((file_id, frag_idx), bytes(10))
+    cache.invalidate("file_1", 2)
+    assert cache.get(("file_1", 0)) is None and cache.get(("file_1", 1)) is None
+    assert cache.get(("file_2", 0)) is not None
+    assert cache.stats()["bytes"] == 20
+
+
+def test_concurrent_misses_load_a_fragment_once():
+    cache = FragmentCache(100)
+    loading, release = threading.Event(), threading.Event()
+    loads = []
+
+    def loader():
+        loads.append(1)
+        loading.set()
+        release.wait(5)
+        return b"fragment"
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get_or_load(("file_1", 0), loader)))
+        for _ in range(5)
+    ]
+    threads[0].start()
+    assert loading.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == [b"fragment"] * 5 and loads == [1]
+    stats = cache.stats()
+    assert stats["misses"] == 1 and stats["coalesced"] + stats["hits"] == 4
+
+
+def test_a_failed_load_is_not_cached_and_reaches_every_waiter():
+    cache = FragmentCache(100)
+    assert cache.get_or_load(("file_1", 0), lambda: None) is None
+    assert cache.stats()["fragments"] == 0
+
+    def loader():
+        raise IOError("node is gone")
+
+    with pytest.raises(IOError):
+        cache.get_or_load(("file_1", 0), loader)
+    assert cache.get_or_load(("file_1", 0), lambda: b"fragment") == b"fragment"
+
+
+def test_get_or_load_many_loads_only_the_missing_fragments():
+    cache = FragmentCache(100)
+    cache.put(("file_1", 1), b"one")
+    asked = []
+
+    def loader(keys):
+        asked.append(sorted(keys))
+        return {key: f"fragment {key[1]}".encode() for key in keys}
+
+    keys = [("file_1", frag_idx) for frag_idx in range(3)]
+    assert cache.get_or_load_many(keys, loader) == [b"fragment 0", b"one", b"fragment 2"]
+    assert asked == [[("file_1", 0), ("file_1", 2)]]
+
+
+def test_misses_on_the_event_loop_are_coalesced_and_survive_a_cancelled_loader():
+    cache = FragmentCache(100)
+    loads = []
+
+    async def loader():
+        loads.append(1)
+        await asyncio.sleep(0.1)
+        return b"data"
+
+    async def main():
+        first = asyncio.ensure_future(cache.get_or_load_async(("file_1", 0), loader))
+        await asyncio.sleep(0.01)
+        others = [asyncio.ensure_future(cache.get_or_load_async(("file_1", 0), loader)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        # The waiters load the fragment themselves once the first caller goes away
+        first.cancel()
+        assert await asyncio.gather(*others) == [b"data"] * 3
+
+    asyncio.run(main())
+    assert len(loads) == 2
+    assert cache.get(("file_1", 0)) == b"data"
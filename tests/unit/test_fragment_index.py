@@ -0,0 +1,104 @@
+from fragment_index import FragmentIndex
+
+
+def node(name):
+    return {"name": name, "ip": name}
+
+
+def replicated(*replicas, pending=()):
+    return {"assigned_nodes": [[node(name) for name in replica] for replica in replicas], "pending": list(pending)}
+
+
+def index_with_nodes(*names):
+    index = FragmentIndex()
+    index.load([])
+    for name in names:
+        index.node_up(name)
+    return index
+
+
+def test_counts_follow_nodes_leaving_and_joining():
+    index = index_with_nodes("a", "b", "c")
+    index.add_file("f", replicated(["a", "b"], ["b", "c"]), 2)
+    index.add_file("g", replicated(["c", "c"], ["c", "c"]), 2)
+    assert (index.files_lost(), index.total_files()) == (0, 2)
+
+    index.node_down("c")
+    assert index.at_risk_files() == {"lost": ["g"], "under_replicated": ["f"]}
+    index.node_down("b")
+    assert index.files_lost() == 2
+    index.node_up("b")
+    index.node_up("c")
+    assert index.at_risk_files() == {"lost": [], "under_replicated": []}
+
+
+def test_erasure_coded_file_survives_until_fewer_than_k_fragments():
+    index = index_with_nodes("a", "b", "c", "d", "e", "f")
+    index.add_file("f", replicated(["a", "b", "c", "d", "e", "f"]), 4)
+    index.node_down("a")
+    index.node_down("b")
+    assert index.at_risk_files() == {"lost": [], "under_replicated": ["f"]}
+    index.node_down("c")
+    assert index.files_lost() == 1
+
+
+def test_pending_copies_count_as_missing():
+    index = index_with_nodes("a", "b")
+    index.add_file("f", replicated(["a"], ["b"], pending=[[1, 0]]), 1)
+    assert index.at_risk_files()["under_replicated"] == ["f"]
+    assert index.fragments_on_node("b") == []
+    assert index.fragments_to_repair() == [(1, "f", 0)]
+
+
+def test_fragments_to_repair_of_a_node():
+    index = index_with_nodes("a", "b", "c")
+    index.add_file("f", replicated(["a", "b"], ["c", "c"]), 2)
+    index.node_down("c")
+    assert sorted(index.fragments_to_repair("c")) == [(1, "f", 0), (1, "f", 1)]
+    # Fragment 0 has no copy left, so the file is lost and nothing can be copied
+    index.node_down("a")
+    assert index.fragments_to_repair("c") == []
+
+
+def test_readding_and_removing_files():
+    index = index_with_nodes("a", "b")
+    index.add_file("f", replicated(["a"]), 1)
+    index.add_file("f", replicated(["b"]), 1)
+    assert index.fragments_on_node("a") == []
+    assert index.fragments_on_node("b") == [("f", 0)]
+    index.remove_file("f")
+    assert index.total_files() == 0
+    index.node_down("b")
+    assert index.files_lost() == 0
+
+
+def test_files_changed_while_loading_keep_their_current_state():
+    index = FragmentIndex()
+    index.node_up("a")
+    index.node_up("b")
+    index.add_file("new", replicated(["a"]), 1)
+    index.add_file("moved", replicated(["b"]), 1)
+    index.remove_file("deleted")
+    assert not index.loaded()
+
+    index.load([
+        ("old", replicated(["a"]), 1),
+        ("moved", replicated(["a"]), 1),
+        ("deleted", replicated(["a"]), 1),
+    ])
+    assert index.loaded()
+    assert sorted(index.fragments_on_node("a")) == [("new", 0), ("old", 0)]
+    assert index.fragments_on_node("b") == [("moved", 0)]
+    assert index.total_files() == 3
+
+
+def test_clear_stops_a_load():
+    index = FragmentIndex()
+
+    def files():
+        yield "f", replicated(["a"]), 1
+        index.clear()
+        yield "g", replicated(["a"]), 1
+
+    index.load(files())
+    assert index.total_files() == 0 and index.loaded()
@@ -0,0 +1,18 @@
+import pytest
+
+from framing import encode_records, iter_records
+
+
+def test_round_trip_with_missing_and_empty_records():
+    records = [("file_1", 0, b"abc"), ("file_1", 1, None), ("file_é", 7, b""), ("f", 2**31, b"x" * 1000)]
+    decoded = [
+        (file_id, frag_idx, None if data is None else bytes(data))
+        for file_id, frag_idx, data in iter_records(encode_records(records))
+    ]
+    assert decoded == records
+
+
+def test_truncated_body():
+    body = encode_records([("file_1", 0, b"abcdef")])
+    with pytest.raises(ValueError):
+        list(iter_records(body[:-1]))
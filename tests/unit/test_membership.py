@@ -0,0 +1,77 @@
+import pytest
+
+from file_handler import FileHandler
+from membership import FakeMembership, create_membership, FAKE_MEMBERSHIP
+from metadata_store import InMemoryMetadataStore
+from node_selection import MIN_COPY_SETS_SELECTION, RANDOM_SELECTION, BuddySelection, MinCopySetsSelection
+
+
+def nodes(count, start=0):
+    # Nothing listens on these, so the lead node's background stats polls fail fast
+    return [{"name": f"storage-{i}", "ip": f"127.0.0.{100 + i}"} for i in range(start, start + count)]
+
+
+def names(node_list):
+    return sorted(node["name"] for node in node_list)
+
+
+def test_fake_membership_reports_joins_and_leaves():
+    changes = []
+    members = nodes(3)
+    membership = create_membership(FAKE_MEMBERSHIP, "default", "app=storage-node", 60, members)
+    assert isinstance(membership, FakeMembership)
+
+    membership.start(lambda joined, left: changes.append((names(joined), names(left))))
+    assert changes == [(names(members), [])]
+
+    membership.add_node(nodes(1, start=3)[0])
+    membership.kill(members[0])
+    assert changes[1:] == [(["storage-3"], []), ([], ["storage-0"])]
+    assert names(membership.nodes()) == ["storage-1", "storage-2", "storage-3"]
+
+
+@pytest.mark.parametrize(
+    "strategy, groups", [(MinCopySetsSelection, "copy_sets"), (BuddySelection, "buddies")]
+)
+def test_groups_are_formed_again_when_every_group_lost_a_node(strategy, groups):
+    # 8 nodes make four copy sets or two buddy groups of two replicas
+    selector = strategy(nodes(8), 4, 2)
+    assert len(getattr(selector, groups)) > 1
+    # Every group is left with one node and there are no spares to fill the places of the others
+    for group in [list(group) for group in getattr(selector, groups)]:
+        for node in group[1:]:
+            selector.remove_node(node)
+
+    placement = selector.choose_nodes("file", 4)
+    assert len(placement) == 2
+    for frag_idx in range(4):
+        replicas = [placement[replica_idx][frag_idx] for replica_idx in range(2)]
+        assert len({node["name"] for node in replicas}) == 2
+        assert all(node in selector.nodes for node in replicas)
+
+
+@pytest.mark.parametrize("strategy", [MinCopySetsSelection, BuddySelection])
+def test_too_few_nodes_for_a_group_is_a_value_error(strategy):
+    selector = strategy(nodes(2), 4, 3)
+    with pytest.raises(ValueError):
+        selector.choose_nodes("file", 4)
+
+
+def test_file_handler_runs_on_fake_membership():
+    members = nodes(2)
+    membership = FakeMembership(members)
+    handler = FileHandler(InMemoryMetadataStore(), membership)
+    assert names(handler.storage_nodes) == names(members)
+
+    membership.add_node(nodes(1, start=2)[0])
+    assert names(handler.storage_nodes) == ["storage-0", "storage-1", "storage-2"]
+    handler.kill_storage_nodes(1)
+    assert len(handler.storage_nodes) == 2
+
+    # Two nodes cannot hold a copy set of three replicas, so the store fails before any upload
+    handler.change_replication_strategy(MIN_COPY_SETS_SELECTION)
+    try:
+        assert handler.store_file(b"x" * 1000) is None
+        assert handler.store_files([b"x" * 1000, b"y" * 1000]) == [None, None]
+    finally:
+        handler.change_replication_strategy(RANDOM_SELECTION)
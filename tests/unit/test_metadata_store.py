@@ -0,0 +1,77 @@
+import sqlite3
+import threading
+
+import pytest
+
+from metadata_store import InMemoryMetadataStore, SQLiteMetadataStore
+
+
+def open_store(path):
+    return SQLiteMetadataStore(str(path), 0.01, 64)
+
+
+RECORD = {"size": 3, "no_fragments": 1, "assigned_nodes": [[{"name": "storage-0", "ip": "10.0.0.1"}]]}
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_put_get_delete(backend, tmp_path):
+    store = InMemoryMetadataStore() if backend == "memory" else open_store(tmp_path / "metadata.db")
+    store.put_many([("file_1", RECORD), ("file_2", RECORD)])
+    store.put("file_1", dict(RECORD, size=4))
+    assert store.get("file_1")["size"] == 4
+    assert "file_2" in store and len(store) == 2
+    store.delete("file_2")
+    assert store.get("file_2") is None and len(store) == 1
+    assert dict(store.items()) == {"file_1": dict(RECORD, size=4)}
+
+
+def test_records_survive_a_restart(tmp_path):
+    store = open_store(tmp_path / "metadata.db")
+    store.put_many([(f"file_{i}", RECORD) for i in range(100)])
+    store.put_epoch(0, [{"name": "storage-0", "ip": "10.0.0.1"}])
+    store.close()
+
+    reopened = open_store(tmp_path / "metadata.db")
+    assert len(reopened) == 100
+    assert reopened.get("file_42") == RECORD
+    assert reopened.latest_epoch() == (0, [{"name": "storage-0", "ip": "10.0.0.1"}])
+
+
+def test_concurrent_writes_are_committed_together(tmp_path):
+    store = open_store(tmp_path / "metadata.db")
+    threads = [
+        threading.Thread(target=store.put, args=(f"file_{i}", RECORD)) for i in range(50)
+    ]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+    assert len(store) == 50
+
+
+def test_failed_commits_are_reported_to_every_writer(tmp_path):
+    path = tmp_path / "metadata.db"
+    store = open_store(path)
+    store.put("file_0", RECORD)
+    conn = sqlite3.connect(str(path))
+    conn.execute("CREATE TRIGGER fail BEFORE INSERT ON files BEGIN SELECT RAISE(ABORT, 'disk full'); END")
+    conn.commit()
+
+    with pytest.raises(IOError, match="disk full"):
+        store.put_many([("file_1", RECORD), ("file_2", RECORD)])
+    errors = []
+
+    def put(file_id):
+        try:
+            store.put(file_id, RECORD)
+        except IOError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=put, args=(f"file_{i}",)) for i in range(3, 10)]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+    assert len(errors) == 7
+    assert store.get("file_1") is None and len(store) == 1
+
+    conn.execute("DROP TRIGGER fail")
+    conn.commit()
+    store.put("file_1", RECORD)
+    assert len(store) == 2
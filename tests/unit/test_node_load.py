@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import Counter
+
+from node_load import NodeLoad
+from node_selection import LoadAwareSelection, RandomSelection
+
+NODE = {"name": "storage-0", "ip": "10.0.0.1"}
+OTHER = {"name": "storage-1", "ip": "10.0.0.2"}
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_nearly_full_nodes_are_avoided():
+    load = NodeLoad(1.0, 0.05)
+    load.set_disk_usage(NODE, 50, 100)
+    load.set_disk_usage(OTHER, 1, 100)
+    assert load.score(NODE) < float("inf") == load.score(OTHER)
+
+
+def test_a_node_that_comes_back_starts_without_requests_in_flight():
+    load = NodeLoad(1.0, 0.05)
+    started, release = threading.Event(), threading.Event()
+
+    def slow_request():
+        started.set()
+        release.wait(5)
+
+    thread = threading.Thread(target=load.call, args=(NODE, slow_request))
+    thread.start()
+    assert started.wait(5)
+    assert load.stats()["storage-0"]["in_flight"] == 1
+
+    # The node leaves while the request is still running and comes back under the same name
+    load.forget(NODE)
+    assert "storage-0" not in load.stats()
+    release.set()
+    thread.join(5)
+    assert "storage-0" not in load.stats()
+
+    assert load.call(NODE, lambda: "reply") == "reply"
+    assert load.stats()["storage-0"]["in_flight"] == 0
+
+
+def test_scores_grow_with_latency_and_requests_in_flight():
+    load = NodeLoad(0.5, 0.05)
+    load.call(NODE, time.sleep, 0.02)
+    load.call(OTHER, time.sleep, 0.1)
+    assert load.score(NODE) < load.score(OTHER)
+    # A node without samples is assumed to be average
+    assert load.score(NODE) < load.score({"name": "storage-2"}) < load.score(OTHER)
+
+    release = threading.Event()
+    threads = [threading.Thread(target=load.call, args=(NODE, release.wait, 5)) for _ in range(9)]
+    for thread in threads:
+        thread.start()
+    try:
+        assert wait_for(lambda: load.stats()["storage-0"]["in_flight"] == 9)
+        assert load.score(NODE) > load.score(OTHER)
+    finally:
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+
+def test_load_aware_selection_keeps_the_less_loaded_placement():
+    nodes = [{"name": f"storage-{i}", "ip": f"10.0.0.{i}"} for i in range(6)]
+    load = NodeLoad(1.0, 0.05)
+    for node in nodes:
+        load.set_disk_usage(node, 50, 100)
+    # storage-0 is nearly full, every other node is equally loaded
+    load.set_disk_usage(nodes[0], 1, 100)
+    selection = LoadAwareSelection(RandomSelection(nodes, 4, 2), load)
+
+    chosen = Counter(
+        node["name"] for _ in range(200) for replica in selection.choose_nodes("file_1") for node in replica
+    )
+    # A random placement picks storage-0 for about a third of the fragments, the better of two for far fewer
+    assert chosen["storage-0"] < 0.15 * sum(chosen.values())
+    # Only both draws landing on storage-0 pick it, a quarter of the time
+    replacements = Counter(selection.choose_replacement(nodes[1:5])["name"] for _ in range(200))
+    assert replacements["storage-5"] > 120
+    assert selection.choose_replacement(nodes) is None
@@ -0,0 +1,107 @@
+import pytest
+
+from erasure_coding import REPLICATION, ERASURE_CODING
+from metadata_store import InMemoryMetadataStore
+from node_selection import RendezvousSelection, rendezvous_nodes
+from placement import PlacementEpochs
+
+
+def nodes(count, start=0):
+    return [{"name": f"storage-{i}", "ip": f"10.0.0.{i}"} for i in range(start, start + count)]
+
+
+KEYS = [f"file_{i}/{frag_idx}" for i in range(500) for frag_idx in range(4)]
+
+
+def test_rendezvous_is_deterministic_and_order_independent():
+    members = nodes(8)
+    for key in KEYS[:50]:
+        assert rendezvous_nodes(members, key, 3) == rendezvous_nodes(list(reversed(members)), key, 3)
+        assert len({node["name"] for node in rendezvous_nodes(members, key, 3)}) == 3
+
+
+def test_adding_a_node_only_moves_fragments_onto_it():
+    before, after = nodes(10), nodes(11)
+    moved = 0
+    for key in KEYS:
+        old, new = rendezvous_nodes(before, key, 1)[0], rendezvous_nodes(after, key, 1)[0]
+        if old != new:
+            assert new["name"] == "storage-10"
+            moved += 1
+    # About 1/11 of the fragments
+    assert 0.05 < moved / len(KEYS) < 0.15
+
+
+def test_removing_a_node_only_moves_its_fragments():
+    before = nodes(10)
+    after = [node for node in before if node["name"] != "storage-3"]
+    for key in KEYS:
+        old, new = rendezvous_nodes(before, key, 3), rendezvous_nodes(after, key, 3)
+        if all(node["name"] != "storage-3" for node in old):
+            assert old == new
+        else:
+            survivors = [node for node in old if node["name"] != "storage-3"]
+            assert new[: len(survivors)] == survivors
+
+
+def test_no_nodes():
+    with pytest.raises(ValueError):
+        rendezvous_nodes([], "file_1/0", 3)
+
+
+def place(selector, file_id, no_fragments, epoch):
+    return {
+        "storage_mode": REPLICATION,
+        "assigned_nodes": selector.choose_nodes(file_id, no_fragments),
+        "size": 10,
+        "no_fragments": no_fragments,
+        "epoch": epoch,
+        "replicas": selector.no_replicas,
+    }
+
+
+def test_records_store_only_the_epoch_and_resolve_after_membership_changes():
+    epochs = PlacementEpochs(InMemoryMetadataStore())
+    members = nodes(6)
+    epoch = epochs.advance(members)
+    record = place(RendezvousSelection(members, 4, 3), "file_1", 4, epoch)
+
+    stored = epochs.compact("file_1", record)
+    assert "assigned_nodes" not in stored and "overrides" not in stored
+    epochs.advance(nodes(7))
+    assert epochs.resolve("file_1", stored) == record
+
+
+def test_repaired_columns_are_kept_as_overrides():
+    epochs = PlacementEpochs(InMemoryMetadataStore())
+    epoch = epochs.advance(nodes(6))
+    record = place(RendezvousSelection(nodes(6), 3, 2), "file_1", 3, epoch)
+    record["assigned_nodes"][1][2] = {"name": "storage-9", "ip": "10.0.0.9"}
+
+    stored = epochs.compact("file_1", record)
+    assert list(stored["overrides"]) == ["2"]
+    assert epochs.resolve("file_1", stored) == record
+
+
+def test_erasure_coded_stripes():
+    epochs = PlacementEpochs(InMemoryMetadataStore())
+    epoch = epochs.advance(nodes(8))
+    stripe = RendezvousSelection(nodes(8), 1, 6).choose_nodes("file_1")
+    record = {
+        "storage_mode": ERASURE_CODING,
+        "assigned_nodes": [[replica[0] for replica in stripe]],
+        "size": 10,
+        "no_fragments": 6,
+        "ec": {"k": 4, "m": 2},
+        "epoch": epoch,
+    }
+    assert epochs.resolve("file_1", epochs.compact("file_1", record)) == record
+
+
+def test_epochs_outlive_the_lead_node():
+    metadata = InMemoryMetadataStore()
+    epochs = PlacementEpochs(metadata)
+    assert epochs.advance(nodes(3)) == 0
+    assert epochs.advance(list(reversed(nodes(3)))) == 0
+    assert epochs.advance(nodes(4)) == 1
+    assert PlacementEpochs(metadata).current == 1
@@ -0,0 +1,82 @@
+import threading
+import time
+
+from repair import RepairEngine, confirm_slot
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class Repairs:
+    """A repair_fragment that records what it repairs, holding the first repair until released"""
+
+    def __init__(self, failing=()):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.repaired = []
+        self.failing = set(failing)
+
+    def __call__(self, file_id, frag_idx):
+        self.started.set()
+        self.release.wait(5)
+        if (file_id, frag_idx) in self.failing:
+            raise IOError("no replacement node")
+        self.repaired.append((file_id, frag_idx))
+        return 100
+
+
+def test_fragments_with_fewest_copies_left_are_repaired_first():
+    repairs = Repairs()
+    engine = RepairEngine(repairs, 1, 1024 * 1024 * 1024)
+    engine.enqueue([(2, "file_0", 0)])
+    assert repairs.started.wait(5)
+    engine.enqueue([(2, "file_1", 0), (1, "file_2", 0), (2, "file_3", 0)])
+    # A fragment that is queued again with fewer copies moves up
+    engine.enqueue([(0, "file_3", 0), (2, "file_2", 0)])
+    assert engine.status()["queued"] == 3
+
+    repairs.release.set()
+    assert wait_for(lambda: len(repairs.repaired) == 4)
+    assert repairs.repaired == [("file_0", 0), ("file_3", 0), ("file_2", 0), ("file_1", 0)]
+    status = engine.status()
+    assert status["repaired"] == 4 and status["bytes_copied"] == 400 and status["queued"] == 0
+
+
+def test_failed_repairs_are_kept_until_they_are_retried():
+    repairs = Repairs(failing={("file_1", 0)})
+    repairs.release.set()
+    engine = RepairEngine(repairs, 2, 1024 * 1024 * 1024)
+    engine.enqueue([(1, "file_1", 0), (1, "file_2", 0)])
+    assert wait_for(lambda: engine.status()["failed"] == 1 and engine.status()["repaired"] == 1)
+    assert engine.status()["last_error"] == "no replacement node"
+
+    repairs.failing = set()
+    engine.retry_failed()
+    assert wait_for(lambda: engine.status()["repaired"] == 2)
+    assert engine.status()["failed"] == 0
+
+
+def test_repairs_are_throttled_to_the_copy_rate():
+    repairs = Repairs()
+    repairs.release.set()
+    # 100 bytes per repair at 1000 bytes per second
+    engine = RepairEngine(repairs, 2, 1000)
+    start = time.time()
+    engine.enqueue([(1, f"file_{i}", 0) for i in range(4)])
+    assert wait_for(lambda: engine.status()["repaired"] == 4)
+    # The last repair starts once the first three are paid for
+    assert time.time() - start >= 0.15
+
+
+def test_confirm_slot_drops_the_pending_slot():
+    record = {"pending": [[1, 0], [2, 3]]}
+    confirm_slot(record, 1, 0)
+    assert record == {"pending": [[2, 3]]}
+    confirm_slot(record, 2, 3)
+    assert record == {}
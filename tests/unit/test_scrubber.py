@@ -0,0 +1,43 @@
+from checksum import checksum
+from scrubber import Scrubber
+
+
+def scrubber_of(fragments):
+    """A scrubber over a dict of key -> (data, checksum) that never starts a pass by itself"""
+
+    def read_fragment(key):
+        if key not in fragments:
+            return None
+        data, crc = fragments[key]
+        return [data[:3], data[3:]], crc
+
+    return Scrubber(lambda: list(fragments), read_fragment, 1024 * 1024 * 1024, 3600)
+
+
+def test_a_pass_marks_fragments_that_do_not_match_their_checksum():
+    fragments = {
+        "file_1_0": (b"intact", checksum(b"intact")),
+        "file_1_1": (b"rotten", checksum(b"before")),
+        "file_1_2": (b"unchecked", None),
+    }
+    scrubber = scrubber_of(fragments)
+    scrubber.scrub()
+
+    assert scrubber.is_corrupt("file_1_1")
+    assert not scrubber.is_corrupt("file_1_0") and not scrubber.is_corrupt("file_1_2")
+    report = scrubber.report()
+    assert report["passes"] == 1 and report["corrupt"] == ["file_1_1"]
+    assert report["fragments_checked"] == 3 and report["bytes_checked"] == 21
+
+
+def test_a_rewritten_fragment_is_no_longer_corrupt():
+    fragments = {"file_1_0": (b"rotten", checksum(b"before"))}
+    scrubber = scrubber_of(fragments)
+    scrubber.scrub()
+    assert scrubber.is_corrupt("file_1_0")
+
+    fragments["file_1_0"] = (b"after", checksum(b"after"))
+    scrubber.forget("file_1_0")
+    scrubber.scrub()
+    assert not scrubber.is_corrupt("file_1_0")
+    assert scrubber.report()["corrupt"] == []
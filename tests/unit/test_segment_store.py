@@ -0,0 +1,112 @@
+import os
+
+import pytest
+
+from checksum import checksum
+from segment_store import SegmentStore
+
+
+def open_store(directory, segment_size=4096):
+    # Compaction only runs when a test asks for it
+    return SegmentStore(str(directory), segment_size, 3600, 0.5)
+
+
+def put(store, key, data):
+    store.put(key, [data], len(data), checksum(data))
+
+
+def test_put_get_delete(tmp_path):
+    store = open_store(tmp_path)
+    put(store, "file_1_0", b"hello")
+    assert store.get("file_1_0") == (b"hello", checksum(b"hello"))
+    assert store.get_range("file_1_0", 1, 3) == b"el"
+    assert store.length("file_1_0") == 5
+    assert store.checksum("file_1_0") == checksum(b"hello")
+    assert store.delete("file_1_0")
+    assert not store.delete("file_1_0")
+    assert store.get("file_1_0") is None
+    assert store.checksum("file_1_0") is None
+
+
+def test_reopen_after_sealing_and_overwrites(tmp_path):
+    store = open_store(tmp_path)
+    fragments = {f"file_{i}_0": os.urandom(700) for i in range(20)}
+    for key, data in fragments.items():
+        put(store, key, data)
+    fragments["file_3_0"] = b"new"
+    put(store, "file_3_0", b"new")
+    store.delete("file_4_0")
+    del fragments["file_4_0"]
+
+    reopened = open_store(tmp_path)
+    assert sorted(reopened.keys()) == sorted(fragments)
+    for key, data in fragments.items():
+        assert reopened.get(key) == (data, checksum(data))
+
+
+def test_reopen_after_compaction(tmp_path):
+    store = open_store(tmp_path)
+    fragments = {f"file_{i}_0": os.urandom(700) for i in range(30)}
+    for key, data in fragments.items():
+        put(store, key, data)
+    # Leave the first segments mostly garbage, with tombstones that still hide older puts
+    for i in range(25):
+        store.delete(f"file_{i}_0")
+        del fragments[f"file_{i}_0"]
+    put(store, "file_0_0", b"again")
+    fragments["file_0_0"] = b"again"
+    segments_before = len(os.listdir(tmp_path))
+    store.compact()
+    assert len(os.listdir(tmp_path)) < segments_before
+
+    for reopened in (store, open_store(tmp_path)):
+        assert sorted(reopened.keys()) == sorted(fragments)
+        for key, data in fragments.items():
+            assert reopened.get(key) == (data, checksum(data))
+
+
+def test_torn_write_is_cut_off(tmp_path):
+    store = open_store(tmp_path, segment_size=1 << 20)
+    put(store, "file_1_0", b"intact")
+    put(store, "file_2_0", b"torn" * 100)
+    (segment,) = os.listdir(tmp_path)
+    path = os.path.join(tmp_path, segment)
+    os.truncate(path, os.path.getsize(path) - 10)
+
+    reopened = open_store(tmp_path, segment_size=1 << 20)
+    assert reopened.keys() == ["file_1_0"]
+    put(reopened, "file_3_0", b"after")
+    assert open_store(tmp_path, segment_size=1 << 20).get("file_3_0") == (b"after", checksum(b"after"))
+
+
+def test_reads_survive_compaction_of_their_segment(tmp_path):
+    store = open_store(tmp_path)
+    fragments = {f"file_{i}_0": os.urandom(700) for i in range(10)}
+    for key, data in fragments.items():
+        put(store, key, data)
+    view, _ = store.get("file_0_0")
+    for i in range(1, 10):
+        store.delete(f"file_{i}_0")
+    store.compact()
+    # The view maps the removed segment until it is released
+    assert view == fragments["file_0_0"]
+    assert store.get("file_0_0")[0] == fragments["file_0_0"]
+
+
+def test_a_failed_put_leaves_no_record(tmp_path):
+    store = open_store(tmp_path, segment_size=1 << 20)
+    put(store, "file_1_0", b"intact")
+
+    def broken_upload():
+        yield b"partial"
+        raise IOError("client went away")
+
+    with pytest.raises(IOError):
+        store.put("file_2_0", broken_upload(), 100, checksum(b"x"))
+    with pytest.raises(ValueError):
+        store.put("file_3_0", [b"short"], 100, checksum(b"short"))
+    put(store, "file_4_0", b"after")
+
+    reopened = open_store(tmp_path, segment_size=1 << 20)
+    assert sorted(reopened.keys()) == ["file_1_0", "file_4_0"]
+    assert reopened.get("file_4_0") == (b"after", checksum(b"after"))
@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+
+import tokens
+from checksum import checksum
+from conftest import load_storage_node
+
+SECRET = "secret"
+
+
+@pytest.fixture(params=["files", "segments"])
+def storage_node(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("STORAGE_ENGINE", request.param)
+    monkeypatch.setenv("TOKEN_SECRET", SECRET)
+    return load_storage_node("storage_node_app")
+
+
+def direct_upload(client, data, crc=None):
+    token = tokens.sign(SECRET, tokens.UPLOAD, "file_1", 0, int(time.time()) + 60)
+    return client.post(
+        "/direct/upload_fragment?file_id=file_1&frag_idx=0",
+        data=data,
+        headers={"X-Token": token, "X-Checksum": crc or checksum(data)},
+    )
+
+
+def test_direct_uploads_are_write_once(storage_node):
+    client = storage_node.app.test_client()
+    assert direct_upload(client, b"first").status_code == 200
+    assert direct_upload(client, b"first").status_code == 200
+    assert direct_upload(client, b"second").status_code == 409
+    assert direct_upload(client, b"third", crc="00000000").status_code == 400
+    assert storage_node.read_fragment("file_1", 0) == (b"first", checksum(b"first"))
+
+
+def test_concurrent_direct_uploads_store_one_fragment(storage_node, monkeypatch):
+    first, second = b"a" * 1000, b"b" * 1000
+    paused, release = threading.Event(), threading.Event()
+    existing_checksum = storage_node.existing_checksum
+
+    def slow_existing_checksum(file_id, frag_idx):
+        # The first upload stops right after looking for the fragment, until the second one ran
+        found = existing_checksum(file_id, frag_idx)
+        if not paused.is_set():
+            paused.set()
+            release.wait(5)
+        return found
+
+    monkeypatch.setattr(storage_node, "existing_checksum", slow_existing_checksum)
+    statuses = {}
+
+    def upload(name, data):
+        statuses[name] = direct_upload(storage_node.app.test_client(), data).status_code
+
+    threads = [threading.Thread(target=upload, args=("first", first))]
+    threads[0].start()
+    assert paused.wait(5)
+    threads.append(threading.Thread(target=upload, args=("second", second)))
+    threads[1].start()
+    threads[1].join(0.5)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert statuses == {"first": 200, "second": 409}
+    assert storage_node.read_fragment("file_1", 0) == (first, checksum(first))
+
+
+def test_fragments_are_served_whole_and_by_range(storage_node):
+    client = storage_node.app.test_client()
+    data = bytes(range(256)) * 1000
+    assert client.post("/upload_fragment?file_id=file_1&frag_idx=0", data=data).status_code == 200
+
+    reply = client.get("/get_fragment?file_id=file_1&frag_idx=0")
+    assert reply.data == data and reply.headers["X-Checksum"] == checksum(data)
+    reply = client.get("/get_fragment?file_id=file_1&frag_idx=0", headers={"Range": "bytes=1000-199999"})
+    assert reply.status_code == 206 and reply.data == data[1000:200_000]
+
+
+def test_uploads_that_do_not_match_their_checksum_are_rejected(storage_node):
+    client = storage_node.app.test_client()
+    reply = client.post(
+        "/upload_fragment?file_id=file_1&frag_idx=0", data=b"data", headers={"X-Checksum": checksum(b"other")}
+    )
+    assert reply.status_code == 400
+    assert storage_node.read_fragment("file_1", 0) is None
+
+
+@pytest.mark.parametrize("storage_node", ["files"], indirect=True)
+def test_fragments_the_scrubber_finds_corrupt_are_not_served(storage_node):
+    client = storage_node.app.test_client()
+    assert client.post("/upload_fragment?file_id=file_1&frag_idx=0", data=b"data").status_code == 200
+    with open(f"{storage_node.storage_dir}/file_1_0", "wb") as f:
+        f.write(b"rot!")
+
+    storage_node.scrubber.scrub()
+    assert client.get("/get_fragment?file_id=file_1&frag_idx=0").status_code == 404
+    # Until the fragment is written again
+    assert client.post("/upload_fragment?file_id=file_1&frag_idx=0", data=b"data").status_code == 200
+    assert client.get("/get_fragment?file_id=file_1&frag_idx=0").data == b"data"
@@ -0,0 +1,81 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import storage_node_client
+from storage_node_client import close_node_pool, open_node_pool
+from storage_node_client import download_fragment_from_node, upload_fragment_to_node
+
+
+class FragmentHandler(BaseHTTPRequestHandler):
+    """Fragment upload and download that keeps connections open, noting the client port of every request.
+
+    Flask's development server closes every connection, so it cannot show whether they are reused.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def key(self):
+        query = parse_qs(urlparse(self.path).query)
+        return query["file_id"][0], query["frag_idx"][0]
+
+    def reply(self, status, body=b""):
+        self.server.ports.append(self.client_address[1])
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.server.fragments[self.key()] = self.rfile.read(int(self.headers["Content-Length"]))
+        self.reply(200, b"OK")
+
+    def do_GET(self):
+        fragment = self.server.fragments.get(self.key())
+        if fragment is None:
+            self.reply(404)
+        else:
+            self.reply(200, fragment)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def node():
+    server = ThreadingHTTPServer(("127.0.0.160", 5000), FragmentHandler)
+    server.daemon_threads = True
+    server.fragments, server.ports = {}, []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # A name no other test uses, pools are kept per node name
+    member = {"name": "pooled-node", "ip": "127.0.0.160"}
+    try:
+        yield member, server
+    finally:
+        close_node_pool(member)
+        server.shutdown()
+        server.server_close()
+
+
+def test_requests_to_a_node_reuse_its_pooled_connection(node):
+    member, server = node
+    for frag_idx in range(10):
+        assert upload_fragment_to_node(member, member["ip"], "file_1", frag_idx, b"x" * 1000)
+        assert download_fragment_from_node(member, member["ip"], "file_1", frag_idx) == b"x" * 1000
+    assert len(server.ports) == 20 and len(set(server.ports)) == 1
+
+
+def test_a_node_keeps_one_pool_until_it_is_closed(node):
+    member, server = node
+    session = open_node_pool(member)
+    assert open_node_pool(dict(member)) is session
+    assert upload_fragment_to_node(member, member["ip"], "file_1", 0, b"x")
+    close_node_pool(member)
+    assert member["name"] not in storage_node_client._sessions
+
+    # A node that is used again gets a new pool with new connections
+    assert download_fragment_from_node(member, member["ip"], "file_1", 0) == b"x"
+    assert storage_node_client._sessions[member["name"]] is not session
+    assert len(set(server.ports)) == 2
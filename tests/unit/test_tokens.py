@@ -0,0 +1,24 @@
+import time
+
+import tokens
+
+SECRET = "secret"
+
+
+def test_a_token_allows_one_operation_on_one_fragment():
+    token = tokens.sign(SECRET, tokens.UPLOAD, "file_1", 0, int(time.time()) + 60)
+    assert tokens.verify(SECRET, token, tokens.UPLOAD, "file_1", 0)
+    assert tokens.verify(SECRET, token, tokens.UPLOAD, "file_1", "0")
+    assert not tokens.verify(SECRET, token, tokens.DOWNLOAD, "file_1", 0)
+    assert not tokens.verify(SECRET, token, tokens.UPLOAD, "file_1", 1)
+    assert not tokens.verify(SECRET, token, tokens.UPLOAD, "file_2", 0)
+    assert not tokens.verify("other", token, tokens.UPLOAD, "file_1", 0)
+
+
+def test_expired_and_forged_tokens_are_refused():
+    expired = tokens.sign(SECRET, tokens.DOWNLOAD, "file_1", 0, int(time.time()) - 1)
+    assert not tokens.verify(SECRET, expired, tokens.DOWNLOAD, "file_1", 0)
+    # Moving the expiry breaks the signature
+    mac = expired.split(".", 1)[1]
+    assert not tokens.verify(SECRET, f"{int(time.time()) + 60}.{mac}", tokens.DOWNLOAD, "file_1", 0)
+    assert not tokens.verify(SECRET, "garbage", tokens.DOWNLOAD, "file_1", 0)
@@ -0,0 +1,114 @@
+import asyncio
+import threading
+import time
+
+from node_load import NodeLoad
+from upload_engine import UploadEngine
+
+A, B = {"name": "storage-a"}, {"name": "storage-b"}
+
+
+class Uploads:
+    """Uploads that run until released, counting how many run at once per node"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.release = threading.Event()
+        self.running = {}
+        self.most_running = {}
+
+    def upload(self, node, result):
+        with self.lock:
+            self.running[node["name"]] = self.running.get(node["name"], 0) + 1
+            self.most_running[node["name"]] = max(
+                self.most_running.get(node["name"], 0), self.running[node["name"]]
+            )
+        try:
+            self.release.wait(5)
+            return result
+        finally:
+            with self.lock:
+                self.running[node["name"]] -= 1
+
+
+def test_no_node_runs_more_than_its_limit_and_a_busy_node_holds_up_no_other():
+    engine = UploadEngine(8, 2, 100, 4)
+    uploads = Uploads()
+    held = [engine.submit(A, uploads.upload, A, i) for i in range(6)]
+    # A's uploads beyond its limit wait in its queue, not on workers B needs
+    assert engine.submit(B, lambda: "b").result(timeout=1) == "b"
+    time.sleep(0.1)
+    assert uploads.running == {A["name"]: 2}
+
+    uploads.release.set()
+    assert [future.result(timeout=5) for future in held] == list(range(6))
+    assert uploads.most_running == {A["name"]: 2}
+
+
+def test_submit_blocks_while_the_queue_is_full():
+    engine = UploadEngine(4, 1, 2, 4)
+    uploads = Uploads()
+    engine.submit(A, uploads.upload, A, 0)
+    engine.submit(A, uploads.upload, A, 1)
+    submitted = threading.Event()
+
+    def submit():
+        engine.submit(A, uploads.upload, A, 2)
+        submitted.set()
+
+    threading.Thread(target=submit, daemon=True).start()
+    assert not submitted.wait(0.2)
+    uploads.release.set()
+    assert submitted.wait(5)
+
+
+def test_uploads_waiting_for_a_node_that_left_are_started():
+    engine = UploadEngine(8, 1, 100, 4)
+    uploads = Uploads()
+    running = engine.submit(A, uploads.upload, A, 0)
+    waiting = [engine.submit(A, lambda i=i: i) for i in range(1, 4)]
+    time.sleep(0.1)
+    assert not any(future.done() for future in waiting)
+
+    engine.forget_node(A)
+    assert [future.result(timeout=1) for future in waiting] == [1, 2, 3]
+    uploads.release.set()
+    assert running.result(timeout=5) == 0
+
+
+def test_uploads_are_reported_to_node_load():
+    load = NodeLoad(0.5, 0.05)
+    engine = UploadEngine(4, 4, 100, 4, load)
+    uploads = Uploads()
+    futures = [engine.submit(A, uploads.upload, A, i) for i in range(3)]
+    time.sleep(0.1)
+    assert load.stats()[A["name"]]["in_flight"] == 3
+
+    uploads.release.set()
+    for future in futures:
+        future.result(timeout=5)
+    assert load.stats()[A["name"]]["in_flight"] == 0
+    assert load.stats()[A["name"]]["latency"] > 0
+
+
+def test_uploads_on_an_event_loop_share_the_node_limit():
+    engine = UploadEngine(4, 1, 100, 4, NodeLoad(0.5, 0.05))
+    uploads = Uploads()
+    running = engine.submit(A, uploads.upload, A, 0)
+
+    async def upload(result):
+        return result
+
+    async def main():
+        waiting = asyncio.ensure_future(engine.run_async(A, upload, "waited"))
+        cancelled = asyncio.ensure_future(engine.run_async(A, upload, "cancelled"))
+        await asyncio.sleep(0.1)
+        assert not waiting.done()
+        cancelled.cancel()
+        uploads.release.set()
+        assert await waiting == "waited"
+        # The slot of the cancelled upload was handed on
+        assert await asyncio.wait_for(engine.run_async(A, upload, "next"), 1) == "next"
+
+    asyncio.run(main())
+    assert running.result(timeout=5) == 0
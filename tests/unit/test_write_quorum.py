@@ -0,0 +1,61 @@
+import threading
+
+from write_quorum import WriteQuorum
+
+
+def node(name):
+    return {"name": name, "ip": name}
+
+
+# Two fragments with three replicas each, node b holds two replicas of fragment 1
+ASSIGNED = [
+    [node("a"), node("b")],
+    [node("b"), node("b")],
+    [node("c"), node("d")],
+]
+
+
+def test_quorum_per_fragment():
+    tracker = WriteQuorum({"f": ASSIGNED}, 2)
+    tracker.ack("a", [("f", 0)])
+    tracker.ack("b", [("f", 0)])
+    tracker.finish()
+    # Fragment 1 has no acknowledged replica
+    assert tracker.wait() == set()
+
+
+def test_node_ack_covers_all_its_replicas():
+    tracker = WriteQuorum({"f": ASSIGNED}, 2)
+    tracker.ack("a", [("f", 0)])
+    tracker.ack("b", [("f", 0), ("f", 1)])
+    assert tracker.wait() == {"f"}
+    assert tracker.pending("f") == [[2, 0], [2, 1]]
+
+
+def test_duplicate_acks_count_once():
+    tracker = WriteQuorum({"f": ASSIGNED}, 3)
+    for _ in range(3):
+        tracker.ack("a", [("f", 0)])
+        tracker.ack("b", [("f", 1)])
+    tracker.finish()
+    assert tracker.wait() == set()
+
+
+def test_quorum_is_capped_by_replicas():
+    tracker = WriteQuorum({"f": [[node("a")]]}, 3)
+    tracker.ack("a", [("f", 0)])
+    assert tracker.wait() == {"f"}
+    assert tracker.pending("f") == []
+
+
+def test_wait_returns_once_quorum_is_reached():
+    tracker = WriteQuorum({"f": ASSIGNED, "g": [[node("c")], [node("d")]]}, 1)
+    written = []
+    waiter = threading.Thread(target=lambda: written.append(tracker.wait()))
+    waiter.start()
+    tracker.ack("a", [("f", 0)])
+    tracker.ack("b", [("f", 1)])
+    tracker.ack("d", [("g", 0)])
+    waiter.join(timeout=5)
+    assert written == [{"f", "g"}]
+    assert tracker.written() == {"f", "g"}